@@ -0,0 +1,61 @@
+import gzip
+import time
+
+import orjson
+
+from fhir_kindling.fhir_server.transactions import make_transaction_bundle
+from fhir_kindling.generators import PatientGenerator
+from fhir_kindling.serde.json import json_bytes
+
+BUNDLE_SIZES = [100, 1000, 5000]
+COMPRESSION_LEVELS = [1, 6, 9]
+
+
+def search_page(resources: list) -> bytes:
+    # search result page as returned by a server for a query of the given resources
+    return orjson.dumps(
+        {
+            "resourceType": "Bundle",
+            "type": "searchset",
+            "total": len(resources),
+            "entry": [
+                {
+                    "resource": orjson.loads(json_bytes(resource)),
+                    "search": {"mode": "match"},
+                }
+                for resource in resources
+            ],
+        }
+    )
+
+
+def measure(name: str, content: bytes) -> list:
+    results = []
+    for level in COMPRESSION_LEVELS:
+        start = time.perf_counter()
+        compressed = gzip.compress(content, compresslevel=level)
+        elapsed = time.perf_counter() - start
+        results.append(
+            {
+                "payload": name,
+                "level": level,
+                "bytes": len(content),
+                "wire_bytes": len(compressed),
+                "ratio": len(content) / len(compressed),
+                "compress_time": elapsed,
+            }
+        )
+    return results
+
+
+if __name__ == "__main__":
+    for size in BUNDLE_SIZES:
+        patients = PatientGenerator(n=size).generate()
+        bundle = json_bytes(make_transaction_bundle(resources=patients))
+        results = measure(f"transaction bundle ({size} patients)", bundle)
+        results += measure(f"search page ({size} patients)", search_page(patients))
+        for r in results:
+            print(
+                f"{r['payload']}, level {r['level']}: {r['bytes']} -> {r['wire_bytes']} bytes "
+                f"({r['ratio']:.1f}x) in {r['compress_time'] * 1000:.1f} ms"
+            )
@@ -0,0 +1,53 @@
+import json
+import time
+
+from fhir_kindling.fhir_server.transactions import make_transaction_bundle
+from fhir_kindling.generators import PatientGenerator
+from fhir_kindling.serde.json import json_bytes, json_dict
+
+BUNDLE_SIZES = [100, 1000, 5000]
+N_ATTEMPTS = 5
+
+
+def encode_double(bundle) -> bytes:
+    # previous request path: model -> json -> dict, re-encoded by httpx with the stdlib json module
+    return json.dumps(json_dict(bundle)).encode("utf-8")
+
+
+def encode_direct(bundle) -> bytes:
+    return json_bytes(bundle)
+
+
+def time_encoding(encode, bundle) -> float:
+    times = []
+    for _ in range(N_ATTEMPTS):
+        start = time.perf_counter()
+        encode(bundle)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def benchmark_serialization(bundle_size: int) -> dict:
+    patients = PatientGenerator(n=bundle_size).generate()
+    bundle = make_transaction_bundle(resources=patients)
+
+    double_time = time_encoding(encode_double, bundle)
+    direct_time = time_encoding(encode_direct, bundle)
+    return {
+        "bundle_size": bundle_size,
+        "payload_bytes": len(encode_direct(bundle)),
+        "json_dict_time": double_time,
+        "json_bytes_time": direct_time,
+        "speedup": double_time / direct_time,
+    }
+
+
+if __name__ == "__main__":
+    results = [benchmark_serialization(size) for size in BUNDLE_SIZES]
+    for result in results:
+        print(
+            f"{result['bundle_size']} resources ({result['payload_bytes']} bytes): "
+            f"json_dict {result['json_dict_time'] * 1000:.1f} ms, "
+            f"json_bytes {result['json_bytes_time'] * 1000:.1f} ms "
+            f"({result['speedup']:.1f}x)"
+        )
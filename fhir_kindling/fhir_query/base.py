@@ -1,5 +1,8 @@
+import pathlib
+from contextlib import contextmanager, nullcontext
+from datetime import date, datetime, time, timedelta, timezone
 from inspect import signature
-from typing import Any, Callable, List, TypeVar, Union
+from typing import Any, BinaryIO, Callable, Iterator, List, TypeVar, Union
 
 import fhir.resources
 import httpx
@@ -16,10 +19,21 @@ from fhir_kindling.fhir_query.query_parameters import (
 )
 from fhir_kindling.fhir_query.query_response import (
     OutputFormats,
+    QueryResponse,
+    ResponseStatusCodes,
 )
+from fhir_kindling.util.date_utils import (
+    parse_datetime,
+    split_time_range,
+    to_search_string,
+)
+from fhir_kindling.util.resource_cache import ResourceCache
 
 T = TypeVar("T", bound="FhirQueryBase")
 
+# search parameters used by servers to page through search results by offset e.g. HAPI uses _getpagesoffset
+OFFSET_PARAMETERS = ("_getpagesoffset", "_offset")
+
 
 class FhirQueryBase:
     def __init__(
@@ -32,6 +46,7 @@ class FhirQueryBase:
         auth: httpx.Auth = None,
         headers: dict = None,
         output_format: str = "json",
+        cache: ResourceCache = None,
     ):
         if base_url[-1] == "/":
             base_url = base_url[:-1]
@@ -40,6 +55,8 @@ class FhirQueryBase:
         # Set up the requests session with auth and headers
         self.auth = auth
         self.headers = headers
+        # resources of the result pages are stored in the resource cache of the server
+        self.cache = cache
 
         # initialize the resource and query parameters
         if resource:
@@ -76,6 +93,8 @@ class FhirQueryBase:
         self._includes = None
         self._limit = None
         self._count = None
+        self._lazy = False
+        self._validate = True
         self._query_response: Union[Bundle, str, None] = None
 
     def where(
@@ -266,6 +285,22 @@ class FhirQueryBase:
 
         return self
 
+    def lazy(self: T, validate: bool = False) -> T:
+        """
+        Materialize the resources of the query response lazily. The resources are kept as the raw dictionaries
+        returned by the server and are only parsed into FHIR models when they are accessed.
+
+        Args:
+            validate: validate the resources against their FHIR model when they are parsed. If False the models are
+                created without validation, which is considerably faster for large result sets.
+
+        Returns:
+            Query object returning lazily materialized responses
+        """
+        self._lazy = True
+        self._validate = validate
+        return self
+
     def _make_query_string(self) -> str:
         """
         Make the query string from the query parameters
@@ -318,6 +353,215 @@ class FhirQueryBase:
         """
         return self._make_query_string()
 
+    @staticmethod
+    def _next_page_url(page: dict) -> Union[str, None]:
+        """
+        Get the url of the next page from the links of a bundle page
+
+        Args:
+            page: json bundle of a page of query results
+
+        Returns:
+            url of the next page or None if it is the last page
+        """
+        for link in page.get("link", []):
+            if link.get("relation", None) == "next":
+                return link.get("url")
+        return None
+
+    def _offset_page_urls(self, first_page: dict, total: int) -> Union[List[str], None]:
+        """
+        Compute the urls of all pages following the first page, based on the offset parameter of the next link.
+
+        Args:
+            first_page: json bundle of the first page of query results
+            total: total number of resources matching the query
+
+        Returns:
+            list of the urls of the remaining pages or None if the server does not page via offsets
+        """
+        next_url = self._next_page_url(first_page)
+        page_size = len(first_page.get("entry", []))
+        if not next_url or page_size == 0:
+            return []
+
+        next_url = httpx.URL(next_url)
+        offset_param = next(
+            (param for param in OFFSET_PARAMETERS if param in next_url.params), None
+        )
+        if not offset_param:
+            return None
+
+        if self._limit:
+            total = min(total, self._limit)
+        first_offset = int(next_url.params[offset_param])
+        # the offset of the next link is the number of matches on the first page, the entries of a page also contain
+        # resources added by _include/_revinclude and OperationOutcomes
+        page_size = first_offset or _match_count(first_page)
+        if page_size == 0:
+            return []
+        return [
+            str(next_url.copy_set_param(offset_param, offset))
+            for offset in range(first_offset, total, page_size)
+        ]
+
+    def _merge_pages(self, pages: List[dict], count: int = None) -> QueryResponse:
+        """
+        Merge the entries of pages fetched independently of each other into a single query response
+
+        Args:
+            pages: the pages of query results in order
+            count: number of results in a page
+
+        Returns:
+            QueryResponse containing the entries of all pages
+        """
+        response_json = pages[0]
+        entries = []
+        for page in pages:
+            self._cache_page(page)
+            entries.extend(page.get("entry", []))
+        response_json["entry"] = entries[: self._limit] if self._limit else entries
+        self.status_code = (
+            ResponseStatusCodes.OK if entries else ResponseStatusCodes.NOT_FOUND
+        )
+
+        return self._make_response(response_json, count)
+
+    def _partition_queries(
+        self,
+        start: Union[datetime, date, str],
+        end: Union[datetime, date, str, None],
+        partitions: int,
+        field: str,
+    ) -> List[T]:
+        """
+        Split the query into disjoint sub-queries, each restricted to a consecutive time window of the given date
+        search parameter via ge/lt conditions.
+
+        Args:
+            start: start of the time range covered by the sub-queries (inclusive)
+            end: end of the time range (exclusive), defaults to the current time
+            partitions: number of sub-queries
+            field: date search parameter used to split the query e.g. _lastUpdated
+
+        Returns:
+            list of sub-queries sharing the client of this query
+        """
+        start = _as_utc_datetime(start)
+        end = (
+            _as_utc_datetime(end)
+            if end
+            else datetime.now(timezone.utc) + timedelta(seconds=1)
+        )
+        queries = []
+        for window_start, window_end in split_time_range(start, end, partitions):
+            query_parameters = self.query_parameters.copy(deep=True)
+            query_parameters.resource_parameters = list(
+                query_parameters.resource_parameters or []
+            ) + [
+                FieldParameter(
+                    field=field,
+                    operator=QueryOperators.ge,
+                    value=to_search_string(window_start),
+                ),
+                FieldParameter(
+                    field=field,
+                    operator=QueryOperators.lt,
+                    value=to_search_string(window_end),
+                ),
+            ]
+            queries.append(
+                self.__class__(
+                    base_url=self.base_url,
+                    query_parameters=query_parameters,
+                    auth=self.auth,
+                    headers=self.headers,
+                    output_format=self.output_format.value,
+                    client=self.client,
+                    proxies=self.proxies,
+                    cache=self.cache,
+                )
+            )
+        return queries
+
+    def _merge_partitions(
+        self, responses: List[QueryResponse], count: int = None
+    ) -> QueryResponse:
+        """
+        Merge the responses of partitioned sub-queries into a single response, resources returned by multiple
+        sub-queries (e.g. included resources) are only added once.
+
+        Args:
+            responses: responses of the sub-queries
+            count: number of results in a page
+
+        Returns:
+            QueryResponse containing the de-duplicated entries of all sub-queries
+        """
+        seen = set()
+        entries = []
+        for response in responses:
+            for entry in response.response.get("entry", []):
+                resource = entry.get("resource", {})
+                key = (
+                    (resource.get("resourceType"), resource["id"])
+                    if resource.get("id")
+                    else entry.get("fullUrl")
+                )
+                if key is not None:
+                    if key in seen:
+                        continue
+                    seen.add(key)
+                entries.append(entry)
+
+        response_json = dict(responses[0].response)
+        response_json["entry"] = entries
+        # links and total of a single partition do not apply to the merged response
+        response_json.pop("link", None)
+        response_json.pop("total", None)
+        self.status_code = (
+            ResponseStatusCodes.OK if entries else ResponseStatusCodes.NOT_FOUND
+        )
+        return self._make_response(response_json, count)
+
+    def _make_response(self, response: Any, count: int = None) -> QueryResponse:
+        return QueryResponse(
+            response=response,
+            query_params=self.query_parameters,
+            count=count,
+            limit=self._limit,
+            output_format=self.output_format,
+            lazy=self._lazy,
+            validate=self._validate,
+        )
+
+    def _validate_stream_format(self):
+        if self.output_format != OutputFormats.JSON:
+            raise NotImplementedError(
+                "Streaming query results is only supported for json format"
+            )
+
+    def _validate_xml_format(self):
+        if self.output_format != OutputFormats.XML:
+            raise ValueError(
+                "Writing the results as xml requires a query with output_format='xml'"
+            )
+
+    @staticmethod
+    @contextmanager
+    def _xml_output(file: Union[str, pathlib.Path, BinaryIO]) -> Iterator[BinaryIO]:
+        if isinstance(file, (str, pathlib.Path)):
+            with open(file, "wb") as f:
+                yield f
+        else:
+            with nullcontext(file) as f:
+                yield f
+
+    def _cache_page(self, page: dict) -> None:
+        if self.cache is not None:
+            self.cache.put_bundle(page)
+
     @staticmethod
     def _execute_callback(
         entries: list,
@@ -367,3 +611,20 @@ class FhirQueryBase:
             return (
                 f"<{self.__class__.__name__}(resource={resource}, url={self.query_url}>"
             )
+
+
+def _as_utc_datetime(value: Union[datetime, date, str]) -> datetime:
+    if isinstance(value, str):
+        value = parse_datetime(value)
+    if not isinstance(value, datetime):
+        value = datetime.combine(value, time())
+    return value.astimezone(timezone.utc)
+
+
+def _match_count(page: dict) -> int:
+    # entries without a search mode are counted as matches, servers are not required to set it
+    return sum(
+        1
+        for entry in page.get("entry", [])
+        if (entry.get("search") or {}).get("mode", "match") == "match"
+    )
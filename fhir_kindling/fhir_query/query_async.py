@@ -1,10 +1,13 @@
-from typing import Any, Callable, List, Union
+import asyncio
+import io
+import pathlib
+from datetime import date, datetime
+from typing import Any, AsyncIterator, BinaryIO, Callable, List, Union
 
 import fhir.resources
 import httpx
 import orjson
-import xmltodict
-from fhir.resources import FHIRAbstractModel
+from fhir.resources import FHIRAbstractModel, construct_fhir_element
 from fhir.resources.fhirresourcemodel import FHIRResourceModel
 
 from fhir_kindling.fhir_query.base import FhirQueryBase
@@ -16,6 +19,11 @@ from fhir_kindling.fhir_query.query_response import (
     QueryResponse,
     ResponseStatusCodes,
 )
+from fhir_kindling.serde.xml import XmlBundlePage, XmlBundleWriter
+from fhir_kindling.util.resource_cache import ResourceCache
+
+# marks the end of the pages put into the queue of a streamed query
+_STREAM_END = object()
 
 
 class FhirQueryAsync(FhirQueryBase):
@@ -31,6 +39,7 @@ class FhirQueryAsync(FhirQueryBase):
         output_format: str = "json",
         client: httpx.AsyncClient = None,
         proxies: Union[str, dict] = None,
+        cache: ResourceCache = None,
     ):
         """Initialize an async FHIR query object.
 
@@ -43,6 +52,7 @@ class FhirQueryAsync(FhirQueryBase):
             output_format: Response format of the query. Defaults to "json".
             client: httpx Client passed from the server. Defaults to None.
             proxies: List of proxies to use. Defaults to None.
+            cache: Resource cache of the server the resources of the result pages are stored in. Defaults to None.
         """
         super().__init__(
             base_url,
@@ -51,6 +61,7 @@ class FhirQueryAsync(FhirQueryBase):
             auth,
             headers,
             output_format,
+            cache,
         )
         self.proxies = proxies
         # set up the async client instance
@@ -66,6 +77,8 @@ class FhirQueryAsync(FhirQueryBase):
             Callable[[List[FHIRAbstractModel]], Any], Callable[[], Any], None
         ] = None,
         count: int = None,
+        parallel: bool = False,
+        max_concurrency: int = 4,
     ) -> QueryResponse:
         """
         Execute the query and return all results matching the query parameters.
@@ -73,6 +86,10 @@ class FhirQueryAsync(FhirQueryBase):
         Args:
             page_callback: if this argument is set the given callback function will be called for each page of results
             count: number of results in a page, default value of 50 is used when page_callback is set but no count is
+            parallel: fetch the pages concurrently if the server supports paging by offset (e.g. `_getpagesoffset` or
+                `_offset`), otherwise the pages are resolved one after another. The page callback is called in the
+                order the pages arrive
+            max_concurrency: maximum number of pages fetched at the same time in parallel mode
         Returns:
             QueryResponse object containing all resources matching the query, as well os optional included
             resources.
@@ -80,7 +97,16 @@ class FhirQueryAsync(FhirQueryBase):
         """
         self._limit = None
         self._count = count
-        response = await self._execute_query(page_callback=page_callback, count=count)
+        if parallel:
+            response = await self._execute_parallel_query(
+                page_callback=page_callback,
+                count=count,
+                max_concurrency=max_concurrency,
+            )
+        else:
+            response = await self._execute_query(
+                page_callback=page_callback, count=count
+            )
         return response
 
     async def limit(
@@ -108,6 +134,43 @@ class FhirQueryAsync(FhirQueryBase):
         response = await self._execute_query(page_callback=page_callback, count=count)
         return response
 
+    async def all_partitioned(
+        self,
+        start: Union[datetime, date, str],
+        end: Union[datetime, date, str] = None,
+        partitions: int = 4,
+        field: str = "_lastUpdated",
+        count: int = None,
+        max_concurrency: int = None,
+    ) -> QueryResponse:
+        """
+        Execute the query as multiple disjoint sub-queries concurrently, each covering a time window of the given date
+        search parameter, and return the de-duplicated results of all sub-queries.
+
+        Args:
+            start: start of the time range to query (inclusive)
+            end: end of the time range to query (exclusive), defaults to the current time
+            partitions: number of sub-queries the time range is split into
+            field: date search parameter used to split the query, defaults to _lastUpdated
+            count: number of results in a page
+            max_concurrency: maximum number of sub-queries executed at the same time, defaults to all partitions
+
+        Returns:
+            QueryResponse object containing all resources matching the query in the time range
+        """
+        self._validate_stream_format()
+        self._limit = None
+        self._count = count
+        queries = self._partition_queries(start, end, partitions, field)
+        semaphore = asyncio.Semaphore(max_concurrency or len(queries))
+
+        async def execute(query: FhirQueryAsync) -> QueryResponse:
+            async with semaphore:
+                return await query.all(count=count)
+
+        responses = await asyncio.gather(*[execute(query) for query in queries])
+        return self._merge_partitions(list(responses), count)
+
     async def first(self) -> QueryResponse:
         """
         Return the first resource matching the query parameters.
@@ -131,9 +194,93 @@ class FhirQueryAsync(FhirQueryBase):
         response.raise_for_status()
         return response.json()["total"]
 
+    async def stream(
+        self, limit: int = None, count: int = None, prefetch: int = 1
+    ) -> AsyncIterator[List[dict]]:
+        """
+        Execute the query and yield the entries of each page of results. While a page is processed by the caller, the
+        following pages are already fetched in the background.
+
+        Args:
+            limit: maximum number of entries to return over all pages
+            count: number of results in a page
+            prefetch: number of pages that are fetched ahead of the page that is currently processed
+
+        Returns:
+            Async iterator over the lists of bundle entries of each page
+        """
+        self._validate_stream_format()
+        if prefetch < 1:
+            raise ValueError(f"prefetch must be at least 1, given {prefetch}")
+        self._limit = limit
+        self._count = count
+
+        queue = asyncio.Queue()
+        slots = asyncio.Semaphore(prefetch)
+        producer = asyncio.ensure_future(self._prefetch_pages(queue, slots))
+        try:
+            while True:
+                page = await queue.get()
+                slots.release()
+                if page is _STREAM_END:
+                    break
+                if isinstance(page, Exception):
+                    raise page
+                yield page.get("entry", [])
+        finally:
+            producer.cancel()
+
+    async def iter_resources(
+        self, limit: int = None, count: int = None, prefetch: int = 1
+    ) -> AsyncIterator[FHIRAbstractModel]:
+        """
+        Execute the query and yield the resources (including included resources) one page at a time, while the
+        following pages are fetched in the background.
+
+        Args:
+            limit: maximum number of resources to return
+            count: number of results in a page
+            prefetch: number of pages that are fetched ahead of the page that is currently processed
+
+        Returns:
+            Async iterator over the resources matching the query
+        """
+        async for entries in self.stream(limit=limit, count=count, prefetch=prefetch):
+            for entry in entries:
+                resource = entry.get("resource")
+                if resource:
+                    yield construct_fhir_element(resource["resourceType"], resource)
+
+    async def write_xml(
+        self,
+        file: Union[str, pathlib.Path, BinaryIO],
+        limit: int = None,
+        count: int = None,
+    ) -> int:
+        """
+        Execute the query and write the results of all pages as a single xml bundle to a file. The entries of each
+        page are copied to the file as soon as the page is received, so only a single page is kept in memory.
+
+        Args:
+            file: path of the file or binary file object to write the bundle to
+            limit: maximum number of entries to write
+            count: number of results in a page
+
+        Returns:
+            Number of entries written to the file
+        """
+        self._validate_xml_format()
+        self._limit = limit
+        self._count = count
+        r = await self.client.get(self.query_url)
+        r.raise_for_status()
+        with self._xml_output(file) as f:
+            return await self._write_xml_pages(r.content, f)
+
     def _setup_client(self):
         headers = self.headers if self.headers else {}
         headers["Content-Type"] = "application/fhir+json"
+        headers.setdefault("Accept-Encoding", "gzip, deflate")
         self.client = httpx.AsyncClient(auth=self.auth, headers=headers, timeout=None)
 
     async def _execute_query(
@@ -148,6 +295,56 @@ class FhirQueryAsync(FhirQueryBase):
         response = await self._resolve_response_pagination(r, page_callback, count)
         return response
 
+    async def _execute_parallel_query(
+        self,
+        page_callback: Union[
+            Callable[[List[FHIRAbstractModel]], Any], Callable[[], Any], None
+        ] = None,
+        count: int = None,
+        max_concurrency: int = 4,
+    ) -> QueryResponse:
+        self._validate_stream_format()
+        if max_concurrency < 1:
+            raise ValueError(
+                f"max_concurrency must be at least 1, given {max_concurrency}"
+            )
+        total = await self.count()
+
+        r = await self.client.get(self.query_url)
+        r.raise_for_status()
+        first_page = orjson.loads(r.content)
+        page_urls = self._offset_page_urls(first_page, total)
+        # fall back to following the next links if the server does not page by offset
+        if page_urls is None:
+            return await self._resolve_response_pagination(r, page_callback, count)
+
+        self._execute_callback(first_page.get("entry", []), page_callback)
+        pages = [first_page] + [None] * len(page_urls)
+        semaphore = asyncio.Semaphore(max_concurrency)
+
+        async def fetch_page(index: int, url: str) -> dict:
+            async with semaphore:
+                page_response = await self.client.get(url)
+                page_response.raise_for_status()
+                pages[index] = orjson.loads(page_response.content)
+                return pages[index]
+
+        tasks = [
+            asyncio.ensure_future(fetch_page(index, url))
+            for index, url in enumerate(page_urls, start=1)
+        ]
+        try:
+            # the callback is called as soon as a page arrives, the pages are merged in order
+            for next_page in asyncio.as_completed(tasks):
+                page = await next_page
+                self._execute_callback(page.get("entry", []), page_callback)
+        finally:
+            # pages that are still being fetched are cancelled after an error
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+        return self._merge_pages(pages, count)
+
     async def _resolve_response_pagination(
         self,
         initial_response: httpx.Response,
@@ -164,13 +361,7 @@ class FhirQueryAsync(FhirQueryBase):
         else:
             response = await self._resolve_xml_pagination(initial_response)
 
-        return QueryResponse(
-            response=response,
-            query_params=self.query_parameters,
-            count=count,
-            limit=self._limit,
-            output_format=self.output_format,
-        )
+        return self._make_response(response, count)
 
     async def _resolve_json_pagination(
         self,
@@ -185,91 +376,103 @@ class FhirQueryAsync(FhirQueryBase):
         # If there is a link, get the next page otherwise return the response
         if not link:
             self.status_code = ResponseStatusCodes.OK
+            self._cache_page(response_json)
             return response_json
-        else:
-            entries = []
-            initial_entry = response_json.get("entry", None)
-            if not initial_entry:
-                self.status_code = ResponseStatusCodes.NOT_FOUND
-                return response_json
-            else:
-                self.status_code = ResponseStatusCodes.OK
-                response_entries = response_json["entry"]
-                entries.extend(response_entries)
-                self._execute_callback(response_entries, page_callback)
-            # if the limit is reached, stop resolving the pagination
-            if self._limit and len(entries) >= self._limit:
-                response_entries = response_json["entry"][: self._limit]
-                response_json["entry"] = response_entries
-                self._execute_callback(response_entries, page_callback)
-                return response_json
-            # query the linked page and add the entries to the response
-            while response_json.get("link", None):
-                if self._limit and len(entries) >= self._limit:
-                    break
-                next_page = next(
-                    (
-                        link
-                        for link in response_json["link"]
-                        if link.get("relation", None) == "next"
-                    ),
-                    None,
-                )
-                if next_page:
-                    page_response = await self.client.get(next_page["url"])
-                    response_json = page_response.json()
-                    response_entries = response_json["entry"]
-                    entries.extend(response_entries)
-                    self._execute_callback(response_entries, page_callback)
-                else:
-                    break
-
-            response_json["entry"] = entries[: self._limit] if self._limit else entries
+        if not response_json.get("entry", None):
+            self.status_code = ResponseStatusCodes.NOT_FOUND
             return response_json
 
+        self.status_code = ResponseStatusCodes.OK
+        # collect the entries of all linked pages into the initial response
+        entries = []
+        async for page in self._iter_json_pages(response_json):
+            response_entries = page.get("entry", [])
+            entries.extend(response_entries)
+            self._execute_callback(response_entries, page_callback)
+
+        response_json["entry"] = entries
+        return response_json
+
+    async def _iter_json_pages(self, page: dict) -> AsyncIterator[dict]:
+        """
+        Follow the next links starting from the given page and yield the pages one after another, the entries of the
+        pages are truncated once the limit of the query is reached.
+
+        Args:
+            page: the first page of the query results
+
+        Returns:
+            Async iterator over the pages of the query results
+        """
+        n_entries = 0
+        while True:
+            if self._limit and page.get("entry"):
+                page["entry"] = page["entry"][: self._limit - n_entries]
+            n_entries += len(page.get("entry", []))
+            next_url = self._next_page_url(page)
+            self._cache_page(page)
+            yield page
+
+            if not next_url or (self._limit and n_entries >= self._limit):
+                break
+            r = await self.client.get(next_url)
+            r.raise_for_status()
+            page = orjson.loads(r.content)
+
+    async def _prefetch_pages(self, queue: asyncio.Queue, slots: asyncio.Semaphore):
+        """
+        Fetch the pages of the query results into the queue. A slot has to be acquired before a page is fetched,
+        which bounds the number of pages that are fetched ahead of the consumer.
+
+        Args:
+            queue: queue receiving the pages, the end of the results or the error that occurred
+            slots: semaphore with one slot per page that may be fetched ahead
+        """
+        try:
+            await slots.acquire()
+            r = await self.client.get(self.query_url)
+            r.raise_for_status()
+            async for page in self._iter_json_pages(orjson.loads(r.content)):
+                await queue.put(page)
+                # the next page is fetched when the iteration resumes
+                await slots.acquire()
+            await queue.put(_STREAM_END)
+        except Exception as e:
+            await queue.put(e)
+
     async def _resolve_xml_pagination(self, server_response: httpx.Response) -> str:
-        # parse the xml response and extract the initial entries
-        initial_response = xmltodict.parse(server_response.text)
-        entries = initial_response["Bundle"].get("entry")
+        buffer = io.BytesIO()
+        n_entries = await self._write_xml_pages(server_response.content, buffer)
 
         # if there are no entries, return the initial response
-        if not entries:
+        if not n_entries:
             self.status_code = ResponseStatusCodes.NOT_FOUND
             print(
                 f"No resources match the query - query url: {self.query_parameters.to_query_string()}"
             )
             return server_response.text
-        else:
-            self.status_code = ResponseStatusCodes.OK
-        response = initial_response
-        # resolve the pagination
-        while True:
-            next_page = False
-            for link in response["Bundle"]["link"]:
-                # if there is a next page, get the next page
-                if not isinstance(link, dict):
-                    break
-                relation_dict = link.get("relation", None)
-                if relation_dict.get("@value") == "next":
-                    # get url and extend with xml format
-                    url = link["url"]["@value"]
-                    url = url + "&_format=xml"
-                    r = await self.client.get(url)
-                    r.raise_for_status()
-                    response = xmltodict.parse(r.text)
-                    added_entries = response["Bundle"]["entry"]
-                    entries.extend(added_entries)
-                    # Stop resolving the pagination when the limit is reached
-                    if self._limit:
-                        next_page = len(entries) < self._limit
-                    else:
-                        next_page = True
-
-            if not next_page:
-                break
-        # added the paginated resources to the initial response
-        initial_response["Bundle"]["entry"] = (
-            entries[: self._limit] if self._limit else entries
-        )
-        full_response_xml = xmltodict.unparse(initial_response, pretty=True)
-        return full_response_xml
+        self.status_code = ResponseStatusCodes.OK
+        return buffer.getvalue().decode("utf-8")
+
+    async def _write_xml_pages(self, content: bytes, file: BinaryIO) -> int:
+        """
+        Follow the next links starting from the given xml page and copy the entries of all pages into a single bundle
+        written to the given file. Only the positions of the entries in each page are parsed, the entries themselves
+        are copied as is.
+
+        Args:
+            content: content of the first page of the query results
+            file: binary file object to write the bundle to
+
+        Returns:
+            Number of entries written
+        """
+        writer = XmlBundleWriter(file, limit=self._limit)
+        page = XmlBundlePage(content)
+        while writer.write_page(page) and page.next_url:
+            # get url and extend with xml format
+            r = await self.client.get(page.next_url + "&_format=xml")
+            r.raise_for_status()
+            page = XmlBundlePage(r.content)
+        writer.close()
+        return writer.n_entries
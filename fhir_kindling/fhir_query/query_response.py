@@ -1,10 +1,17 @@
 import pathlib
+import random
+from collections.abc import Sequence
 from enum import Enum
+from functools import lru_cache
 from typing import Dict, List, Optional, Union
 
 import httpx
 import orjson
-from fhir.resources import FHIRAbstractModel
+from fhir.resources import (
+    FHIRAbstractModel,
+    construct_fhir_element,
+    get_fhir_model_class,
+)
 from fhir.resources.bundle import Bundle
 from pydantic import BaseModel
 
@@ -34,6 +41,61 @@ class IncludedResources(BaseModel):
     resources: Optional[List[FHIRAbstractModel]] = None
 
 
+class LazyResourceList(Sequence):
+    """
+    Read only sequence of resources backed by the raw resource dictionaries of a server response. A resource is only
+    parsed into its FHIR model the first time it is accessed, the parsed model is cached afterwards.
+    """
+
+    def __init__(self, raw_resources: List[dict], validate: bool = True):
+        self.raw = raw_resources
+        self.validate = validate
+        self._parsed: List[Optional[FHIRAbstractModel]] = [None] * len(raw_resources)
+
+    def __len__(self) -> int:
+        return len(self.raw)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        resource = self._parsed[index]
+        if resource is None:
+            resource = parse_resource(self.raw[index], validate=self.validate)
+            self._parsed[index] = resource
+        return resource
+
+    def __repr__(self):
+        return f"<LazyResourceList(n={len(self)}, validate={self.validate})>"
+
+
+def parse_resource(resource: dict, validate: bool = True) -> FHIRAbstractModel:
+    """
+    Parse a raw resource dictionary into its FHIR model.
+
+    Args:
+        resource: the resource as returned by the server
+        validate: validate the resource against the model. If False the model is created without validation and
+            nested elements are kept as plain dictionaries and lists.
+
+    Returns:
+        The FHIR model of the resource
+    """
+    resource_type = resource["resourceType"]
+    if validate:
+        return construct_fhir_element(resource_type, resource)
+    field_names = _model_field_names(resource_type)
+    return get_fhir_model_class(resource_type).construct(
+        **{field_names.get(key, key): value for key, value in resource.items()}
+    )
+
+
+@lru_cache(maxsize=None)
+def _model_field_names(resource_type: str) -> Dict[str, str]:
+    # map the json keys to the model field names e.g. resourceType -> resource_type and class -> class_
+    model = get_fhir_model_class(resource_type)
+    return {field.alias: name for name, field in model.__fields__.items()}
+
+
 class ResponseStatusCodes(str, Enum):
     OK = 200
     CREATED = 201
@@ -54,6 +116,8 @@ class QueryResponse:
         output_format: OutputFormats = OutputFormats.JSON,
         limit: int = None,
         count: int = None,
+        lazy: bool = False,
+        validate: bool = True,
     ):
         self.format = output_format
         self._limit = limit
@@ -61,17 +125,24 @@ class QueryResponse:
         self.resource = query_params.resource
         self._resources = None
         self._included_resources = {}
+        self._raw_resources: List[dict] = []
+        self._raw_included: Dict[str, List[dict]] = {}
         self._bundle = None
         self.status_code: ResponseStatusCodes = None
         self.count = count
+        self.lazy = lazy
+        self.validate_resources = validate
 
         # parse the response after the rest of the setup is complete
         self.response: Union[str, dict] = self._process_server_response(response)
+        if self.format == OutputFormats.JSON:
+            self._index_entries()
 
     @property
     def resources(self) -> List[FHIRAbstractModel]:
         """
-        List of primary resources returned by the server.
+        List of primary resources returned by the server. For lazy responses this is a LazyResourceList that parses
+        the resources on first access.
 
         Returns:
             List of FHIRResourceModel objects returned by the server.
@@ -79,13 +150,9 @@ class QueryResponse:
         """
         if self.format == OutputFormats.XML:
             raise NotImplementedError("Resource parsing not supported for xml format")
-        else:
-            # return empty list if no resource matched the query
-            if not self.response.get("entry"):
-                return []
-            if self._resources is None:
-                self._extract_resources()
-            return self._resources
+        if self._resources is None:
+            self._resources = self._materialize(self._raw_resources)
+        return self._resources
 
     @property
     def included_resources(self) -> List[IncludedResources]:
@@ -98,22 +165,32 @@ class QueryResponse:
         """
         if self.format == OutputFormats.XML:
             raise NotImplementedError("Resource parsing not supported for xml format")
-        else:
-            # return empty list if no resource matched the query
-            if not self.response.get("entry"):
-                return []
-            if not self.query_params.include_parameters:
-                return []
-            # parse the included resources if they don't exist
-            if not self._included_resources:
-                self._extract_resources()
-
-            included = []
-            for resource_type, resources in self._included_resources.items():
-                included.append(
-                    IncludedResources(resource_type=resource_type, resources=resources)
+        if not self.query_params.include_parameters:
+            return []
+
+        included = []
+        for resource_type in self._raw_included:
+            # construct without validation to not materialize lazy resources
+            included.append(
+                IncludedResources.construct(
+                    resource_type=resource_type,
+                    resources=self._included_of_type(resource_type),
                 )
-            return included
+            )
+        return included
+
+    @property
+    def raw_resources(self) -> List[dict]:
+        """
+        The primary resources as the raw dictionaries returned by the server, without parsing them into FHIR models.
+
+        Returns:
+            List of resource dictionaries
+
+        """
+        if self.format == OutputFormats.XML:
+            raise NotImplementedError("Resource parsing not supported for xml format")
+        return self._raw_resources
 
     @property
     def resource_list(self) -> List[FHIRAbstractModel]:
@@ -124,11 +201,34 @@ class QueryResponse:
             List of FHIRResourceModel objects returned by the server.
 
         """
-        resources = self.resources
+        if self.lazy:
+            raw = list(self.raw_resources)
+            for included in self.included_resources:
+                raw.extend(included.resources.raw)
+            return LazyResourceList(raw, validate=self.validate_resources)
+        resources = list(self.resources)
         for included in self.included_resources:
             resources.extend(included.resources)
         return resources
 
+    @property
+    def resource_counts(self) -> Dict[str, int]:
+        """
+        Number of resources per resource type in the response, without parsing the resources.
+        Returns:
+            Dictionary mapping the resource types to the number of resources of this type
+
+        """
+        if self.format == OutputFormats.XML:
+            raise NotImplementedError("Resource parsing not supported for xml format")
+        counts = (
+            {self.resource: len(self._raw_resources)} if self._raw_resources else {}
+        )
+        if self.query_params.include_parameters:
+            for resource_type, resources in self._raw_included.items():
+                counts[resource_type] = len(resources)
+        return counts
+
     @property
     def total(self) -> int:
         """
@@ -137,7 +237,34 @@ class QueryResponse:
             Total number of resources matching the query.
 
         """
-        return len(self.resource_list)
+        return sum(self.resource_counts.values())
+
+    def validate(self, sample: int = None) -> int:
+        """
+        Validate the resources of the response against their FHIR models. Useful for responses created with
+        validation disabled.
+
+        Args:
+            sample: only validate a random sample of this many resources, defaults to validating all resources
+
+        Raises:
+            pydantic.ValidationError: if a resource is not valid
+
+        Returns:
+            The number of validated resources
+        """
+        if self.format == OutputFormats.XML:
+            raise NotImplementedError("Resource parsing not supported for xml format")
+        resources = [
+            entry["resource"]
+            for entry in self.response.get("entry", [])
+            if entry.get("resource")
+        ]
+        if sample is not None and sample < len(resources):
+            resources = random.sample(resources, sample)
+        for resource in resources:
+            parse_resource(resource, validate=True)
+        return len(resources)
 
     def save(
         self, file_path: Union[str, pathlib.Path], output_format: str = "json"
@@ -171,31 +298,51 @@ class QueryResponse:
                 # dump the response as json using orjson and indent 2
                 f.write(orjson.dumps(self.response, option=orjson.OPT_INDENT_2))
 
-    def _extract_resources(self):
+    def _index_entries(self):
         """
-        Parse the resources from the server response bundle. Split into included resources and resources that match the
-        query exactly.
+        Group the entries of the server response bundle by resource type and search mode in a single pass. Splits the
+        raw resources into resources that match the query exactly and included resources per resource type.
         Returns:
 
         """
-        if not self._resources:
-            self._resources = []
-        for entry in Bundle(**self.response).entry:
+        primary = []
+        included = {}
+        for entry in self.response.get("entry") or []:
+            resource = entry.get("resource")
+            if not resource:
+                continue
+            resource_type = resource.get("resourceType")
             # add the directly queried resource to the resources list
-            if entry.resource.resource_type == self.resource:
-                self._resources.append(entry.resource)
-
+            if resource_type == self.resource:
+                primary.append(resource)
             # process included resources
-            elif entry.search.mode == "include":
-                # get list of included resources based on type, if it does not exist yet return empty list
-                included_resources = self._included_resources.get(
-                    entry.resource.resource_type, []
-                )
-                # update the list with the entry and update the included resources dict
-                included_resources.append(entry.resource)
-                self._included_resources[
-                    entry.resource.resource_type
-                ] = included_resources
+            elif entry.get("search", {}).get("mode") == "include":
+                resources = included.get(resource_type)
+                if resources is None:
+                    resources = included[resource_type] = []
+                resources.append(resource)
+
+        self._raw_resources = primary
+        self._raw_included = included
+
+    def _included_of_type(
+        self, resource_type: str
+    ) -> Union[List[FHIRAbstractModel], LazyResourceList]:
+        resources = self._included_resources.get(resource_type)
+        if resources is None:
+            resources = self._materialize(self._raw_included[resource_type])
+            self._included_resources[resource_type] = resources
+        return resources
+
+    def _materialize(
+        self, raw_resources: List[dict]
+    ) -> Union[List[FHIRAbstractModel], LazyResourceList]:
+        if self.lazy:
+            return LazyResourceList(raw_resources, validate=self.validate_resources)
+        return [
+            parse_resource(resource, validate=self.validate_resources)
+            for resource in raw_resources
+        ]
 
     def _process_server_response(
         self, response: Union[httpx.Response, str, dict]
@@ -227,10 +374,12 @@ class QueryResponse:
     def __repr__(self):
         if self.format == OutputFormats.XML:
             return f"<QueryResponse(resource={self.resource}, format=xml)>"
-        if self._included_resources:
-            resources = list(self._included_resources.keys())
+        if self._raw_included and self.query_params.include_parameters:
+            resources = list(self._raw_included.keys())
             return (
                 f"<QueryResponse(resource={self.resource}, format=json, "
                 f"included_resources={resources})>"
             )
-        return f"<QueryResponse(resource={self.resource}, n={len(self.resources)})>"
+        return (
+            f"<QueryResponse(resource={self.resource}, n={len(self._raw_resources)})>"
+        )
@@ -1,10 +1,13 @@
-from typing import Any, Callable, List, Union
+import io
+import pathlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import date, datetime
+from typing import Any, BinaryIO, Callable, Iterator, List, Union
 
 import fhir.resources
 import httpx
 import orjson
-import xmltodict
-from fhir.resources import FHIRAbstractModel
+from fhir.resources import FHIRAbstractModel, construct_fhir_element
 from fhir.resources.fhirresourcemodel import FHIRResourceModel
 
 from fhir_kindling.fhir_query.base import FhirQueryBase
@@ -16,6 +19,8 @@ from fhir_kindling.fhir_query.query_response import (
     QueryResponse,
     ResponseStatusCodes,
 )
+from fhir_kindling.serde.xml import XmlBundlePage, XmlBundleWriter
+from fhir_kindling.util.resource_cache import ResourceCache
 
 
 class FhirQuerySync(FhirQueryBase):
@@ -31,6 +36,7 @@ class FhirQuerySync(FhirQueryBase):
         client: httpx.Client = None,
         output_format: str = "json",
         proxies: Union[str, dict] = None,
+        cache: ResourceCache = None,
     ):
         """Initialize an sync FHIR query object.
 
@@ -43,6 +49,7 @@ class FhirQuerySync(FhirQueryBase):
             output_format: Response format of the query. Defaults to "json".
             client: httpx Client passed from the server. Defaults to None.
             proxies: List of proxies to use. Defaults to None.
+            cache: Resource cache of the server the resources of the result pages are stored in. Defaults to None.
         """
 
         super().__init__(
@@ -52,6 +59,7 @@ class FhirQuerySync(FhirQueryBase):
             auth,
             headers,
             output_format,
+            cache,
         )
         self.proxies = proxies
         self.client = None
@@ -66,6 +74,8 @@ class FhirQuerySync(FhirQueryBase):
             Callable[[List[FHIRAbstractModel]], Any], Callable[[], Any], None
         ] = None,
         count: int = None,
+        parallel: bool = False,
+        max_concurrency: int = 4,
     ) -> QueryResponse:
         """
         Execute the query and return all results matching the query parameters.
@@ -73,6 +83,10 @@ class FhirQuerySync(FhirQueryBase):
         Args:
             page_callback: if this argument is set the given callback function will be called for each page of results
             count: number of results in a page, default value of 50 is used when page_callback is set but no count is
+            parallel: fetch the pages in parallel if the server supports paging by offset (e.g. `_getpagesoffset` or
+                `_offset`), otherwise the pages are resolved one after another. The page callback is called in the
+                order the pages arrive
+            max_concurrency: maximum number of pages fetched at the same time in parallel mode
         Returns:
             QueryResponse object containing all resources matching the query, as well os optional included
             resources.
@@ -80,6 +94,12 @@ class FhirQuerySync(FhirQueryBase):
         """
         self._limit = None
         self._count = count
+        if parallel:
+            return self._execute_parallel_query(
+                page_callback=page_callback,
+                count=count,
+                max_concurrency=max_concurrency,
+            )
         return self._execute_query(page_callback=page_callback, count=count)
 
     def limit(
@@ -106,6 +126,40 @@ class FhirQuerySync(FhirQueryBase):
         self._count = count
         return self._execute_query(page_callback=page_callback, count=count)
 
+    def all_partitioned(
+        self,
+        start: Union[datetime, date, str],
+        end: Union[datetime, date, str] = None,
+        partitions: int = 4,
+        field: str = "_lastUpdated",
+        count: int = None,
+        max_concurrency: int = None,
+    ) -> QueryResponse:
+        """
+        Execute the query as multiple disjoint sub-queries in parallel, each covering a time window of the given date
+        search parameter, and return the de-duplicated results of all sub-queries.
+
+        Args:
+            start: start of the time range to query (inclusive)
+            end: end of the time range to query (exclusive), defaults to the current time
+            partitions: number of sub-queries the time range is split into
+            field: date search parameter used to split the query, defaults to _lastUpdated
+            count: number of results in a page
+            max_concurrency: maximum number of sub-queries executed at the same time, defaults to all partitions
+
+        Returns:
+            QueryResponse object containing all resources matching the query in the time range
+        """
+        self._validate_stream_format()
+        self._limit = None
+        self._count = count
+        queries = self._partition_queries(start, end, partitions, field)
+        with ThreadPoolExecutor(
+            max_workers=max_concurrency or len(queries)
+        ) as executor:
+            responses = list(executor.map(lambda q: q.all(count=count), queries))
+        return self._merge_partitions(responses, count)
+
     def first(self) -> QueryResponse:
         """
         Return the first resource matching the query parameters.
@@ -122,11 +176,77 @@ class FhirQuerySync(FhirQueryBase):
         response.raise_for_status()
         return response.json()["total"]
 
+    def iter_pages(self, limit: int = None, count: int = None) -> Iterator[List[dict]]:
+        """
+        Execute the query and yield the entries of each page of results as soon as the page is received. Only the
+        current page is kept in memory, which allows processing large result sets.
+
+        Args:
+            limit: maximum number of entries to return over all pages
+            count: number of results in a page
+
+        Returns:
+            Iterator over the lists of bundle entries of each page
+        """
+        self._validate_stream_format()
+        self._limit = limit
+        self._count = count
+        r = self.client.get(self.query_url)
+        r.raise_for_status()
+        for page in self._iter_json_pages(orjson.loads(r.content)):
+            yield page.get("entry", [])
+
+    def iter_resources(
+        self, limit: int = None, count: int = None
+    ) -> Iterator[FHIRAbstractModel]:
+        """
+        Execute the query and yield the resources (including included resources) one page at a time.
+
+        Args:
+            limit: maximum number of resources to return
+            count: number of results in a page
+
+        Returns:
+            Iterator over the resources matching the query
+        """
+        for entries in self.iter_pages(limit=limit, count=count):
+            for entry in entries:
+                resource = entry.get("resource")
+                if resource:
+                    yield construct_fhir_element(resource["resourceType"], resource)
+
+    def write_xml(
+        self,
+        file: Union[str, pathlib.Path, BinaryIO],
+        limit: int = None,
+        count: int = None,
+    ) -> int:
+        """
+        Execute the query and write the results of all pages as a single xml bundle to a file. The entries of each
+        page are copied to the file as soon as the page is received, so only a single page is kept in memory.
+
+        Args:
+            file: path of the file or binary file object to write the bundle to
+            limit: maximum number of entries to write
+            count: number of results in a page
+
+        Returns:
+            Number of entries written to the file
+        """
+        self._validate_xml_format()
+        self._limit = limit
+        self._count = count
+        r = self.client.get(self.query_url)
+        r.raise_for_status()
+        with self._xml_output(file) as f:
+            return self._write_xml_pages(r.content, f)
+
     def _setup_client(self):
         if self.client:
             return self.client
         headers = self.headers if self.headers else {}
         headers["Content-Type"] = "application/fhir+json"
+        headers.setdefault("Accept-Encoding", "gzip, deflate")
         client = httpx.Client(
             auth=self.auth, headers=headers, proxies=self.proxies, timeout=None
         )
@@ -145,6 +265,54 @@ class FhirQuerySync(FhirQueryBase):
         response = self._resolve_response_pagination(r, page_callback, count)
         return response
 
+    def _execute_parallel_query(
+        self,
+        page_callback: Union[
+            Callable[[List[FHIRAbstractModel]], Any], Callable[[], Any], None
+        ] = None,
+        count: int = None,
+        max_concurrency: int = 4,
+    ) -> QueryResponse:
+        self._validate_stream_format()
+        if max_concurrency < 1:
+            raise ValueError(
+                f"max_concurrency must be at least 1, given {max_concurrency}"
+            )
+        total = self.count()
+        self._count = count
+
+        r = self.client.get(self.query_url)
+        r.raise_for_status()
+        first_page = orjson.loads(r.content)
+        page_urls = self._offset_page_urls(first_page, total)
+        # fall back to following the next links if the server does not page by offset
+        if page_urls is None:
+            return self._resolve_response_pagination(r, page_callback, count)
+
+        self._execute_callback(first_page.get("entry", []), page_callback)
+        pages = [first_page] + [None] * len(page_urls)
+        with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+            futures = {
+                executor.submit(self._fetch_page, url): index
+                for index, url in enumerate(page_urls, start=1)
+            }
+            try:
+                # the callback is called as soon as a page arrives, the pages are merged in order
+                for future in as_completed(futures):
+                    page = future.result()
+                    pages[futures[future]] = page
+                    self._execute_callback(page.get("entry", []), page_callback)
+            finally:
+                # pages that are not fetched yet are not requested after an error
+                for future in futures:
+                    future.cancel()
+        return self._merge_pages(pages, count)
+
+    def _fetch_page(self, url: str) -> dict:
+        r = self.client.get(url)
+        r.raise_for_status()
+        return orjson.loads(r.content)
+
     def _resolve_response_pagination(
         self,
         initial_response: httpx.Response,
@@ -161,13 +329,7 @@ class FhirQuerySync(FhirQueryBase):
         else:
             response = self._resolve_xml_pagination(initial_response)
 
-        return QueryResponse(
-            response=response,
-            query_params=self.query_parameters,
-            count=count,
-            limit=self._limit,
-            output_format=self.output_format,
-        )
+        return self._make_response(response, count)
 
     def _resolve_json_pagination(
         self,
@@ -183,94 +345,82 @@ class FhirQuerySync(FhirQueryBase):
 
         if not link:
             self.status_code = ResponseStatusCodes.OK
+            self._cache_page(response_json)
             return response_json
-        else:
-            entries = []
-            initial_entry = response_json.get("entry", None)
-            if not initial_entry:
-                self.status_code = ResponseStatusCodes.NOT_FOUND
-                return response_json
-            else:
-                self.status_code = ResponseStatusCodes.OK
-                response_entries = response_json["entry"]
-                entries.extend(response_entries)
-                self._execute_callback(response_entries, page_callback)
-            # if the limit is reached, stop resolving the pagination
-            if self._limit and len(entries) >= self._limit:
-                response_entries = response_json["entry"][: self._limit]
-                response_json["entry"] = response_entries
-                self._execute_callback(response_entries, page_callback)
-                return response_json
-            # query the linked page and add the entries to the response
-
-            while response_json.get("link", None):
-                if self._limit and len(entries) >= self._limit:
-                    break
-                next_page = next(
-                    (
-                        link
-                        for link in response_json["link"]
-                        if link.get("relation", None) == "next"
-                    ),
-                    None,
-                )
-                if next_page:
-                    response_json = self.client.get(next_page["url"]).json()
-                    response_entries = response_json["entry"]
-                    entries.extend(response_entries)
-                    self._execute_callback(response_entries, page_callback)
-                else:
-                    break
-
-            response_json["entry"] = entries[: self._limit] if self._limit else entries
+        if not response_json.get("entry", None):
+            self.status_code = ResponseStatusCodes.NOT_FOUND
             return response_json
 
+        self.status_code = ResponseStatusCodes.OK
+        # collect the entries of all linked pages into the initial response
+        entries = []
+        for page in self._iter_json_pages(response_json):
+            response_entries = page.get("entry", [])
+            entries.extend(response_entries)
+            self._execute_callback(response_entries, page_callback)
+
+        response_json["entry"] = entries
+        return response_json
+
+    def _iter_json_pages(self, page: dict) -> Iterator[dict]:
+        """
+        Follow the next links starting from the given page and yield the pages one after another, the entries of the
+        pages are truncated once the limit of the query is reached.
+
+        Args:
+            page: the first page of the query results
+
+        Returns:
+            Iterator over the pages of the query results
+        """
+        n_entries = 0
+        while True:
+            if self._limit and page.get("entry"):
+                page["entry"] = page["entry"][: self._limit - n_entries]
+            n_entries += len(page.get("entry", []))
+            next_url = self._next_page_url(page)
+            self._cache_page(page)
+            yield page
+
+            if not next_url or (self._limit and n_entries >= self._limit):
+                break
+            r = self.client.get(next_url)
+            r.raise_for_status()
+            page = orjson.loads(r.content)
+
     def _resolve_xml_pagination(self, server_response: httpx.Response) -> str:
-        # parse the xml response and extract the initial entries
-        initial_response = xmltodict.parse(server_response.text)
-        entries = initial_response["Bundle"].get("entry")
+        buffer = io.BytesIO()
+        n_entries = self._write_xml_pages(server_response.content, buffer)
 
         # if there are no entries, return the initial response
-        if not entries:
+        if not n_entries:
             self.status_code = ResponseStatusCodes.NOT_FOUND
             print(
                 f"No resources match the query - query url: {self.query_parameters.to_query_string()}"
             )
             return server_response.text
-        else:
-            self.status_code = ResponseStatusCodes.OK
-        response = initial_response
-        # resolve the pagination
-        while True:
-            next_page = False
-            for link in response["Bundle"]["link"]:
-                # if there is a next page, get the next page
-                if not isinstance(link, dict):
-                    break
-                relation_dict = link.get("relation", None)
-
-                if relation_dict.get("@value") == "next":
-                    # get url and extend with xml format
-                    url = link["url"]["@value"]
-                    url = url + "&_format=xml"
-                    r = self.client.get(url)
-                    r.raise_for_status()
-                    response = xmltodict.parse(r.text)
-                    if not response["Bundle"].get("entry", None):
-                        break
-                    added_entries = response["Bundle"]["entry"]
-                    entries.extend(added_entries)
-                    # Stop resolving the pagination when the limit is reached
-                    if self._limit:
-                        next_page = len(entries) < self._limit
-                    else:
-                        next_page = True
-
-            if not next_page:
-                break
-        # added the paginated resources to the initial response
-        initial_response["Bundle"]["entry"] = (
-            entries[: self._limit] if self._limit else entries
-        )
-        full_response_xml = xmltodict.unparse(initial_response, pretty=True)
-        return full_response_xml
+        self.status_code = ResponseStatusCodes.OK
+        return buffer.getvalue().decode("utf-8")
+
+    def _write_xml_pages(self, content: bytes, file: BinaryIO) -> int:
+        """
+        Follow the next links starting from the given xml page and copy the entries of all pages into a single bundle
+        written to the given file. Only the positions of the entries in each page are parsed, the entries themselves
+        are copied as is.
+
+        Args:
+            content: content of the first page of the query results
+            file: binary file object to write the bundle to
+
+        Returns:
+            Number of entries written
+        """
+        writer = XmlBundleWriter(file, limit=self._limit)
+        page = XmlBundlePage(content)
+        while writer.write_page(page) and page.next_url:
+            # get url and extend with xml format
+            r = self.client.get(page.next_url + "&_format=xml")
+            r.raise_for_status()
+            page = XmlBundlePage(r.content)
+        writer.close()
+        return writer.n_entries
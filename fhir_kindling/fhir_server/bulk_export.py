@@ -0,0 +1,372 @@
+from __future__ import annotations
+
+import pathlib
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import date, datetime
+from typing import TYPE_CHECKING, Dict, Iterator, List, Union
+
+import httpx
+import orjson
+from fhir.resources import FHIRAbstractModel
+from tqdm import tqdm
+
+from fhir_kindling.fhir_query.query_response import parse_resource
+from fhir_kindling.fhir_server.server_responses import (
+    BulkExportFile,
+    BulkExportResponse,
+)
+from fhir_kindling.util.date_utils import retry_after_seconds, to_search_string
+
+if TYPE_CHECKING:
+    from fhir_kindling.fhir_server import FhirServer
+
+NDJSON_FORMAT = "application/fhir+ndjson"
+
+
+class BulkExportError(Exception):
+    """
+    Raised when the server rejects or fails a bulk data export.
+    """
+
+
+def bulk_export(
+    server: "FhirServer",
+    output_dir: Union[str, pathlib.Path],
+    resource_types: List[str] = None,
+    since: Union[datetime, date, str] = None,
+    type_filters: List[str] = None,
+    group: str = None,
+    patient: bool = False,
+    max_concurrency: int = 4,
+    poll_interval: float = 2.0,
+    timeout: float = None,
+    display: bool = True,
+) -> BulkExportResponse:
+    """
+    Run a bulk data export and download the NDJSON output files of the export in parallel. The files are streamed to
+    disk, so only a chunk of each file is kept in memory.
+
+    Args:
+        server: the server to export the resources from
+        output_dir: directory to write the output files to
+        resource_types: resource types to export, defaults to all resources
+        since: only export resources updated after this time
+        type_filters: search queries to filter the exported resources e.g. `MedicationRequest?status=active`
+        group: id of a group to export the resources of the group members ($export on the group)
+        patient: export the resources of all patients ($export on Patient)
+        max_concurrency: maximum number of files downloaded at the same time
+        poll_interval: seconds between polling the status of the export if the server does not send Retry-After
+        timeout: maximum time in seconds to wait for the export to complete, None to wait indefinitely
+        display: whether to display a progress bar
+
+    Returns:
+        BulkExportResponse with the downloaded output and error files
+    """
+    if max_concurrency < 1:
+        raise ValueError(f"max_concurrency must be at least 1, given {max_concurrency}")
+    manifest = export_manifest(
+        server,
+        resource_types,
+        since,
+        type_filters,
+        group,
+        patient,
+        poll_interval,
+        timeout,
+        display,
+    )
+    output_dir = pathlib.Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    outputs = manifest.get("output", [])
+    errors = manifest.get("error", [])
+    paths = _output_paths(output_dir, outputs) + _output_paths(
+        output_dir, errors, prefix="error-"
+    )
+
+    with download_client(server, manifest) as client, tqdm(
+        total=len(paths), disable=not display
+    ) as p_bar:
+
+        def download(index: int, output: dict) -> BulkExportFile:
+            return download_ndjson(server, output, paths[index], client)
+
+        p_bar.set_description(f"Downloading {len(paths)} files")
+        files = server._map_threaded(download, outputs + errors, max_concurrency, p_bar)
+    return BulkExportResponse(
+        manifest, files=files[: len(outputs)], errors=files[len(outputs) :]
+    )
+
+
+def iter_bulk_export(
+    server: "FhirServer",
+    resource_types: List[str] = None,
+    since: Union[datetime, date, str] = None,
+    type_filters: List[str] = None,
+    group: str = None,
+    patient: bool = False,
+    max_concurrency: int = 4,
+    buffer_size: int = 1000,
+    validate: bool = True,
+    poll_interval: float = 2.0,
+    timeout: float = None,
+) -> Iterator[FHIRAbstractModel]:
+    """
+    Run a bulk data export and yield the exported resources while the output files are downloaded in parallel.
+    Memory use is bounded by the buffer size, downloads pause while the buffer is full.
+
+    Args:
+        server: the server to export the resources from
+        resource_types: resource types to export, defaults to all resources
+        since: only export resources updated after this time
+        type_filters: search queries to filter the exported resources e.g. `MedicationRequest?status=active`
+        group: id of a group to export the resources of the group members ($export on the group)
+        patient: export the resources of all patients ($export on Patient)
+        max_concurrency: maximum number of files downloaded at the same time
+        buffer_size: maximum number of downloaded resources waiting to be yielded
+        validate: whether to validate the resources against their model
+        poll_interval: seconds between polling the status of the export if the server does not send Retry-After
+        timeout: maximum time in seconds to wait for the export to complete, None to wait indefinitely
+
+    Returns:
+        Iterator over the exported resources, the order of resources from different files is not defined
+    """
+    if max_concurrency < 1:
+        raise ValueError(f"max_concurrency must be at least 1, given {max_concurrency}")
+    manifest = export_manifest(
+        server,
+        resource_types,
+        since,
+        type_filters,
+        group,
+        patient,
+        poll_interval,
+        timeout,
+        display=False,
+    )
+    with download_client(server, manifest) as client:
+        for line in _iter_ndjson_lines(
+            client, manifest.get("output", []), max_concurrency, buffer_size
+        ):
+            yield parse_resource(orjson.loads(line), validate=validate)
+
+
+def export_manifest(
+    server: "FhirServer",
+    resource_types: List[str] = None,
+    since: Union[datetime, date, str] = None,
+    type_filters: List[str] = None,
+    group: str = None,
+    patient: bool = False,
+    poll_interval: float = 2.0,
+    timeout: float = None,
+    display: bool = True,
+) -> dict:
+    """
+    Kick off a bulk data export and poll its status until the export is complete.
+
+    Returns:
+        the manifest of the completed export listing the output and error files
+    """
+    if group and patient:
+        raise ValueError("Only one of group and patient can be exported")
+    if group:
+        endpoint = f"Group/{group}/$export"
+    elif patient:
+        endpoint = "Patient/$export"
+    else:
+        endpoint = "$export"
+
+    params = {"_outputFormat": NDJSON_FORMAT}
+    if resource_types:
+        params["_type"] = ",".join(resource_types)
+    if since:
+        params["_since"] = to_search_string(since)
+    if type_filters:
+        params["_typeFilter"] = type_filters
+
+    client = server._sync_client()
+    r = client.get(
+        f"{server.api_address}/{endpoint}",
+        params=params,
+        headers={"Accept": "application/fhir+json", "Prefer": "respond-async"},
+    )
+    if r.status_code != 202:
+        raise BulkExportError(
+            f"Bulk export was not accepted by the server ({r.status_code}): {r.text}"
+        )
+    status_url = r.headers.get("Content-Location")
+    if not status_url:
+        raise BulkExportError("Server did not return a Content-Location to poll")
+    return _poll_export_status(client, status_url, poll_interval, timeout, display)
+
+
+def _poll_export_status(
+    client: httpx.Client,
+    status_url: str,
+    poll_interval: float,
+    timeout: Union[float, None],
+    display: bool,
+) -> dict:
+    deadline = time.monotonic() + timeout if timeout is not None else None
+    with tqdm(total=None, disable=not display) as p_bar:
+        while True:
+            r = client.get(status_url, headers={"Accept": "application/json"})
+            if r.status_code == 200:
+                return r.json()
+            if r.status_code != 202:
+                raise BulkExportError(f"Bulk export failed ({r.status_code}): {r.text}")
+            p_bar.set_description(
+                f"Waiting for export: {r.headers.get('X-Progress', 'in progress')}"
+            )
+            wait = retry_after_seconds(r.headers)
+            if wait is None:
+                wait = poll_interval
+            if deadline is not None and time.monotonic() + wait > deadline:
+                # ask the server to cancel the export and free its resources
+                client.delete(status_url)
+                raise TimeoutError(f"Bulk export did not complete within {timeout}s")
+            time.sleep(wait)
+
+
+@contextmanager
+def download_client(server: "FhirServer", manifest: dict) -> Iterator[httpx.Client]:
+    """
+    Client to download the output files of an export. Files of manifests with `requiresAccessToken` set to false
+    are downloaded without the headers and authentication of the server, e.g. from presigned urls of a storage
+    service that rejects unexpected credentials.
+
+    Args:
+        server: the server the export was run on
+        manifest: the manifest of the completed export
+    """
+    if manifest.get("requiresAccessToken", True):
+        yield server._sync_client()
+        return
+    with httpx.Client(proxies=server._proxies, timeout=server._timeout) as client:
+        yield client
+
+
+def download_ndjson(
+    server: "FhirServer",
+    output: dict,
+    path: pathlib.Path,
+    client: httpx.Client = None,
+) -> BulkExportFile:
+    """
+    Stream an NDJSON output file of an export to disk.
+
+    Args:
+        server: the server the export was run on
+        output: the entry of the file in the manifest of the export
+        path: path to write the file to
+        client: client to download the file with, see `download_client`. Defaults to the client of the server
+
+    Returns:
+        BulkExportFile with the path, size and number of resources of the file
+    """
+    count = 0
+    size = 0
+    last_byte = b"\n"
+    client = client if client is not None else server._sync_client()
+    with client.stream("GET", output["url"], headers={"Accept": NDJSON_FORMAT}) as r:
+        r.raise_for_status()
+        with open(path, "wb") as f:
+            for chunk in r.iter_bytes():
+                if not chunk:
+                    continue
+                f.write(chunk)
+                size += len(chunk)
+                count += chunk.count(b"\n")
+                last_byte = chunk[-1:]
+    # the last line does not need to end with a line break
+    if last_byte != b"\n":
+        count += 1
+    return BulkExportFile(
+        resource_type=output.get("type"),
+        url=output["url"],
+        path=path,
+        count=count,
+        size=size,
+    )
+
+
+def _output_paths(
+    output_dir: pathlib.Path, outputs: List[dict], prefix: str = ""
+) -> List[pathlib.Path]:
+    # number the files of each resource type e.g. Patient-0.ndjson, Patient-1.ndjson
+    counters: Dict[str, int] = {}
+    paths = []
+    for output in outputs:
+        resource_type = output.get("type", "output")
+        index = counters.get(resource_type, 0)
+        counters[resource_type] = index + 1
+        paths.append(output_dir / f"{prefix}{resource_type}-{index}.ndjson")
+    return paths
+
+
+class _LineBuffer:
+    """
+    Bounded buffer for the lines of NDJSON files downloaded by multiple threads. Downloads block while the buffer is
+    full and stop once the consumer stopped reading.
+    """
+
+    DONE = object()
+
+    def __init__(self, size: int):
+        self.lines = queue.Queue(maxsize=size)
+        self.stopped = threading.Event()
+
+    def put(self, item) -> bool:
+        while not self.stopped.is_set():
+            try:
+                self.lines.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def download(self, client: httpx.Client, output: dict) -> None:
+        try:
+            if self.stopped.is_set():
+                return
+            with client.stream(
+                "GET", output["url"], headers={"Accept": NDJSON_FORMAT}
+            ) as r:
+                r.raise_for_status()
+                for line in r.iter_lines():
+                    if line.strip() and not self.put(line):
+                        return
+        except Exception as e:
+            self.put(e)
+        finally:
+            self.put(self.DONE)
+
+    def iter_lines(self, n_files: int) -> Iterator[str]:
+        remaining = n_files
+        while remaining:
+            item = self.lines.get()
+            if item is self.DONE:
+                remaining -= 1
+            elif isinstance(item, Exception):
+                raise item
+            else:
+                yield item
+
+
+def _iter_ndjson_lines(
+    client: httpx.Client, outputs: List[dict], max_concurrency: int, buffer_size: int
+) -> Iterator[str]:
+    buffer = _LineBuffer(buffer_size)
+    with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        for output in outputs:
+            executor.submit(buffer.download, client, output)
+        try:
+            yield from buffer.iter_lines(len(outputs))
+        finally:
+            # stop the downloads that are still running when the iterator is closed early or fails
+            buffer.stopped.set()
@@ -0,0 +1,288 @@
+from __future__ import annotations
+
+import glob
+import gzip
+import pathlib
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import TYPE_CHECKING, Iterable, Iterator, List, Optional, Set, Tuple, Union
+
+import orjson
+from fhir.resources import construct_fhir_element
+from tqdm import tqdm
+
+from fhir_kindling.fhir_server.bundle_upload import raise_for_bundle_status
+from fhir_kindling.fhir_server.server_responses import (
+    BatchUploadFailure,
+    BulkLoadResponse,
+)
+from fhir_kindling.fhir_server.transactions import TransactionMethod, TransactionType
+from fhir_kindling.fhir_server.upload_journal import (
+    UploadJournal,
+    batch_fingerprint,
+    open_journal,
+)
+from fhir_kindling.serde.json import json_bytes
+
+if TYPE_CHECKING:
+    from fhir_kindling.fhir_server import FhirServer
+
+
+def load_ndjson(
+    server: "FhirServer",
+    path_or_glob: Union[str, pathlib.Path, Iterable[Union[str, pathlib.Path]]],
+    batch_size: int = 1000,
+    max_concurrency: int = 4,
+    method: Union[TransactionMethod, str] = None,
+    validate: bool = False,
+    fail_fast: bool = True,
+    display: bool = True,
+    journal: Union[str, pathlib.Path, UploadJournal] = None,
+) -> BulkLoadResponse:
+    """
+    Upload the resources of NDJSON files to the server. The files are read line by line and the resources are
+    uploaded in transaction bundles of batch_size resources as soon as a batch is complete, with at most
+    max_concurrency bundles being uploaded at the same time. Memory use is bounded by the batch size times the
+    concurrency, independent of the size of the files.
+
+    Args:
+        server: the server to upload the resources to
+        path_or_glob: path of an NDJSON file, a glob pattern e.g. `export/*.ndjson` or a list of paths. Files ending in
+            .gz are decompressed on the fly.
+        batch_size: number of resources in each transaction bundle
+        max_concurrency: maximum number of bundles uploaded at the same time
+        method: transaction method of the entries, by default resources with an id are created or updated with PUT to
+            keep their ids and the references between them valid, resources without an id are created with POST
+        validate: whether to validate the resources against their model before uploading them
+        fail_fast: if True the first failing batch stops the upload and raises the error, otherwise failed batches are
+            collected in the `failed_batches` of the response
+        display: whether to display a progress bar
+        journal: path of an upload journal or UploadJournal that records the completed batches, batches that are
+            already recorded in the journal are skipped, so an interrupted load can be resumed
+
+    Returns:
+        BulkLoadResponse with the number of uploaded resources and the throughput of the upload
+    """
+    if max_concurrency < 1:
+        raise ValueError(f"max_concurrency must be at least 1, given {max_concurrency}")
+    if batch_size < 1:
+        raise ValueError(f"batch_size must be at least 1, given {batch_size}")
+    if method is not None:
+        method = TransactionMethod(method)
+    files = ndjson_files(path_or_glob)
+    response = BulkLoadResponse(files=files)
+    start = time.monotonic()
+
+    with open_journal(journal) as upload_journal, ThreadPoolExecutor(
+        max_workers=max_concurrency
+    ) as executor, tqdm(unit=" resources", disable=not display) as p_bar:
+        in_flight: Set[Future] = set()
+        batches = iter_ndjson_batches(files, batch_size, validate, method)
+        for index, batch in enumerate(batches):
+            completed, fingerprint = _journal_lookup(upload_journal, index, batch)
+            if completed:
+                response.skipped_batches += 1
+                continue
+            # wait for a free slot before reading the next batch, so at most max_concurrency batches are held
+            if len(in_flight) >= max_concurrency:
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                _collect_batches(done, response, p_bar)
+            in_flight.add(
+                executor.submit(
+                    _upload_batch,
+                    server,
+                    index,
+                    batch,
+                    method,
+                    fail_fast,
+                    upload_journal,
+                    fingerprint,
+                )
+            )
+        _collect_batches(wait(in_flight).done, response, p_bar)
+
+    response.elapsed = time.monotonic() - start
+    return response
+
+
+def ndjson_files(
+    path_or_glob: Union[str, pathlib.Path, Iterable[Union[str, pathlib.Path]]]
+) -> List[pathlib.Path]:
+    """
+    Resolve a path, glob pattern or list of paths to the list of NDJSON files to read.
+    """
+    if isinstance(path_or_glob, (str, pathlib.Path)):
+        pattern = str(path_or_glob)
+        if glob.has_magic(pattern):
+            files = [pathlib.Path(p) for p in sorted(glob.glob(pattern))]
+        else:
+            files = [pathlib.Path(pattern)]
+    else:
+        files = [pathlib.Path(p) for p in path_or_glob]
+    if not files:
+        raise ValueError(f"No files found matching {path_or_glob}")
+    for file in files:
+        if not file.is_file():
+            raise FileNotFoundError(f"NDJSON file {file} does not exist")
+    return files
+
+
+def iter_ndjson_batches(
+    files: List[pathlib.Path],
+    batch_size: int,
+    validate: bool = False,
+    method: Union[TransactionMethod, None] = None,
+) -> Iterator[List[dict]]:
+    """
+    Read the resources of NDJSON files line by line and yield them in batches of batch_size resources.
+
+    Args:
+        files: the NDJSON files to read
+        batch_size: number of resources in a batch
+        validate: whether to validate the resources against their model
+        method: transaction method the resources are uploaded with, resources uploaded with PUT need an id
+
+    Returns:
+        Iterator over the batches of resources as json dictionaries
+    """
+    batch = []
+    for file in files:
+        with _open_ndjson(file) as f:
+            for line_number, line in enumerate(f, start=1):
+                if not line.strip():
+                    continue
+                try:
+                    resource = orjson.loads(line)
+                    if validate:
+                        construct_fhir_element(resource.get("resourceType"), resource)
+                except Exception as e:
+                    raise ValueError(
+                        f"Invalid resource in line {line_number} of {file}: {e}"
+                    )
+                if method == TransactionMethod.PUT and not resource.get("id"):
+                    raise ValueError(
+                        f"Resource in line {line_number} of {file} has no id, which is required to upload it with PUT"
+                    )
+                batch.append(resource)
+                if len(batch) >= batch_size:
+                    yield batch
+                    batch = []
+    if batch:
+        yield batch
+
+
+def ndjson_bundle(
+    resources: List[dict], method: Union[TransactionMethod, None] = None
+) -> dict:
+    """
+    Build a transaction bundle from raw resource dictionaries, without creating models of the resources.
+
+    Args:
+        resources: the resources to add to the bundle
+        method: transaction method of the entries, by default PUT for resources with an id and POST otherwise
+
+    Returns:
+        the transaction bundle as json dictionary
+    """
+    entries = []
+    for resource in resources:
+        entry_method = method
+        if entry_method is None:
+            entry_method = (
+                TransactionMethod.PUT if resource.get("id") else TransactionMethod.POST
+            )
+        if entry_method == TransactionMethod.PUT:
+            if not resource.get("id"):
+                raise ValueError(
+                    f"Resource {resource.get('resourceType')} has no id, which is required to upload it with PUT"
+                )
+            url = f"{resource['resourceType']}/{resource['id']}"
+        else:
+            url = resource["resourceType"]
+        entries.append(
+            {
+                "resource": resource,
+                "request": {"method": entry_method.value, "url": url},
+            }
+        )
+    return {
+        "resourceType": "Bundle",
+        "type": TransactionType.TRANSACTION.value,
+        "entry": entries,
+    }
+
+
+def upload_ndjson_batch(
+    server: "FhirServer",
+    resources: List[dict],
+    method: Union[TransactionMethod, None] = None,
+) -> List[str]:
+    """
+    Upload a batch of resources in a single transaction bundle.
+
+    Returns:
+        references {ResourceType}/{id} of the created or updated resources
+    """
+    bundle = ndjson_bundle(resources, method)
+    r = server._sync_client().post(
+        server.api_address, content=json_bytes(json_dict=bundle)
+    )
+    raise_for_bundle_status(r)
+    references = []
+    for entry in r.json().get("entry", []):
+        location = entry.get("response", {}).get("location", "")
+        # locations are of the form {ResourceType}/{id}/_history/{version}, optionally with the base url
+        location = location.replace(server.api_address, "").strip("/")
+        references.append("/".join(location.split("/")[:2]))
+    # resources updated with PUT may be cached from earlier reads
+    server._invalidate_cached(references)
+    return references
+
+
+def _open_ndjson(file: pathlib.Path):
+    if file.suffix == ".gz":
+        return gzip.open(file, "rb")
+    return open(file, "rb")
+
+
+def _upload_batch(
+    server: "FhirServer",
+    index: int,
+    batch: List[dict],
+    method: Optional[TransactionMethod],
+    fail_fast: bool,
+    journal: Optional[UploadJournal],
+    fingerprint: Optional[str],
+) -> Union[int, BatchUploadFailure]:
+    try:
+        references = upload_ndjson_batch(server, batch, method)
+    except Exception as e:
+        if fail_fast:
+            raise e
+        return BatchUploadFailure(index, batch, e)
+    if journal is not None:
+        journal.record(index, fingerprint, references)
+    return len(batch)
+
+
+def _journal_lookup(
+    journal: Optional[UploadJournal], index: int, batch: List[dict]
+) -> Tuple[bool, Optional[str]]:
+    # the fingerprint includes the ids, as resources with an id keep it on the server
+    if journal is None:
+        return False, None
+    fingerprint = batch_fingerprint(batch)
+    return journal.completed(index, fingerprint) is not None, fingerprint
+
+
+def _collect_batches(
+    done: Set[Future], response: BulkLoadResponse, p_bar: tqdm
+) -> None:
+    for future in done:
+        result = future.result()
+        response.n_batches += 1
+        if isinstance(result, BatchUploadFailure):
+            response.failed_batches.append(result)
+            continue
+        response.n_resources += result
+        p_bar.update(result)
@@ -0,0 +1,413 @@
+from __future__ import annotations
+
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple
+
+import httpx
+import orjson
+from fhir.resources.bundle import Bundle
+
+from fhir_kindling.fhir_server.server_responses import (
+    BundleCreateResponse,
+    EntryUploadFailure,
+    ResourceCreateResponse,
+    outcome_diagnostics,
+)
+from fhir_kindling.fhir_server.transactions import (
+    TransactionMethod,
+    TransactionType,
+    make_transaction_bundle,
+)
+from fhir_kindling.serde.json import json_bytes
+
+if TYPE_CHECKING:
+    from fhir_kindling.fhir_server import FhirServer
+
+# entry statuses that may succeed when the entry is sent again
+RETRYABLE_ENTRY_STATUS_CODES = frozenset([408, 409, 429, 500, 502, 503, 504])
+# errors that are not caused by the content of a bundle, splitting the bundle would not help. Server errors (5xx)
+# are not bisected either, a temporarily unavailable server would otherwise reject every half of the bundle
+NOT_BISECTED_STATUS_CODES = frozenset([401, 403, 404, 405, 407, 408, 413, 429])
+
+
+class BundleUploadError(httpx.HTTPStatusError):
+    """
+    Raised when the server rejects a bundle, with the OperationOutcome returned by the server.
+    """
+
+    outcome: Optional[dict]
+
+    def __init__(self, response: httpx.Response):
+        self.outcome = response_outcome(response)
+        details = outcome_diagnostics(self.outcome) or response.text[:1000]
+        super().__init__(
+            f"Uploading the bundle failed with status {response.status_code}: {details}",
+            request=response.request,
+            response=response,
+        )
+
+
+def raise_for_bundle_status(response: httpx.Response) -> None:
+    """
+    Raise a BundleUploadError if the upload of a bundle failed.
+    """
+    if response.is_error:
+        raise BundleUploadError(response)
+
+
+def response_outcome(response: httpx.Response) -> Optional[dict]:
+    """
+    The OperationOutcome in the body of an error response, None if the body is not an OperationOutcome.
+    """
+    try:
+        content = orjson.loads(response.content)
+    except orjson.JSONDecodeError:
+        return None
+    if isinstance(content, dict) and content.get("resourceType") == "OperationOutcome":
+        return content
+    return None
+
+
+def entry_status(entry_response: dict) -> int:
+    """
+    The status code of the response of a bundle entry e.g. 201 for "201 Created".
+    """
+    status = str(entry_response.get("status", "")).strip()
+    try:
+        return int(status.split(" ")[0])
+    except ValueError:
+        return 0
+
+
+def entry_outcome(entry: dict) -> Optional[dict]:
+    """
+    The OperationOutcome of a bundle response entry, servers return it in the response or as resource of the entry.
+    """
+    outcome = (entry.get("response") or {}).get("outcome")
+    if outcome is None:
+        resource = entry.get("resource") or {}
+        if resource.get("resourceType") == "OperationOutcome":
+            outcome = resource
+    return outcome
+
+
+def upload_resources(
+    server: "FhirServer",
+    resources: list,
+    batch_index: int = 0,
+    transaction_type: TransactionType = TransactionType.TRANSACTION,
+    bisect: bool = False,
+    entry_retries: int = 1,
+    previous: BundleCreateResponse = None,
+) -> BundleCreateResponse:
+    """
+    Create a batch of resources on the server with a single bundle.
+
+    Args:
+        server: the server to upload the resources to
+        resources: the resources to create
+        batch_index: index of the batch in the upload, used to report failed entries
+        transaction_type: upload the resources in a transaction bundle that fails as a whole if any resource is
+            rejected, or in a batch bundle that creates all valid resources
+        bisect: split failing transaction bundles in halves until the rejected resources are found
+        entry_retries: number of times the failed entries of a batch bundle are sent again, only entries that
+            failed with a temporary error e.g. 409 Conflict or 503 are retried
+        previous: response of an earlier upload of the batch e.g. from the upload journal, only its entries that
+            failed with a temporary error are uploaded
+
+    Returns:
+        BundleCreateResponse with the created resources and the rejected entries
+    """
+    if previous is not None:
+        pending = retryable_entries(previous)
+        retried = upload_resources(
+            server,
+            [resources[i] for i in pending],
+            batch_index,
+            transaction_type,
+            bisect,
+            entry_retries,
+        )
+        return merge_retried_entries(previous, pending, retried)
+    if transaction_type == TransactionType.BATCH:
+        return upload_batch_bundle(server, resources, batch_index, entry_retries)
+    if bisect:
+        return upload_bisecting(server, resources, batch_index)
+    bundle = make_transaction_bundle(method=TransactionMethod.POST, resources=resources)
+    return server._upload_bundle(bundle)
+
+
+async def upload_resources_async(
+    server: "FhirServer",
+    resources: list,
+    batch_index: int = 0,
+    transaction_type: TransactionType = TransactionType.TRANSACTION,
+    bisect: bool = False,
+    entry_retries: int = 1,
+    previous: BundleCreateResponse = None,
+) -> BundleCreateResponse:
+    """
+    Asynchronously create a batch of resources on the server with a single bundle, see `upload_resources`.
+    """
+    if previous is not None:
+        pending = retryable_entries(previous)
+        retried = await upload_resources_async(
+            server,
+            [resources[i] for i in pending],
+            batch_index,
+            transaction_type,
+            bisect,
+            entry_retries,
+        )
+        return merge_retried_entries(previous, pending, retried)
+    if transaction_type == TransactionType.BATCH:
+        return await upload_batch_bundle_async(
+            server, resources, batch_index, entry_retries
+        )
+    if bisect:
+        return await upload_bisecting_async(server, resources, batch_index)
+    bundle = make_transaction_bundle(method=TransactionMethod.POST, resources=resources)
+    return await server._upload_bundle_async(bundle)
+
+
+def retryable_entries(response: BundleCreateResponse) -> List[int]:
+    """
+    Indices of the entries of a batch that failed with a temporary error and can be sent again.
+    """
+    return [
+        failure.entry_index
+        for failure in response.failed_entries
+        if failure.status in RETRYABLE_ENTRY_STATUS_CODES
+    ]
+
+
+def merge_retried_entries(
+    previous: BundleCreateResponse, pending: List[int], retried: BundleCreateResponse
+) -> BundleCreateResponse:
+    """
+    Combine the response of a batch with the response of sending some of its failed entries again.
+
+    Args:
+        previous: response of the whole batch
+        pending: indices of the entries of the batch that were sent again
+        retried: response of the entries that were sent again, in the order of pending
+
+    Returns:
+        BundleCreateResponse of the whole batch with the created resources in the order of the batch
+    """
+    failed = {f.entry_index: f for f in previous.failed_entries}
+    created_indices = [
+        i
+        for i in range(len(previous.create_responses) + len(failed))
+        if i not in failed
+    ]
+    created = dict(zip(created_indices, previous.create_responses))
+    retried_failed = {}
+    for f in retried.failed_entries:
+        index = pending[f.entry_index]
+        retried_failed[index] = EntryUploadFailure(
+            f.batch_index, index, f.resource, f.status, f.outcome
+        )
+    for index in pending:
+        failed.pop(index, None)
+    created.update(
+        zip([i for i in pending if i not in retried_failed], retried.create_responses)
+    )
+    failed.update(retried_failed)
+    return BundleCreateResponse(
+        create_responses=[created[i] for i in sorted(created)],
+        failed_entries=[failed[i] for i in sorted(failed)],
+    )
+
+
+def upload_batch_bundle(
+    server: "FhirServer", resources: list, batch_index: int = 0, entry_retries: int = 1
+) -> BundleCreateResponse:
+    """
+    Create resources with a batch bundle, in which every entry succeeds or fails on its own. The status and
+    OperationOutcome of each entry are read from the batch response, the created resources are kept and only the
+    entries that failed with a temporary error are sent again.
+
+    Args:
+        server: the server to upload the resources to
+        resources: the resources to create
+        batch_index: index of the batch in the upload, used to report failed entries
+        entry_retries: number of times temporarily failed entries are sent again
+
+    Returns:
+        BundleCreateResponse with the created resources in the given order and the failed entries
+    """
+    upload = _BatchUpload(resources, batch_index)
+    pending = list(range(len(resources)))
+    for _ in range(entry_retries + 1):
+        bundle = upload.bundle(pending)
+        r = server._sync_client().post(server.api_address, content=json_bytes(bundle))
+        raise_for_bundle_status(r)
+        pending = upload.collect(pending, bundle, r.json())
+        if not pending:
+            break
+    return upload.response()
+
+
+async def upload_batch_bundle_async(
+    server: "FhirServer", resources: list, batch_index: int = 0, entry_retries: int = 1
+) -> BundleCreateResponse:
+    """
+    Asynchronously create resources with a batch bundle, see `upload_batch_bundle`.
+    """
+    upload = _BatchUpload(resources, batch_index)
+    pending = list(range(len(resources)))
+    for _ in range(entry_retries + 1):
+        bundle = upload.bundle(pending)
+        r = await server._async_client().post(
+            server.api_address, content=json_bytes(bundle)
+        )
+        raise_for_bundle_status(r)
+        pending = upload.collect(pending, bundle, r.json())
+        if not pending:
+            break
+    return upload.response()
+
+
+def upload_bisecting(
+    server: "FhirServer", resources: list, batch_index: int = 0, offset: int = 0
+) -> BundleCreateResponse:
+    """
+    Create resources with a transaction bundle, if the server rejects the bundle it is split in halves that are
+    uploaded on their own, until the rejected resources are isolated. All valid resources are created and the
+    rejected resources are reported with the OperationOutcome of their single resource bundle.
+
+    Args:
+        server: the server to upload the resources to
+        resources: the resources to create
+        batch_index: index of the batch in the upload, used to report failed entries
+        offset: index of the first resource in the batch
+
+    Returns:
+        BundleCreateResponse with the created resources in the given order and the rejected entries
+    """
+    bundle = make_transaction_bundle(method=TransactionMethod.POST, resources=resources)
+    try:
+        return server._upload_bundle(bundle)
+    except BundleUploadError as e:
+        failure = _bisect_failure(e, resources, batch_index, offset)
+        if failure is not None:
+            return failure
+    middle = len(resources) // 2
+    return BundleCreateResponse.from_batches(
+        [
+            upload_bisecting(server, resources[:middle], batch_index, offset),
+            upload_bisecting(server, resources[middle:], batch_index, offset + middle),
+        ]
+    )
+
+
+async def upload_bisecting_async(
+    server: "FhirServer", resources: list, batch_index: int = 0, offset: int = 0
+) -> BundleCreateResponse:
+    """
+    Asynchronously create resources with a transaction bundle that is split when it is rejected, see
+    `upload_bisecting`.
+    """
+    bundle = make_transaction_bundle(method=TransactionMethod.POST, resources=resources)
+    try:
+        return await server._upload_bundle_async(bundle)
+    except BundleUploadError as e:
+        failure = _bisect_failure(e, resources, batch_index, offset)
+        if failure is not None:
+            return failure
+    middle = len(resources) // 2
+    return BundleCreateResponse.from_batches(
+        [
+            await upload_bisecting_async(
+                server, resources[:middle], batch_index, offset
+            ),
+            await upload_bisecting_async(
+                server, resources[middle:], batch_index, offset + middle
+            ),
+        ]
+    )
+
+
+def _bisect_failure(
+    error: BundleUploadError, resources: list, batch_index: int, offset: int
+) -> Optional[BundleCreateResponse]:
+    # errors that do not depend on the resources are raised, a single rejected resource is reported as failed entry
+    status = error.response.status_code
+    if status in NOT_BISECTED_STATUS_CODES or status >= 500:
+        raise error
+    if len(resources) > 1:
+        return None
+    failure = EntryUploadFailure(
+        batch_index,
+        offset,
+        resources[0],
+        status=error.response.status_code,
+        outcome=error.outcome,
+    )
+    return BundleCreateResponse(failed_entries=[failure])
+
+
+class _BatchUpload:
+    """
+    State of the upload of resources in a batch bundle over multiple attempts.
+    """
+
+    def __init__(self, resources: list, batch_index: int):
+        self.resources = resources
+        self.batch_index = batch_index
+        self.created: Dict[int, ResourceCreateResponse] = {}
+        self.failed: Dict[int, EntryUploadFailure] = {}
+
+    def bundle(self, pending: List[int]) -> Bundle:
+        return make_transaction_bundle(
+            transaction_type=TransactionType.BATCH,
+            method=TransactionMethod.POST,
+            resources=[self.resources[i] for i in pending],
+        )
+
+    def collect(self, pending: List[int], bundle: Bundle, response: dict) -> List[int]:
+        """
+        Read the entries of a batch response.
+
+        Returns:
+            indices of the resources that failed with a temporary error and can be sent again
+        """
+        retry = []
+        for position, (index, entry, status, outcome) in enumerate(
+            self._entries(pending, response)
+        ):
+            if 200 <= status < 300:
+                self.created[index] = ResourceCreateResponse(
+                    entry, bundle.entry[position].resource
+                )
+                self.failed.pop(index, None)
+                continue
+            self.failed[index] = EntryUploadFailure(
+                self.batch_index, index, self.resources[index], status, outcome
+            )
+            if status in RETRYABLE_ENTRY_STATUS_CODES:
+                retry.append(index)
+        return retry
+
+    def response(self) -> BundleCreateResponse:
+        return BundleCreateResponse(
+            create_responses=[self.created[i] for i in sorted(self.created)],
+            failed_entries=[self.failed[i] for i in sorted(self.failed)],
+        )
+
+    @staticmethod
+    def _entries(
+        pending: List[int], response: dict
+    ) -> List[Tuple[int, dict, int, Optional[dict]]]:
+        entries = response.get("entry") or []
+        if len(entries) != len(pending):
+            raise ValueError(
+                f"Batch response contains {len(entries)} entries for {len(pending)} requests"
+            )
+        result = []
+        for index, entry in zip(pending, entries):
+            entry_response = entry.get("response") or {}
+            status = entry_status(entry_response)
+            outcome = entry_outcome(entry)
+            result.append((index, entry_response, status, outcome))
+        return result
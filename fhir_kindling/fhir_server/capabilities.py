@@ -0,0 +1,150 @@
+import hashlib
+import os
+import pathlib
+import tempfile
+import time
+from typing import Dict, List, Optional, Union
+
+import orjson
+from fhir.resources.capabilitystatement import CapabilityStatement
+
+
+class ServerCapabilities:
+    """
+    Capability statement of a server with indexes of the supported resources and their search parameters. The indexes
+    are built from the raw statement, the statement is only parsed into a CapabilityStatement when it is accessed.
+    """
+
+    def __init__(self, statement: dict, fetched_at: float = None):
+        """
+        Args:
+            statement: json dictionary of the capability statement returned by the /metadata endpoint
+            fetched_at: unix timestamp of when the statement was fetched from the server, defaults to now
+        """
+        self.statement = statement
+        self.fetched_at = fetched_at if fetched_at is not None else time.time()
+        self._capability_statement: Optional[CapabilityStatement] = None
+        self.search_params: Dict[str, Dict[str, str]] = {}
+        for resource in self._rest_resources():
+            self.search_params[resource["type"]] = {
+                param["name"]: param.get("type")
+                for param in resource.get("searchParam", [])
+            }
+
+    @property
+    def capability_statement(self) -> CapabilityStatement:
+        if self._capability_statement is None:
+            self._capability_statement = CapabilityStatement(**self.statement)
+        return self._capability_statement
+
+    @property
+    def resources(self) -> List[str]:
+        """Resource types supported by the server"""
+        return list(self.search_params)
+
+    def supports(self, resource: str, search_param: str = None) -> bool:
+        """
+        Check whether the server supports a resource type or a search parameter of a resource type.
+
+        Args:
+            resource: the resource type e.g. Patient
+            search_param: optional name of a search parameter of the resource e.g. birthdate
+
+        Returns:
+            True if the resource (and search parameter) are listed in the capability statement
+        """
+        params = self.search_params.get(resource)
+        if params is None:
+            return False
+        return search_param is None or search_param in params
+
+    def _rest_resources(self) -> List[dict]:
+        rest = self.statement.get("rest") or []
+        if not rest:
+            return []
+        # use the capabilities of the server over those of a client if both are given
+        server_rest = next((r for r in rest if r.get("mode") == "server"), rest[0])
+        return server_rest.get("resource") or []
+
+    def __repr__(self):
+        return f"<ServerCapabilities(resources={len(self.search_params)})>"
+
+
+class CapabilityCache:
+    DEFAULT_DIRECTORY = pathlib.Path.home() / ".cache" / "fhir_kindling"
+
+    def __init__(
+        self, directory: Union[str, pathlib.Path] = None, ttl: Optional[float] = 86400
+    ):
+        """
+        Disk cache of the capability statements of servers, so short-lived processes can use the capabilities of a
+        server without requesting and parsing the /metadata endpoint on every start. Statements are stored as one
+        json file per server.
+
+        Args:
+            directory: directory to store the statements in, defaults to ~/.cache/fhir_kindling
+            ttl: time in seconds a stored statement is used before it is requested again, None to never expire
+        """
+        self.directory = pathlib.Path(directory or self.DEFAULT_DIRECTORY)
+        self.ttl = ttl
+
+    def path(self, api_address: str) -> pathlib.Path:
+        digest = hashlib.sha256(api_address.encode("utf-8")).hexdigest()[:16]
+        return self.directory / f"capabilities-{digest}.json"
+
+    def load(self, api_address: str) -> Optional[ServerCapabilities]:
+        """
+        Load the stored capabilities of a server.
+
+        Args:
+            api_address: base url of the server
+
+        Returns:
+            the capabilities of the server, None if none are stored, they expired or could not be read
+        """
+        try:
+            cached = orjson.loads(self.path(api_address).read_bytes())
+        except (OSError, orjson.JSONDecodeError):
+            return None
+        if cached.get("api_address") != api_address:
+            return None
+        fetched_at = cached.get("fetched_at", 0)
+        if self.ttl is not None and time.time() - fetched_at > self.ttl:
+            return None
+        return ServerCapabilities(cached["statement"], fetched_at=fetched_at)
+
+    def store(self, api_address: str, capabilities: ServerCapabilities) -> None:
+        """
+        Store the capabilities of a server, replacing previously stored capabilities.
+
+        Args:
+            api_address: base url of the server
+            capabilities: the capabilities to store
+        """
+        self.directory.mkdir(parents=True, exist_ok=True)
+        content = orjson.dumps(
+            {
+                "api_address": api_address,
+                "fetched_at": capabilities.fetched_at,
+                "statement": capabilities.statement,
+            }
+        )
+        # write to a temporary file first, so concurrent processes never read a partially written file
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(content)
+            os.replace(tmp_path, self.path(api_address))
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def invalidate(self, api_address: str) -> None:
+        """Remove the stored capabilities of a server"""
+        try:
+            self.path(api_address).unlink()
+        except FileNotFoundError:
+            pass
+
+    def __repr__(self):
+        return f"<CapabilityCache(directory={self.directory}, ttl={self.ttl})>"
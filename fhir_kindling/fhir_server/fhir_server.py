@@ -1,9 +1,33 @@
+import asyncio
+import itertools
 import os
+import pathlib
 import re
-from typing import Iterable, List, Union
+import threading
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    Future,
+    ThreadPoolExecutor,
+    as_completed,
+    wait,
+)
+from datetime import date, datetime
+from typing import (
+    Any,
+    AsyncIterator,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Set,
+    Tuple,
+    Union,
+)
 
 import fhir.resources
 import httpx
+import orjson
 from authlib.integrations.httpx_client import OAuth2Client
 from authlib.oauth2.rfc6749 import OAuth2Token
 from authlib.oauth2.rfc7523 import ClientSecretJWT
@@ -18,8 +42,23 @@ from tqdm import tqdm
 from fhir_kindling.fhir_query import FhirQueryAsync, FhirQuerySync
 from fhir_kindling.fhir_query.query_parameters import FhirQueryParameters
 from fhir_kindling.fhir_server.auth import BearerAuth, auth_info_from_env
+from fhir_kindling.fhir_server.bulk_export import bulk_export, iter_bulk_export
+from fhir_kindling.fhir_server.bulk_load import load_ndjson
+from fhir_kindling.fhir_server.bundle_upload import (
+    entry_outcome,
+    entry_status,
+    raise_for_bundle_status,
+    retryable_entries,
+    upload_resources,
+    upload_resources_async,
+)
+from fhir_kindling.fhir_server.capabilities import CapabilityCache, ServerCapabilities
 from fhir_kindling.fhir_server.server_responses import (
+    BatchUploadFailure,
+    BulkExportResponse,
+    BulkLoadResponse,
     BundleCreateResponse,
+    EntryReadFailure,
     ResourceCreateResponse,
     TransferResponse,
 )
@@ -34,8 +73,28 @@ from fhir_kindling.fhir_server.transactions import (
     make_transaction_bundle,
 )
 from fhir_kindling.fhir_server.transfer import transfer
-from fhir_kindling.serde.json import json_dict
-from fhir_kindling.util.retry_transport import RetryTransport
+from fhir_kindling.fhir_server.upload_journal import (
+    UploadJournal,
+    batch_fingerprint,
+    open_journal,
+)
+from fhir_kindling.serde.json import json_bytes
+from fhir_kindling.util.circuit_breaker import (
+    CircuitBreaker,
+    CircuitBreakerTransport,
+    CircuitState,
+)
+from fhir_kindling.util.compression_transport import CompressionTransport
+from fhir_kindling.util.hedging import HedgePolicy, HedgingTransport
+from fhir_kindling.util.rate_limit import AdaptiveLimiter, RateLimitTransport
+from fhir_kindling.util.resource_cache import (
+    CACHED_READ_EXTENSION,
+    CacheEntry,
+    CacheRevalidationTransport,
+    ResourceCache,
+    entry_validators,
+)
+from fhir_kindling.util.retry_transport import RetryBudget, RetryTransport
 
 
 class FhirServer:
@@ -60,6 +119,21 @@ class FhirServer:
         backoff_factor: float = 0.1,
         jitter_ratio: float = 0.1,
         respect_retry_after_header: bool = True,
+        retry_budget_ratio: Union[float, None] = 0.2,
+        retry_budget_min_retries: int = 10,
+        max_connections: Union[int, None] = 100,
+        max_keepalive_connections: Union[int, None] = 20,
+        keepalive_expiry: Union[float, None] = 5.0,
+        compress_requests: bool = False,
+        compression_min_size: int = 1024,
+        compression_level: int = 6,
+        accept_encoding: Union[str, None] = "gzip, deflate",
+        http2: bool = False,
+        rate_limiter: Union[AdaptiveLimiter, bool, None] = None,
+        circuit_breaker: Union[CircuitBreaker, bool, None] = None,
+        hedging: Union[HedgePolicy, bool, None] = None,
+        cache: Union[ResourceCache, bool, None] = None,
+        capability_cache: Union[CapabilityCache, bool, None] = None,
     ):
         """
         Initialize a FHIR server connection
@@ -79,12 +153,40 @@ class FhirServer:
             retry_status_codes: optional list of status codes to retry on
             max_atttempts: optional number of times to retry
             retry_wait: optional number of seconds to wait between retries
+            retry_budget_ratio: maximum number of retries per client as a fraction of the requests made by the client,
+                None to not limit the retries
+            retry_budget_min_retries: number of retries per client that are allowed independent of the budget ratio
+            max_connections: maximum number of concurrent connections in the connection pool
+            max_keepalive_connections: maximum number of idle connections kept alive in the pool
+            keepalive_expiry: time in seconds after which idle connections are closed
+            compress_requests: gzip encode the bodies of requests sent to the server, the server needs to support
+                gzip encoded requests
+            compression_min_size: minimum size of a request body in bytes to be compressed
+            compression_level: gzip compression level of the request bodies between 0 and 9
+            accept_encoding: value of the Accept-Encoding header sent with every request to negotiate compressed
+                responses, None to not send the header
+            http2: use HTTP/2 to multiplex concurrent requests over a few connections, requires the h2 package
+                (`pip install fhir-kindling[http2]`, python 3.10+). Servers with a plain http:// address are expected to
+                speak HTTP/2 directly (prior knowledge).
+            rate_limiter: adaptive limiter for the request rate and concurrency shared by all requests of the server,
+                True to use a limiter with the default configuration
+            circuit_breaker: circuit breaker shared by all requests of the server that rejects requests while the
+                server is failing, True to use a circuit breaker with the default configuration
+            hedging: policy for hedging slow GET requests with a duplicate request, the first response wins. True to
+                use a policy with the default configuration
+            cache: cache for resources read with get, get_many and queries, invalidated by update and delete. True to
+                use a cache with the default configuration
+            capability_cache: disk cache for the capability statement of the server shared between processes, True to
+                use a cache with the default configuration
         """
 
         # server definition values
         self.fhir_server_type = fhir_server_type
         self.api_address = self._validate_api_address(api_address)
-        self._meta_data = None
+        self._capabilities: Union[ServerCapabilities, None] = None
+        if capability_cache is True:
+            capability_cache = CapabilityCache()
+        self.capability_cache: Union[CapabilityCache, None] = capability_cache or None
 
         # possible basic auth class vars
         self.username = username
@@ -107,12 +209,56 @@ class FhirServer:
         self.backoff_factor = backoff_factor
         self.jitter_ratio = jitter_ratio
         self.respect_retry_after_header = respect_retry_after_header
+        self.retry_budget_ratio = retry_budget_ratio
+        self.retry_budget_min_retries = retry_budget_min_retries
+
+        # adaptive rate limiting shared by the sync and async clients
+        if rate_limiter is True:
+            rate_limiter = AdaptiveLimiter()
+        self.rate_limiter: Union[AdaptiveLimiter, None] = rate_limiter or None
+        if circuit_breaker is True:
+            circuit_breaker = CircuitBreaker()
+        self.circuit_breaker: Union[CircuitBreaker, None] = circuit_breaker or None
+        if hedging is True:
+            hedging = HedgePolicy()
+        self.hedging: Union[HedgePolicy, None] = hedging or None
+
+        # resources read by reference, kept until they are updated or deleted through this server
+        if cache is True:
+            cache = ResourceCache()
+        self.cache: Union[ResourceCache, None] = (
+            cache if isinstance(cache, ResourceCache) else None
+        )
 
         self._auth = auth
         self._headers = headers
         self._proxies = proxies
         self._timeout = timeout
 
+        # compression
+        self.compress_requests = compress_requests
+        self.compression_min_size = compression_min_size
+        self.compression_level = compression_level
+        self.accept_encoding = accept_encoding
+
+        # long-lived connection pools shared by all requests and queries of the server
+        self.http2 = http2
+        self._limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry,
+        )
+        self._client: Union[httpx.Client, None] = None
+        self._aclient: Union[httpx.AsyncClient, None] = None
+        self._aclient_loop: Union[asyncio.AbstractEventLoop, None] = None
+        # auth and headers the clients were configured with, the clients are updated when they change
+        self._client_settings: Union[tuple, None] = None
+        self._aclient_settings: Union[tuple, None] = None
+        # close tasks of async clients replaced after the event loop changed
+        self._closing_clients: Set[asyncio.Task] = set()
+        # the clients are created lazily and may be requested from multiple threads at the same time
+        self._client_lock = threading.Lock()
+
     @classmethod
     def from_env(cls, no_auth: bool = False) -> "FhirServer":
         api_address = _api_address_from_env()
@@ -185,6 +331,7 @@ class FhirServer:
             proxies=self._proxies,
             headers=self._headers,
             client=self._sync_client(),
+            cache=self.cache,
         )
 
         return query
@@ -224,6 +371,7 @@ class FhirServer:
             output_format=output_format,
             proxies=self._proxies,
             client=self._async_client(),
+            cache=self.cache,
         )
 
         return query
@@ -278,6 +426,7 @@ class FhirServer:
             proxies=self._proxies,
             headers=self._headers,
             client=self._sync_client(),
+            cache=self.cache,
         )
         return query
 
@@ -305,6 +454,7 @@ class FhirServer:
             auth=self.auth,
             proxies=self._proxies,
             client=self._async_client(),
+            cache=self.cache,
         )
         return query
 
@@ -321,8 +471,13 @@ class FhirServer:
         """
         if isinstance(reference, Reference):
             reference = reference.reference
-        with self._sync_client() as client:
-            r = client.get(f"{self.api_address}/{reference}")
+        resource = self._get_cached(reference)
+        if resource is not None:
+            return resource
+        r = self._sync_client().get(
+            f"{self.api_address}/{reference}",
+            extensions={CACHED_READ_EXTENSION: True},
+        )
         r.raise_for_status()
         resource_dict = r.json()
         resource = construct_fhir_element(resource_dict["resourceType"], resource_dict)
@@ -341,83 +496,162 @@ class FhirServer:
         """
         if isinstance(reference, Reference):
             reference = reference.reference
-        async with self._async_client() as client:
-            r = await client.get(f"{self.api_address}/{reference}")
-            r.raise_for_status()
+        resource = self._get_cached(reference)
+        if resource is not None:
+            return resource
+        r = await self._async_client().get(
+            f"{self.api_address}/{reference}",
+            extensions={CACHED_READ_EXTENSION: True},
+        )
+        r.raise_for_status()
         resource_dict = r.json()
         resource = construct_fhir_element(resource_dict["resourceType"], resource_dict)
         return resource
 
     def get_many(
-        self, references: List[Union[str, Reference]]
-    ) -> List[FHIRAbstractModel]:
+        self,
+        references: List[Union[str, Reference]],
+        batch_size: int = 1000,
+        workers: int = 4,
+    ) -> List[Union[FHIRAbstractModel, None]]:
         """
-        Get a list of resources from the server specified by the given references
+        Get a list of resources from the server specified by the given references. The references are read in batch
+        bundles of at most batch_size references, multiple batches are read in parallel.
 
         Args:
             references: list of references to the resources, either a Reference object or a string of the form
                 `{ResourceType}/{id}`
+            batch_size: maximum number of references read in one batch bundle
+            workers: number of threads reading batches in parallel
 
         Returns:
-            list of resources corresponding to the references
+            list of resources corresponding to the references, None for references that could not be read e.g.
+            because the resource does not exist. Use `iter_many` for the status of these references.
 
         """
-        str_references = [
-            reference if isinstance(reference, str) else reference.reference
-            for reference in references
-        ]
+        resources = [None] * len(references)
+        for index, result in self._iter_many_indexed(references, batch_size, workers):
+            if not isinstance(result, EntryReadFailure):
+                resources[index] = result
+        return resources
 
-        get_many_transaction = make_transaction_bundle(
-            method=TransactionMethod.GET,
-            transaction_type=TransactionType.BATCH,
-            references=str_references,
-        )
-        with self._sync_client() as client:
-            r = client.post(self.api_address, json=json_dict(get_many_transaction))
-            r.raise_for_status()
-        entries = r.json()["entry"]
-        resources = [
-            construct_fhir_element(entry["resource"]["resourceType"], entry["resource"])
-            for entry in entries
-        ]
+    def iter_many(
+        self,
+        references: List[Union[str, Reference]],
+        batch_size: int = 1000,
+        workers: int = 4,
+    ) -> Iterator[Tuple[str, Union[FHIRAbstractModel, EntryReadFailure]]]:
+        """
+        Read the resources specified by the given references in batch bundles of at most batch_size references and
+        yield them as soon as their batch is read, while the next batches are read in parallel.
 
-        return resources
+        Args:
+            references: list of references to the resources, either a Reference object or a string of the form
+                `{ResourceType}/{id}`
+            batch_size: maximum number of references read in one batch bundle
+            workers: number of threads reading batches in parallel
+
+        Returns:
+            Iterator over tuples of the reference and the resource, or an EntryReadFailure with the status and
+            OperationOutcome of references that could not be read. Batches are yielded in the order they are read.
+        """
+        str_references = _reference_strings(references)
+        for index, result in self._iter_many_indexed(
+            str_references, batch_size, workers
+        ):
+            yield str_references[index], result
 
     async def get_many_async(
-        self, references: List[Union[str, Reference]]
-    ) -> List[FHIRAbstractModel]:
+        self,
+        references: List[Union[str, Reference]],
+        batch_size: int = 1000,
+        max_concurrency: int = 4,
+    ) -> List[Union[FHIRAbstractModel, None]]:
         """
-        Asynchronously get a list of resources from the server specified by the given references
+        Asynchronously get a list of resources from the server specified by the given references. The references are
+        read in batch bundles of at most batch_size references, multiple batches are read concurrently.
 
         Args:
             references: list of references to the resources, either a Reference object or a string of the form
                 `{ResourceType}/{id}`
+            batch_size: maximum number of references read in one batch bundle
+            max_concurrency: maximum number of batches that are read concurrently
 
         Returns:
-            list of resources corresponding to the references
+            list of resources corresponding to the references, None for references that could not be read e.g.
+            because the resource does not exist. Use `iter_many_async` for the status of these references.
 
         """
-        str_references = [
-            reference if isinstance(reference, str) else reference.reference
-            for reference in references
+        if max_concurrency < 1:
+            raise ValueError(
+                f"max_concurrency must be at least 1, given {max_concurrency}"
+            )
+        batches = self._batch_resources(_reference_strings(references), batch_size)
+        semaphore = asyncio.Semaphore(max_concurrency)
+
+        async def read_batch(batch: List[str]) -> list:
+            async with semaphore:
+                return await self._get_many_batch_async(batch)
+
+        tasks = [asyncio.ensure_future(read_batch(batch)) for batch in batches]
+        try:
+            batch_results = await asyncio.gather(*tasks)
+        except Exception as e:
+            for task in tasks:
+                task.cancel()
+            raise e
+        return [
+            None if isinstance(result, EntryReadFailure) else result
+            for results in batch_results
+            for result in results
         ]
-        get_many_transaction = make_transaction_bundle(
-            method=TransactionMethod.GET,
-            transaction_type=TransactionType.BATCH,
-            references=str_references,
-        )
 
-        async with self._async_client() as client:
-            response = await client.post(
-                self.api_address, json=get_many_transaction.dict(exclude_none=True)
-            )
+    async def iter_many_async(
+        self,
+        references: List[Union[str, Reference]],
+        batch_size: int = 1000,
+        max_concurrency: int = 4,
+    ) -> AsyncIterator[Tuple[str, Union[FHIRAbstractModel, EntryReadFailure]]]:
+        """
+        Asynchronously read the resources specified by the given references in batch bundles of at most batch_size
+        references and yield them as soon as their batch is read, while the next batches are read concurrently.
 
-        # construct the list of resources from the server response
-        resources = [
-            construct_fhir_element(entry["resource"]["resourceType"], entry["resource"])
-            for entry in response.json()["entry"]
-        ]
-        return resources
+        Args:
+            references: list of references to the resources, either a Reference object or a string of the form
+                `{ResourceType}/{id}`
+            batch_size: maximum number of references read in one batch bundle
+            max_concurrency: maximum number of batches that are read concurrently
+
+        Returns:
+            Async iterator over tuples of the reference and the resource, or an EntryReadFailure with the status and
+            OperationOutcome of references that could not be read. Batches are yielded in the order they are read.
+        """
+        if max_concurrency < 1:
+            raise ValueError(
+                f"max_concurrency must be at least 1, given {max_concurrency}"
+            )
+        batches = iter(
+            self._batch_resources(_reference_strings(references), batch_size)
+        )
+        # references of the batches that are being read by task
+        pending: Dict[asyncio.Future, List[str]] = {}
+        try:
+            while True:
+                # only start a batch when a slot is free, so read batches do not pile up in memory
+                for batch in itertools.islice(batches, max_concurrency - len(pending)):
+                    task = asyncio.ensure_future(self._get_many_batch_async(batch))
+                    pending[task] = batch
+                if not pending:
+                    return
+                done, _ = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    for item in zip(pending.pop(task), task.result()):
+                        yield item
+        finally:
+            for task in pending:
+                task.cancel()
 
     def add(self, resource: Union[Resource, dict]) -> ResourceCreateResponse:
         """
@@ -476,6 +710,12 @@ class FhirServer:
         resources: List[Union[Resource, FHIRAbstractModel, dict]],
         batch_size: int = 1000,
         display: bool = True,
+        workers: int = 1,
+        fail_fast: bool = True,
+        journal: Union[str, pathlib.Path, UploadJournal] = None,
+        transaction_type: Union[TransactionType, str] = TransactionType.TRANSACTION,
+        bisect: bool = False,
+        entry_retries: int = 1,
     ) -> BundleCreateResponse:
         """
         Upload a list of resources to the server, after packaging them into a bundle
@@ -483,44 +723,76 @@ class FhirServer:
             resources: list of resources to upload to the server, either dictionary or FHIR resource objects
             batch_size: maximum number of resources to upload in one bundle
             display: whether to display a progress bar when the upload is batched
+            workers: number of threads uploading batches in parallel over the pooled connections of the server
+            fail_fast: if True the first failing batch stops the upload and raises the error, otherwise failed
+                batches are collected in the `failed_batches` of the response
+            journal: path of an upload journal or UploadJournal that records the completed batches, batches that are
+                already recorded in the journal are skipped, so an interrupted upload can be resumed
+            transaction_type: upload the batches as transaction bundles, in which a single rejected resource fails the
+                whole batch, or as batch bundles, in which every resource is created on its own and rejected resources
+                are collected in the `failed_entries` of the response
+            bisect: split rejected transaction bundles in halves and upload them again, until the rejected resources
+                are isolated and collected in the `failed_entries` of the response
+            entry_retries: number of times entries of a batch bundle that failed with a temporary error are sent again
 
         Returns:
             Bundle create response from the fhir server
 
         """
-        response = None
-        if len(resources) > batch_size:
-            # split the list of resources into batches of size batch_size
-            batches = [
-                resources[i : i + batch_size]
-                for i in range(0, len(resources), batch_size)
-            ]
+        if workers < 1:
+            raise ValueError(f"workers must be at least 1, given {workers}")
+
+        batches = self._batch_resources(resources, batch_size)
+        upload_options = self._upload_options(transaction_type, bisect, entry_retries)
 
-            p_bar = tqdm(batches, disable=not display)
-            for i, batch in enumerate(p_bar):
+        def upload_batch(
+            index: int, batch: list
+        ) -> Union[BundleCreateResponse, BatchUploadFailure]:
+            try:
+                return self._upload_batch(
+                    index, batch, upload_journal, **upload_options
+                )
+            except Exception as e:
+                if fail_fast:
+                    raise e
+                return BatchUploadFailure(index, batch, e)
+
+        with open_journal(journal) as upload_journal, tqdm(
+            total=len(batches), disable=not display or len(batches) == 1
+        ) as p_bar:
+            if workers == 1:
+                batch_responses = []
+                for i, batch in enumerate(batches):
+                    p_bar.set_description(
+                        f"Uploading Batch {i + 1}/{len(batches)}, n={len(batch)}"
+                    )
+                    batch_responses.append(upload_batch(i, batch))
+                    p_bar.update(1)
+            else:
                 p_bar.set_description(
-                    f"Uploading Batch {i + 1}/{len(batches)}, n={len(batch)}"
+                    f"Uploading {len(batches)} Batches, workers={workers}"
                 )
-                bundle = make_transaction_bundle(
-                    method=TransactionMethod.POST, resources=batch
+                batch_responses = self._map_threaded(
+                    upload_batch, batches, workers, p_bar
                 )
-                if not response:
-                    response = self._upload_bundle(bundle)
-                else:
-                    add_response = self._upload_bundle(bundle)
-                    response.create_responses.extend(add_response.create_responses)
-        else:
-            bundle = make_transaction_bundle(
-                method=TransactionMethod.POST, resources=resources
-            )
-            response = self._upload_bundle(bundle)
-        return response
+
+        if len(batch_responses) == 1 and isinstance(
+            batch_responses[0], BundleCreateResponse
+        ):
+            return batch_responses[0]
+        return BundleCreateResponse.from_batches(batch_responses)
 
     async def add_all_async(
         self,
         resources: List[Union[Resource, FHIRAbstractModel, dict]],
         batch_size: int = 5000,
         display: bool = True,
+        max_concurrency: int = 1,
+        fail_fast: bool = True,
+        journal: Union[str, pathlib.Path, UploadJournal] = None,
+        transaction_type: Union[TransactionType, str] = TransactionType.TRANSACTION,
+        bisect: bool = False,
+        entry_retries: int = 1,
     ) -> BundleCreateResponse:
         """
         Asynchronously upload a list of resources to the server, after packaging them into a bundle
@@ -529,39 +801,68 @@ class FhirServer:
             resources: list of resources to upload to the server, either dictionary or FHIR resource objects
             batch_size: maximum number of resources to upload in one bundle
             display: whether to display a progress bar when the upload is batched
+            max_concurrency: maximum number of batches that are uploaded concurrently
+            fail_fast: if True the first failing batch cancels the upload and raises the error, otherwise failed
+                batches are collected in the `failed_batches` of the response
+            journal: path of an upload journal or UploadJournal that records the completed batches, batches that are
+                already recorded in the journal are skipped, so an interrupted upload can be resumed
+            transaction_type: upload the batches as transaction bundles, in which a single rejected resource fails the
+                whole batch, or as batch bundles, in which every resource is created on its own and rejected resources
+                are collected in the `failed_entries` of the response
+            bisect: split rejected transaction bundles in halves and upload them again, until the rejected resources
+                are isolated and collected in the `failed_entries` of the response
+            entry_retries: number of times entries of a batch bundle that failed with a temporary error are sent again
 
         Returns: Bundle create response from the fhir server
         """
+        if max_concurrency < 1:
+            raise ValueError(
+                f"max_concurrency must be at least 1, given {max_concurrency}"
+            )
 
-        response = None
-        if len(resources) > batch_size:
-            # split the list of resources into batches of size batch_size
-            batches = [
-                resources[i : i + batch_size]
-                for i in range(0, len(resources), batch_size)
+        batches = self._batch_resources(resources, batch_size)
+        upload_options = self._upload_options(transaction_type, bisect, entry_retries)
+        semaphore = asyncio.Semaphore(max_concurrency)
+        p_bar = tqdm(total=len(batches), disable=not display or len(batches) == 1)
+
+        async def upload_batch(
+            index: int, batch: list
+        ) -> Union[BundleCreateResponse, BatchUploadFailure]:
+            async with semaphore:
+                try:
+                    return await self._upload_batch_async(
+                        index, batch, upload_journal, **upload_options
+                    )
+                except Exception as e:
+                    if fail_fast:
+                        raise e
+                    return BatchUploadFailure(index, batch, e)
+                finally:
+                    p_bar.set_description(
+                        f"Uploaded Batch {index + 1}/{len(batches)}, n={len(batch)}"
+                    )
+                    p_bar.update(1)
+
+        with open_journal(journal) as upload_journal:
+            tasks = [
+                asyncio.ensure_future(upload_batch(i, batch))
+                for i, batch in enumerate(batches)
             ]
-            p_bar = tqdm(batches, disable=not display)
-            for i, batch in enumerate(p_bar):
-                p_bar.set_description(
-                    f"Uploading Batch {i + 1}/{len(batches)}, n={len(batch)}"
-                )
+            try:
+                batch_responses = await asyncio.gather(*tasks)
+            except Exception as e:
+                # cancel the batches that are still pending
+                for task in tasks:
+                    task.cancel()
+                raise e
+            finally:
+                p_bar.close()
 
-                # create a bundle from the batch of resources
-                bundle = make_transaction_bundle(
-                    method=TransactionMethod.POST, resources=batch
-                )
-                if not response:
-                    response = await self._upload_bundle_async(bundle)
-                else:
-                    add_response = await self._upload_bundle_async(bundle)
-                    response.create_responses.extend(add_response.create_responses)
-        else:
-            # create a bundle from the list of resources
-            bundle = make_transaction_bundle(
-                method=TransactionMethod.POST, resources=resources
-            )
-            response = await self._upload_bundle_async(bundle)
-        return response
+        if len(batch_responses) == 1 and isinstance(
+            batch_responses[0], BundleCreateResponse
+        ):
+            return batch_responses[0]
+        return BundleCreateResponse.from_batches(batch_responses)
 
     def add_bundle(
         self, bundle: Union[Bundle, dict, str], validate: bool = True
@@ -624,9 +925,11 @@ class FhirServer:
         update_bundle = make_transaction_bundle(
             method=TransactionMethod.PUT, resources=resources
         )
-        with self._sync_client() as client:
-            r = client.post(self.api_address, json=json_dict(update_bundle))
-            r.raise_for_status()
+        r = self._sync_client().post(
+            self.api_address, content=json_bytes(update_bundle)
+        )
+        self._invalidate_cached(resources)
+        r.raise_for_status()
         return r.json()
 
     async def update_async(self, resources: List[Union[FHIRResourceModel, dict]]):
@@ -634,9 +937,11 @@ class FhirServer:
             method=TransactionMethod.PUT, resources=resources
         )
 
-        async with self._async_client() as client:
-            r = await client.post(self.api_address, json=json_dict(update_bundle))
-            r.raise_for_status()
+        r = await self._async_client().post(
+            self.api_address, content=json_bytes(update_bundle)
+        )
+        self._invalidate_cached(resources)
+        r.raise_for_status()
         return r.json()
 
     def delete(
@@ -668,9 +973,11 @@ class FhirServer:
             references=references,
         )
 
-        with self._sync_client() as client:
-            r = client.post(self.api_address, json=json_dict(delete_bundle))
-            r.raise_for_status()
+        r = self._sync_client().post(
+            self.api_address, content=json_bytes(delete_bundle)
+        )
+        self._invalidate_cached(resources or references)
+        r.raise_for_status()
 
     async def delete_async(
         self,
@@ -701,9 +1008,11 @@ class FhirServer:
             references=references,
         )
 
-        async with self._async_client() as client:
-            r = await client.post(self.api_address, json=json_dict(delete_bundle))
-            r.raise_for_status()
+        r = await self._async_client().post(
+            self.api_address, content=json_bytes(delete_bundle)
+        )
+        self._invalidate_cached(resources or references)
+        r.raise_for_status()
 
     def transfer(
         self,
@@ -742,6 +1051,142 @@ class FhirServer:
         )
         return response
 
+    def bulk_export(
+        self,
+        output_dir: Union[str, pathlib.Path],
+        resource_types: List[str] = None,
+        since: Union[datetime, date, str] = None,
+        type_filters: List[str] = None,
+        group: str = None,
+        patient: bool = False,
+        max_concurrency: int = 4,
+        poll_interval: float = 2.0,
+        timeout: float = None,
+        display: bool = True,
+    ) -> BulkExportResponse:
+        """
+        Export resources from the server with the asynchronous bulk data $export operation. The export is kicked off
+        and polled until it is complete, then the NDJSON output files are streamed to the output directory in parallel.
+
+        Args:
+            output_dir: directory to write the NDJSON files to
+            resource_types: resource types to export, defaults to all resources
+            since: only export resources updated after this time
+            type_filters: search queries to filter the exported resources e.g. `MedicationRequest?status=active`
+            group: id of a group to export the resources of its members
+            patient: export the resources of all patients
+            max_concurrency: maximum number of files downloaded at the same time
+            poll_interval: seconds between polling the status of the export if the server does not send Retry-After
+            timeout: maximum time in seconds to wait for the export to complete, None to wait indefinitely
+            display: whether to display a progress bar
+
+        Returns:
+            BulkExportResponse with the downloaded output and error files of the export
+        """
+        return bulk_export(
+            self,
+            output_dir,
+            resource_types=resource_types,
+            since=since,
+            type_filters=type_filters,
+            group=group,
+            patient=patient,
+            max_concurrency=max_concurrency,
+            poll_interval=poll_interval,
+            timeout=timeout,
+            display=display,
+        )
+
+    def bulk_export_resources(
+        self,
+        resource_types: List[str] = None,
+        since: Union[datetime, date, str] = None,
+        type_filters: List[str] = None,
+        group: str = None,
+        patient: bool = False,
+        max_concurrency: int = 4,
+        buffer_size: int = 1000,
+        validate: bool = True,
+        poll_interval: float = 2.0,
+        timeout: float = None,
+    ) -> Iterator[FHIRAbstractModel]:
+        """
+        Export resources from the server with the asynchronous bulk data $export operation and yield the resources
+        while the output files are downloaded in parallel, without writing them to disk. At most buffer_size
+        resources are held in memory.
+
+        Args:
+            resource_types: resource types to export, defaults to all resources
+            since: only export resources updated after this time
+            type_filters: search queries to filter the exported resources e.g. `MedicationRequest?status=active`
+            group: id of a group to export the resources of its members
+            patient: export the resources of all patients
+            max_concurrency: maximum number of files downloaded at the same time
+            buffer_size: maximum number of downloaded resources waiting to be processed
+            validate: whether to validate the resources against their model
+            poll_interval: seconds between polling the status of the export if the server does not send Retry-After
+            timeout: maximum time in seconds to wait for the export to complete, None to wait indefinitely
+
+        Returns:
+            Iterator over the exported resources
+        """
+        return iter_bulk_export(
+            self,
+            resource_types=resource_types,
+            since=since,
+            type_filters=type_filters,
+            group=group,
+            patient=patient,
+            max_concurrency=max_concurrency,
+            buffer_size=buffer_size,
+            validate=validate,
+            poll_interval=poll_interval,
+            timeout=timeout,
+        )
+
+    def load_ndjson(
+        self,
+        path_or_glob: Union[str, pathlib.Path, Iterable[Union[str, pathlib.Path]]],
+        batch_size: int = 1000,
+        max_concurrency: int = 4,
+        method: Union[TransactionMethod, str] = None,
+        validate: bool = False,
+        fail_fast: bool = True,
+        display: bool = True,
+        journal: Union[str, pathlib.Path, UploadJournal] = None,
+    ) -> BulkLoadResponse:
+        """
+        Upload the resources of NDJSON files, e.g. the output of a bulk data export, to the server. The files are
+        streamed line by line and uploaded in transaction bundles while they are read, so at most
+        batch_size * max_concurrency resources are held in memory.
+
+        Args:
+            path_or_glob: path of an NDJSON file, a glob pattern e.g. `export/*.ndjson` or a list of paths
+            batch_size: number of resources in each transaction bundle
+            max_concurrency: maximum number of bundles uploaded at the same time
+            method: transaction method of the entries, by default resources with an id are uploaded with PUT to keep
+                their ids and resources without an id with POST
+            validate: whether to validate the resources against their model before uploading them
+            fail_fast: raise the error of the first failed batch, otherwise collect the failed batches in the response
+            display: whether to display a progress bar
+            journal: path of an upload journal or UploadJournal that records the completed batches, batches that are
+                already recorded in the journal are skipped, so an interrupted load can be resumed
+
+        Returns:
+            BulkLoadResponse with the number of uploaded resources and the throughput of the upload
+        """
+        return load_ndjson(
+            self,
+            path_or_glob,
+            batch_size=batch_size,
+            max_concurrency=max_concurrency,
+            method=method,
+            validate=validate,
+            fail_fast=fail_fast,
+            display=display,
+            journal=journal,
+        )
+
     def summary(self, display: bool = True) -> ServerSummary:
         """
         Create a summary for the server. Contains resource counts for all resources available on the server.
@@ -773,20 +1218,47 @@ class FhirServer:
         """
         Get the capabilities statement for the server
         """
-        if not self._meta_data:
-            self._get_meta_data()
-        return CapabilityStatement(**self._meta_data)
+        return self.server_capabilities.capability_statement
 
     @property
     def rest_resources(self) -> List[str]:
         """
         Get the list of resources available on the server
         """
-        return [capa.type for capa in self.capabilities.rest[0].resource]
+        return self.server_capabilities.resources
+
+    @property
+    def server_capabilities(self) -> ServerCapabilities:
+        """
+        Capabilities of the server with indexes of the supported resources and search parameters. The capability
+        statement is requested only once per server object, or loaded from the capability cache if configured.
+        """
+        if self._capabilities is not None:
+            return self._capabilities
+        capabilities = None
+        if self.capability_cache is not None:
+            capabilities = self.capability_cache.load(self.api_address)
+        if capabilities is None:
+            capabilities = ServerCapabilities(self._get_meta_data())
+            if self.capability_cache is not None:
+                self.capability_cache.store(self.api_address, capabilities)
+        self._capabilities = capabilities
+        return capabilities
+
+    @property
+    def circuit_state(self) -> Union[CircuitState, None]:
+        """
+        State of the circuit breaker of the server, None if no circuit breaker is configured
+        """
+        if self.circuit_breaker is None:
+            return None
+        return self.circuit_breaker.state
 
     @property
     def headers(self):
         headers = {"Content-Type": "application/fhir+json"}
+        if self.accept_encoding:
+            headers["Accept-Encoding"] = self.accept_encoding
         if self._headers:
             headers.update(self._headers)
         return headers
@@ -832,6 +1304,59 @@ class FhirServer:
         else:
             raise ValueError(f"Malformed API URL: {api_address}")
 
+    @staticmethod
+    def _map_threaded(
+        func: Callable[[int, Any], Any],
+        items: list,
+        workers: int,
+        p_bar: tqdm = None,
+    ) -> list:
+        """
+        Call func(index, item) for all items using a pool of threads
+
+        Args:
+            func: function to apply to the index and value of each item
+            items: the items to process
+            workers: number of threads to use
+            p_bar: optional progress bar that is updated when an item is processed
+
+        Returns:
+            results of the function calls in the order of the items
+        """
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(func, i, item) for i, item in enumerate(items)]
+            try:
+                for future in as_completed(futures):
+                    future.result()
+                    if p_bar is not None:
+                        p_bar.update(1)
+            except Exception as e:
+                # do not start the items that are still queued
+                for future in futures:
+                    future.cancel()
+                raise e
+        return [future.result() for future in futures]
+
+    @staticmethod
+    def _batch_resources(resources: list, batch_size: int) -> List[list]:
+        """
+        Split a list of resources into batches of at most batch_size resources
+
+        Args:
+            resources: the resources to split
+            batch_size: maximum number of resources in a batch
+
+        Returns:
+            list of batches
+        """
+        if batch_size < 1:
+            raise ValueError(f"batch_size must be at least 1, given {batch_size}")
+        if len(resources) <= batch_size:
+            return [resources]
+        return [
+            resources[i : i + batch_size] for i in range(0, len(resources), batch_size)
+        ]
+
     @staticmethod
     def _validate_delete_args(query, references, resources):
         if query and (resources or references):
@@ -845,6 +1370,96 @@ class FhirServer:
             if entry.request.method.lower() not in ["post", "put"]:
                 raise ValueError(f"Entry {i}:  method is not in [post, put]")
 
+    @staticmethod
+    def _upload_options(
+        transaction_type: Union[TransactionType, str], bisect: bool, entry_retries: int
+    ) -> dict:
+        transaction_type = TransactionType(transaction_type)
+        if bisect and transaction_type == TransactionType.BATCH:
+            raise ValueError("Only transaction bundles can be bisected")
+        if entry_retries < 0:
+            raise ValueError(
+                f"entry_retries must not be negative, given {entry_retries}"
+            )
+        return {
+            "transaction_type": transaction_type,
+            "bisect": bisect,
+            "entry_retries": entry_retries,
+        }
+
+    def _upload_batch(
+        self,
+        index: int,
+        batch: list,
+        journal: UploadJournal = None,
+        transaction_type: TransactionType = TransactionType.TRANSACTION,
+        bisect: bool = False,
+        entry_retries: int = 1,
+    ) -> BundleCreateResponse:
+        """
+        Upload a batch of resources in a bundle, skipping batches that are recorded in the journal.
+        Args:
+            index: index of the batch in the upload
+            batch: the resources to create
+            journal: optional journal of the upload
+            transaction_type: type of the bundle the batch is uploaded in
+            bisect: whether to split rejected transaction bundles
+            entry_retries: number of times temporarily failed entries of batch bundles are sent again
+
+        Returns:
+            BundleCreateResponse with the server assigned ids
+        """
+        fingerprint, previous = None, None
+        if journal is not None:
+            # the resources are created with new ids, so their ids are not part of the batch content
+            fingerprint = batch_fingerprint(batch, ignore_ids=True)
+            previous = journal.completed_response(index, fingerprint, batch)
+            # batches with entries that failed with a temporary error are not complete, these entries are sent again
+            if previous is not None and not retryable_entries(previous):
+                return previous
+        response = upload_resources(
+            self, batch, index, transaction_type, bisect, entry_retries, previous
+        )
+        if journal is not None:
+            journal.record_response(index, fingerprint, response)
+        return response
+
+    async def _upload_batch_async(
+        self,
+        index: int,
+        batch: list,
+        journal: UploadJournal = None,
+        transaction_type: TransactionType = TransactionType.TRANSACTION,
+        bisect: bool = False,
+        entry_retries: int = 1,
+    ) -> BundleCreateResponse:
+        """
+        Asynchronously upload a batch of resources in a bundle, skipping batches that are recorded in the journal.
+        Args:
+            index: index of the batch in the upload
+            batch: the resources to create
+            journal: optional journal of the upload
+            transaction_type: type of the bundle the batch is uploaded in
+            bisect: whether to split rejected transaction bundles
+            entry_retries: number of times temporarily failed entries of batch bundles are sent again
+
+        Returns:
+            BundleCreateResponse with the server assigned ids
+        """
+        fingerprint, previous = None, None
+        if journal is not None:
+            fingerprint = batch_fingerprint(batch, ignore_ids=True)
+            previous = journal.completed_response(index, fingerprint, batch)
+            # batches with entries that failed with a temporary error are not complete, these entries are sent again
+            if previous is not None and not retryable_entries(previous):
+                return previous
+        response = await upload_resources_async(
+            self, batch, index, transaction_type, bisect, entry_retries, previous
+        )
+        if journal is not None:
+            journal.record_response(index, fingerprint, response)
+        return response
+
     def _upload_bundle(self, bundle: Bundle) -> BundleCreateResponse:
         """
         Upload a bundle to the server
@@ -855,13 +1470,8 @@ class FhirServer:
             BundleCreateResponse with the server assigned ids
 
         """
-        with self._sync_client() as client:
-            r = client.post(url=self.api_address, json=json_dict(bundle))
-            try:
-                r.raise_for_status()
-            except Exception as e:
-                print(r.text)
-                raise e
+        r = self._sync_client().post(url=self.api_address, content=json_bytes(bundle))
+        raise_for_bundle_status(r)
         bundle_response = BundleCreateResponse(r, bundle)
         return bundle_response
 
@@ -874,13 +1484,10 @@ class FhirServer:
         Returns:
             BundleCreateResponse with the server assigned ids
         """
-        async with self._async_client() as client:
-            r = await client.post(url=self.api_address, json=json_dict(bundle))
-            try:
-                r.raise_for_status()
-            except Exception as e:
-                print(r.text)
-                raise e
+        r = await self._async_client().post(
+            url=self.api_address, content=json_bytes(bundle)
+        )
+        raise_for_bundle_status(r)
         bundle_response = BundleCreateResponse(r, bundle)
         return bundle_response
 
@@ -894,13 +1501,12 @@ class FhirServer:
             httpx.Response from the server
         """
         url = self.api_address + "/" + resource.get_resource_type()
-        with self._sync_client() as client:
-            r = client.post(url=url, json=json_dict(resource))
-            try:
-                r.raise_for_status()
-            except Exception as e:
-                print(r.text)
-                raise e
+        r = self._sync_client().post(url=url, content=json_bytes(resource))
+        try:
+            r.raise_for_status()
+        except Exception as e:
+            print(r.text)
+            raise e
         return r
 
     async def _upload_resource_async(self, resource: Resource) -> httpx.Response:
@@ -913,81 +1519,380 @@ class FhirServer:
             httpx.Response from the server
         """
         url = self.api_address + "/" + resource.get_resource_type()
-        async with self._async_client() as client:
-            r = await client.post(url=url, json=json_dict(resource))
-            try:
-                r.raise_for_status()
-            except Exception as e:
-                print(r.text)
-                raise e
+        r = await self._async_client().post(url=url, content=json_bytes(resource))
+        try:
+            r.raise_for_status()
+        except Exception as e:
+            print(r.text)
+            raise e
         return r
 
-    def _get_meta_data(self):
-        url = self.api_address + "/metadata"
-        with self._sync_client() as client:
-            r = client.get(url)
+    def _get_cached(self, reference: str) -> Union[FHIRAbstractModel, None]:
+        if self.cache is None:
+            return None
+        content = self.cache.get(reference)
+        if content is None:
+            return None
+        resource_dict = orjson.loads(content)
+        return construct_fhir_element(resource_dict["resourceType"], resource_dict)
+
+    def _iter_many_indexed(
+        self, references: List[Union[str, Reference]], batch_size: int, workers: int
+    ) -> Iterator[Tuple[int, Union[FHIRAbstractModel, EntryReadFailure]]]:
+        """
+        Read the references in batches using a pool of threads, yields the index of each reference with its result
+        as soon as its batch is read.
+        """
+        if workers < 1:
+            raise ValueError(f"workers must be at least 1, given {workers}")
+        batches = self._batch_resources(_reference_strings(references), batch_size)
+        offsets = list(itertools.accumulate([0] + [len(b) for b in batches[:-1]]))
+        if workers == 1 or len(batches) == 1:
+            for offset, batch in zip(offsets, batches):
+                yield from enumerate(self._get_many_batch(batch), start=offset)
+            return
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            # offsets of the batches that are being read by future
+            pending: Dict[Future, int] = {}
+            items = iter(zip(offsets, batches))
             try:
-                r.raise_for_status()
-            except Exception as e:
-                print(r.text)
-                raise e
-        response = r.json()
-        self._meta_data = response
+                while True:
+                    # only start a batch when a thread is free, so read batches do not pile up in memory
+                    for offset, batch in itertools.islice(
+                        items, workers - len(pending)
+                    ):
+                        pending[executor.submit(self._get_many_batch, batch)] = offset
+                    if not pending:
+                        return
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        yield from enumerate(future.result(), start=pending.pop(future))
+            finally:
+                for future in pending:
+                    future.cancel()
+
+    def _get_many_batch(
+        self, references: List[str]
+    ) -> List[Union[FHIRAbstractModel, EntryReadFailure]]:
+        """
+        Read a batch of references with a single batch bundle, resources in the cache are not requested.
+        """
+        resources, missing = self._get_many_cached(references)
+        if not missing:
+            return resources
+        bundle, expired = self._get_many_bundle(references, missing)
+        r = self._sync_client().post(self.api_address, content=json_bytes(bundle))
+        raise_for_bundle_status(r)
+        self._add_get_many_entries(resources, missing, references, r.json(), expired)
+        return resources
+
+    async def _get_many_batch_async(
+        self, references: List[str]
+    ) -> List[Union[FHIRAbstractModel, EntryReadFailure]]:
+        """
+        Asynchronously read a batch of references with a single batch bundle, resources in the cache are not
+        requested.
+        """
+        resources, missing = self._get_many_cached(references)
+        if not missing:
+            return resources
+        bundle, expired = self._get_many_bundle(references, missing)
+        r = await self._async_client().post(
+            self.api_address, content=json_bytes(bundle)
+        )
+        raise_for_bundle_status(r)
+        self._add_get_many_entries(resources, missing, references, r.json(), expired)
+        return resources
+
+    def _get_many_cached(
+        self, references: List[str]
+    ) -> Tuple[List[Union[FHIRAbstractModel, None]], List[int]]:
+        """
+        Look up the references in the cache, returns the list of cached resources (None where the resource is not
+        cached) and the indices of the references to read from the server.
+        """
+        resources = [self._get_cached(reference) for reference in references]
+        missing = [i for i, resource in enumerate(resources) if resource is None]
+        return resources, missing
+
+    def _get_many_bundle(
+        self, references: List[str], missing: List[int]
+    ) -> Tuple[Bundle, Dict[int, CacheEntry]]:
+        """
+        Batch bundle reading the missing references from the server. Expired resources in the cache are read
+        conditionally, returns the bundle and the cache entries of the conditional reads by index.
+        """
+        bundle = make_transaction_bundle(
+            method=TransactionMethod.GET,
+            transaction_type=TransactionType.BATCH,
+            references=[references[i] for i in missing],
+        )
+        expired = {}
+        if self.cache is None:
+            return bundle, expired
+        for i, entry in zip(missing, bundle.entry):
+            cached = self.cache.lookup(references[i])
+            if cached is not None and cached.etag:
+                entry.request.ifNoneMatch = cached.etag
+                expired[i] = cached
+        return bundle, expired
+
+    def _add_get_many_entries(
+        self,
+        resources: List[Union[FHIRAbstractModel, EntryReadFailure, None]],
+        missing: List[int],
+        references: List[str],
+        response_bundle: dict,
+        expired: Dict[int, CacheEntry],
+    ) -> None:
+        for i, entry in zip(missing, response_bundle.get("entry") or []):
+            entry_response = entry.get("response") or {}
+            status = entry_status(entry_response)
+            if i in expired and status == 304:
+                self.cache.revalidate(references[i], expired[i])
+                resource_dict = orjson.loads(expired[i].content)
+            elif status >= 400 or "resource" not in entry:
+                # e.g. 404 Not Found for resources that do not exist or were deleted
+                resources[i] = EntryReadFailure(
+                    references[i], status or None, entry_outcome(entry)
+                )
+                continue
+            else:
+                resource_dict = entry["resource"]
+                if self.cache is not None:
+                    content = json_bytes(json_dict=resource_dict)
+                    etag, last_modified = entry_validators(entry_response, content)
+                    self.cache.put(references[i], content, etag, last_modified)
+            resources[i] = construct_fhir_element(
+                resource_dict["resourceType"], resource_dict
+            )
+
+    def _invalidate_cached(
+        self,
+        resources: Union[List[Union[FHIRResourceModel, dict, Reference, str]], None],
+    ) -> None:
+        if self.cache is None or not resources:
+            return
+        for resource in resources:
+            self.cache.invalidate(resource)
+
+    def _get_meta_data(self) -> dict:
+        url = self.api_address + "/metadata"
+        r = self._sync_client().get(url)
+        try:
+            r.raise_for_status()
+        except Exception as e:
+            print(r.text)
+            raise e
+        return r.json()
+
+    def close(self) -> None:
+        """
+        Close the connection pool of the synchronous client. Pending connections of the asynchronous client can only be
+        closed via `aclose()`.
+        """
+        with self._client_lock:
+            client, self._client = self._client, None
+        if client is not None:
+            client.close()
+
+    async def aclose(self) -> None:
+        """
+        Close the connection pools of both the asynchronous and the synchronous client.
+        """
+        if self._aclient is not None:
+            await self._aclient.aclose()
+            self._aclient = None
+            self._aclient_loop = None
+        self.close()
+
+    def __enter__(self) -> "FhirServer":
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.close()
+
+    async def __aenter__(self) -> "FhirServer":
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb) -> None:
+        await self.aclose()
 
     def _sync_client(self) -> httpx.Client:
-        """Get a synchronous httpx client
+        """Get the synchronous httpx client of the server. The client is created on first use and reused for all
+        subsequent requests, until the server is closed. Changes to the auth or headers of the server are applied to
+        the existing client.
 
         Returns:
             _httpx.Client: synchronous httpx client
         """
-
-        transport = self._setup_transport()
-        client = httpx.Client(
-            headers=self.headers,
-            auth=self.auth,
-            proxies=self._proxies,
-            timeout=self._timeout,
-            transport=transport,
-        )
-        return client
+        settings = self._auth_settings()
+        with self._client_lock:
+            if self._client is None or self._client.is_closed:
+                self._client = httpx.Client(
+                    headers=self.headers,
+                    auth=self.auth,
+                    proxies=self._proxies,
+                    timeout=self._timeout,
+                    transport=self._setup_transport(),
+                )
+            elif settings != self._client_settings:
+                self._update_client_auth(self._client)
+            self._client_settings = settings
+            return self._client
 
     def _async_client(self) -> httpx.AsyncClient:
-        transport = self._setup_transport(async_transport=True)
-        client = httpx.AsyncClient(
-            headers=self.headers,
-            auth=self.auth,
-            proxies=self._proxies,
-            timeout=self._timeout,
-            transport=transport,
+        """Get the asynchronous httpx client of the server. The client is created on first use and reused as long as
+        it is used from the same event loop, pooled connections can not be shared between event loops. The client of
+        a previous event loop is closed when it is replaced. Changes to the auth or headers of the server are applied
+        to the existing client.
+
+        Returns:
+            httpx.AsyncClient: asynchronous httpx client
+        """
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            loop = None
+
+        settings = self._auth_settings()
+        with self._client_lock:
+            loop_changed = (
+                loop is not None
+                and self._aclient_loop is not None
+                and loop is not self._aclient_loop
+            )
+            if self._aclient is None or self._aclient.is_closed or loop_changed:
+                if loop_changed and not self._aclient.is_closed:
+                    self._close_stale_client(self._aclient, loop)
+                self._aclient = httpx.AsyncClient(
+                    headers=self.headers,
+                    auth=self.auth,
+                    proxies=self._proxies,
+                    timeout=self._timeout,
+                    transport=self._setup_transport(async_transport=True),
+                )
+                self._aclient_loop = loop
+            else:
+                if settings != self._aclient_settings:
+                    self._update_client_auth(self._aclient)
+                if self._aclient_loop is None:
+                    self._aclient_loop = loop
+            self._aclient_settings = settings
+            return self._aclient
+
+    def _auth_settings(self) -> tuple:
+        # everything the auth and headers of the clients are derived from, e.g. a refreshed oidc token
+        return (
+            tuple(self.headers.items()),
+            self._auth,
+            self.username,
+            self.password,
+            self.token,
         )
-        return client
+
+    def _update_client_auth(self, client: Union[httpx.Client, httpx.AsyncClient]):
+        # the client keeps its connection pool, only the auth and headers of the following requests change
+        client.headers = self.headers
+        client.auth = self.auth
+
+    def _close_stale_client(
+        self, client: httpx.AsyncClient, loop: asyncio.AbstractEventLoop
+    ) -> None:
+        """
+        Close the async client of a previous event loop from the current event loop, so its connection pool does not
+        leak. Connections bound to a loop that was already closed can not be shut down gracefully, they are dropped.
+        """
+
+        async def close():
+            try:
+                await client.aclose()
+            except RuntimeError:
+                pass
+
+        task = loop.create_task(close())
+        self._closing_clients.add(task)
+        task.add_done_callback(self._closing_clients.discard)
+
+    def _base_transport(
+        self, async_transport: bool = False
+    ) -> Union[httpx.AsyncHTTPTransport, httpx.HTTPTransport]:
+        """Create the connection pooling transport that performs the actual requests
+
+        Args:
+            async_transport: if True return an async transport
+        """
+        # without tls there is no protocol negotiation, http2 has to be used with prior knowledge
+        http1 = not (self.http2 and self.api_address.startswith("http://"))
+        if async_transport:
+            return httpx.AsyncHTTPTransport(
+                limits=self._limits, http1=http1, http2=self.http2
+            )
+        return httpx.HTTPTransport(limits=self._limits, http1=http1, http2=self.http2)
 
     def _setup_transport(
         self, async_transport: bool = False
-    ) -> Union[RetryTransport, httpx.AsyncHTTPTransport, httpx.HTTPTransport]:
+    ) -> Union[
+        CompressionTransport,
+        CacheRevalidationTransport,
+        RetryTransport,
+        HedgingTransport,
+        CircuitBreakerTransport,
+        RateLimitTransport,
+        httpx.AsyncHTTPTransport,
+        httpx.HTTPTransport,
+    ]:
         """Setup the transport for the httpx client if retryable methods or status codes are set
-        for the server the requests will be retried according to the configuration
+        for the server the requests will be retried according to the configuration. If request compression is enabled
+        the request bodies are compressed once, before any retries. Every attempt passes the rate limiter if one is
+        configured. While the circuit breaker is open the requests fail fast without being retried.
 
         Args:
             async_transport: if True return an async transport
         """
 
+        transport = self._base_transport(async_transport)
+        # limit every attempt, including retries
+        if self.rate_limiter is not None:
+            transport = RateLimitTransport(transport, self.rate_limiter)
+        # fail fast while the server is failing, before waiting for the rate limiter
+        if self.circuit_breaker is not None:
+            transport = CircuitBreakerTransport(transport, self.circuit_breaker)
+        # hedged requests pass the circuit breaker and rate limiter like any other request
+        if self.hedging is not None:
+            transport = HedgingTransport(transport, self.hedging)
         if self.retry_status_codes or self.retryable_methods:
-            return RetryTransport(
-                wrapped_transport=httpx.AsyncHTTPTransport()
-                if async_transport
-                else httpx.HTTPTransport(),
+            transport = RetryTransport(
+                wrapped_transport=transport,
                 max_attempts=self.max_attempts,
                 backoff_factor=self.backoff_factor,
                 retry_status_codes=self.retry_status_codes,
                 retryable_methods=self.retryable_methods,
                 jitter_ratio=self.jitter_ratio,
                 max_backoff_wait=self.max_backoff_wait,
+                retry_budget=self._retry_budget(),
             )
-        else:
-            return (
-                httpx.AsyncHTTPTransport() if async_transport else httpx.HTTPTransport()
+        # conditional reads of cached resources, wraps the retries so retried reads are conditional as well
+        if self.cache is not None:
+            transport = CacheRevalidationTransport(
+                transport, self.cache, self.api_address
             )
+        if self.compress_requests:
+            transport = CompressionTransport(
+                wrapped_transport=transport,
+                min_size=self.compression_min_size,
+                compression_level=self.compression_level,
+            )
+        return transport
+
+    def _retry_budget(self) -> Union[RetryBudget, None]:
+        # each client gets its own budget
+        if self.retry_budget_ratio is None:
+            return None
+        return RetryBudget(
+            ratio=self.retry_budget_ratio, min_retries=self.retry_budget_min_retries
+        )
 
     def _get_oidc_token(self):
         # get a new token if it is expired or not yet set
@@ -1029,3 +1934,10 @@ def _api_address_from_env() -> str:
     if not api_url:
         raise EnvironmentError("No FHIR api address specified")
     return FhirServer._validate_api_address(api_url)
+
+
+def _reference_strings(references: List[Union[str, Reference]]) -> List[str]:
+    return [
+        reference if isinstance(reference, str) else reference.reference
+        for reference in references
+    ]
@@ -1,5 +1,6 @@
 import json
-from typing import List
+import pathlib
+from typing import Dict, List, Union
 
 from fhir.resources.bundle import Bundle
 from fhir.resources.reference import Reference
@@ -35,6 +36,7 @@ class ResourceCreateResponse(CreateResponse):
             server_response_dict
         )
         self.location = location
+        self.version = version
         self.resource_id = resource_id
         self.resource.id = resource_id
         self.reference = Reference(
@@ -48,15 +50,141 @@ class ResourceCreateResponse(CreateResponse):
         )
 
 
+class BatchUploadFailure:
+    """
+    A batch of resources that could not be uploaded to the server.
+    """
+
+    batch_index: int
+    resources: list
+    error: Exception
+
+    def __init__(self, batch_index: int, resources: list, error: Exception):
+        self.batch_index = batch_index
+        self.resources = resources
+        self.error = error
+
+    def __repr__(self):
+        return (
+            f"<{self.__class__.__name__}(batch_index={self.batch_index}, n={len(self.resources)}, "
+            f"error={self.error!r})>"
+        )
+
+
+class EntryUploadFailure:
+    """
+    A resource of a batch that was rejected by the server, with the status and OperationOutcome of its entry.
+    """
+
+    batch_index: int
+    entry_index: int
+    resource: Union[Resource, dict]
+    status: Union[int, None]
+    outcome: Union[dict, None]
+
+    def __init__(
+        self,
+        batch_index: int,
+        entry_index: int,
+        resource: Union[Resource, dict],
+        status: int = None,
+        outcome: dict = None,
+    ):
+        self.batch_index = batch_index
+        self.entry_index = entry_index
+        self.resource = resource
+        self.status = status
+        self.outcome = outcome
+
+    @property
+    def diagnostics(self) -> str:
+        """Diagnostics of the issues in the OperationOutcome of the entry"""
+        return outcome_diagnostics(self.outcome)
+
+    def __repr__(self):
+        return (
+            f"<{self.__class__.__name__}(batch_index={self.batch_index}, entry_index={self.entry_index}, "
+            f"status={self.status}, diagnostics={self.diagnostics!r})>"
+        )
+
+
+class EntryReadFailure:
+    """
+    A reference of get_many that could not be read from the server, e.g. because the resource does not exist.
+    """
+
+    reference: str
+    status: Union[int, None]
+    outcome: Union[dict, None]
+
+    def __init__(self, reference: str, status: int = None, outcome: dict = None):
+        self.reference = reference
+        self.status = status
+        self.outcome = outcome
+
+    @property
+    def diagnostics(self) -> str:
+        """Diagnostics of the issues in the OperationOutcome of the entry"""
+        return outcome_diagnostics(self.outcome)
+
+    def __repr__(self):
+        return (
+            f"<{self.__class__.__name__}(reference={self.reference}, status={self.status}, "
+            f"diagnostics={self.diagnostics!r})>"
+        )
+
+
 class BundleCreateResponse:
     create_responses: List[ResourceCreateResponse] = None
+    failed_batches: List[BatchUploadFailure] = None
+    failed_entries: List[EntryUploadFailure] = None
+
+    def __init__(
+        self,
+        server_response: Response = None,
+        bundle: Bundle = None,
+        create_responses: List[ResourceCreateResponse] = None,
+        failed_batches: List[BatchUploadFailure] = None,
+        failed_entries: List[EntryUploadFailure] = None,
+    ):
+        self.create_responses = create_responses if create_responses else []
+        self.failed_batches = failed_batches if failed_batches else []
+        self.failed_entries = failed_entries if failed_entries else []
+        if server_response is not None:
+            for i, entry in enumerate(server_response.json()["entry"]):
+                resource = bundle.entry[i].resource
+                create_response = ResourceCreateResponse(entry["response"], resource)
+                self.create_responses.append(create_response)
 
-    def __init__(self, server_response: Response, bundle: Bundle):
-        self.create_responses = []
-        for i, entry in enumerate(server_response.json()["entry"]):
-            resource = bundle.entry[i].resource
-            create_response = ResourceCreateResponse(entry["response"], resource)
-            self.create_responses.append(create_response)
+    @classmethod
+    def from_batches(
+        cls,
+        responses: List[Union["BundleCreateResponse", BatchUploadFailure]],
+    ) -> "BundleCreateResponse":
+        """
+        Combine the responses of uploading multiple batches into a single response, keeping the order of the batches.
+
+        Args:
+            responses: ordered list of batch responses or failures
+
+        Returns:
+            BundleCreateResponse containing the create responses of all successful batches
+        """
+        create_responses = []
+        failed_batches = []
+        failed_entries = []
+        for response in responses:
+            if isinstance(response, BatchUploadFailure):
+                failed_batches.append(response)
+            else:
+                create_responses.extend(response.create_responses)
+                failed_batches.extend(response.failed_batches)
+                failed_entries.extend(response.failed_entries)
+        return cls(
+            create_responses=create_responses,
+            failed_batches=failed_batches,
+            failed_entries=failed_entries,
+        )
 
     @property
     def resources(self):
@@ -67,9 +195,18 @@ class BundleCreateResponse:
         return [r.reference for r in self.create_responses]
 
     def __repr__(self):
+        failed_repr = (
+            f", failed_batches={len(self.failed_batches)}"
+            if self.failed_batches
+            else ""
+        )
+        if self.failed_entries:
+            failed_repr += f", failed_entries={len(self.failed_entries)}"
+        if not self.create_responses:
+            return f"BundleCreateResponse(num_resources=0{failed_repr})"
         return (
             f"BundleCreateResponse(create_responses={self.create_responses[0]}...{self.create_responses[-1]}, "
-            f"num_resources={len(self.create_responses)})"
+            f"num_resources={len(self.create_responses)}{failed_repr})"
         )
 
 
@@ -110,6 +247,135 @@ class TransferResponse:
         )
 
 
+class BulkExportFile:
+    """
+    An NDJSON output file of a bulk data export.
+    """
+
+    resource_type: str
+    url: str
+    path: Union[pathlib.Path, None]
+    count: Union[int, None]
+    size: int
+
+    def __init__(
+        self,
+        resource_type: str,
+        url: str,
+        path: pathlib.Path = None,
+        count: int = None,
+        size: int = 0,
+    ):
+        self.resource_type = resource_type
+        self.url = url
+        self.path = path
+        self.count = count
+        self.size = size
+
+    def __repr__(self):
+        return (
+            f"<{self.__class__.__name__}(resource_type={self.resource_type}, path={self.path}, "
+            f"count={self.count})>"
+        )
+
+
+class BulkExportResponse:
+    """
+    Result of a bulk data export with the downloaded output files and error files of the export.
+    """
+
+    transaction_time: str
+    request: str
+    files: List[BulkExportFile]
+    errors: List[BulkExportFile]
+
+    def __init__(
+        self,
+        manifest: dict,
+        files: List[BulkExportFile],
+        errors: List[BulkExportFile] = None,
+    ):
+        self.manifest = manifest
+        self.transaction_time = manifest.get("transactionTime")
+        self.request = manifest.get("request")
+        self.files = files
+        self.errors = errors if errors else []
+
+    @property
+    def resource_counts(self) -> Dict[str, int]:
+        counts = {}
+        for file in self.files:
+            counts[file.resource_type] = counts.get(file.resource_type, 0) + (
+                file.count or 0
+            )
+        return counts
+
+    def __repr__(self):
+        return (
+            f"<{self.__class__.__name__}(transaction_time={self.transaction_time}, files={len(self.files)}, "
+            f"errors={len(self.errors)})>"
+        )
+
+
+class BulkLoadResponse:
+    """
+    Result of loading NDJSON files into a server with the number of uploaded resources and the throughput.
+    """
+
+    files: List[pathlib.Path]
+    n_resources: int
+    n_batches: int
+    failed_batches: List[BatchUploadFailure]
+    skipped_batches: int
+    elapsed: float
+
+    def __init__(
+        self,
+        files: List[pathlib.Path],
+        n_resources: int = 0,
+        n_batches: int = 0,
+        failed_batches: List[BatchUploadFailure] = None,
+        skipped_batches: int = 0,
+        elapsed: float = 0.0,
+    ):
+        self.files = files
+        self.n_resources = n_resources
+        self.n_batches = n_batches
+        self.failed_batches = failed_batches if failed_batches else []
+        self.skipped_batches = skipped_batches
+        self.elapsed = elapsed
+
+    @property
+    def resources_per_second(self) -> float:
+        return self.n_resources / self.elapsed if self.elapsed else 0.0
+
+    def __repr__(self):
+        return (
+            f"<{self.__class__.__name__}(files={len(self.files)}, n_resources={self.n_resources}, "
+            f"failed_batches={len(self.failed_batches)}, resources_per_second={self.resources_per_second:.1f})>"
+        )
+
+
+def outcome_diagnostics(outcome: Union[dict, None]) -> str:
+    """
+    Join the severity and diagnostics of the issues of an OperationOutcome into a single message.
+
+    Args:
+        outcome: json dictionary of the OperationOutcome
+
+    Returns:
+        the messages of the issues, an empty string if there are none
+    """
+    if not outcome:
+        return ""
+    messages = []
+    for issue in outcome.get("issue", []):
+        text = issue.get("diagnostics") or (issue.get("details") or {}).get("text")
+        if text:
+            messages.append(f"{issue.get('severity', 'error')}: {text}")
+    return "; ".join(messages)
+
+
 class UpdateResponse:
     # TODO: implement
     def __init__(self, server_response: Response):
@@ -236,6 +236,16 @@ def _get_transfer_resources(
     if missing_references:
         if get_missing:
             missing = source.get_many(missing_references)
+            not_found = [
+                reference
+                for reference, resource in zip(missing_references, missing)
+                if resource is None
+            ]
+            if not_found:
+                raise ValueError(
+                    f"Related resources of the resources to be transferred do not exist on the source server:\n"
+                    f"{not_found}"
+                )
             resources.extend(missing)
         else:
             raise ValueError(
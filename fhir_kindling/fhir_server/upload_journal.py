@@ -0,0 +1,227 @@
+import hashlib
+import pathlib
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from typing import Iterator, List, Optional, Union
+
+import orjson
+from fhir.resources import FHIRAbstractModel, construct_fhir_element
+
+from fhir_kindling.fhir_server.server_responses import (
+    BundleCreateResponse,
+    EntryUploadFailure,
+    ResourceCreateResponse,
+)
+
+
+class UploadJournal:
+    def __init__(self, path: Union[str, pathlib.Path]):
+        """
+        Checkpoint file of a batched upload that records the references returned for every completed batch in a
+        SQLite database. When an interrupted upload is run again with the same journal, the completed batches are
+        skipped and the upload continues with the first unfinished batch, so no resources are created twice. Entries
+        of a batch that failed with a temporary error e.g. 503 are recorded with their status and only these entries
+        are sent again when the upload is resumed.
+        A journal belongs to a single upload, batches are identified by their index and a fingerprint of their
+        resources, so the upload has to be repeated with the same resources and batch size.
+
+        Args:
+            path: path of the journal file, it is created if it does not exist
+        """
+        self.path = pathlib.Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        # batches are recorded from the worker threads of the upload
+        self._connection = sqlite3.connect(str(self.path), check_same_thread=False)
+        with self._lock, self._connection:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS batches ("
+                "batch_index INTEGER PRIMARY KEY, "
+                "fingerprint TEXT NOT NULL, "
+                "locations TEXT NOT NULL, "
+                "completed_at REAL NOT NULL)"
+            )
+
+    def completed(self, batch_index: int, fingerprint: str) -> Optional[List[str]]:
+        """
+        Look up a completed batch.
+
+        Args:
+            batch_index: index of the batch in the upload
+            fingerprint: fingerprint of the resources of the batch
+
+        Returns:
+            the locations {ResourceType}/{id}/_history/{version} returned for the resources of the batch, rejected
+            resources are recorded as dictionary of their status and outcome. None if the batch has not been
+            completed yet
+        """
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT fingerprint, locations FROM batches WHERE batch_index = ?",
+                (batch_index,),
+            ).fetchone()
+        if row is None:
+            return None
+        if row[0] != fingerprint:
+            raise ValueError(
+                f"Batch {batch_index} in the upload journal {self.path} was recorded for different resources, "
+                f"resume the upload with the same resources and batch size or use a new journal"
+            )
+        return orjson.loads(row[1])
+
+    def record(
+        self, batch_index: int, fingerprint: str, locations: List[Union[str, dict]]
+    ) -> None:
+        """
+        Record a completed batch, the batch is committed to the journal file before this method returns.
+
+        Args:
+            batch_index: index of the batch in the upload
+            fingerprint: fingerprint of the resources of the batch
+            locations: locations or references of the resources created by the batch
+        """
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO batches VALUES (?, ?, ?, ?)",
+                (batch_index, fingerprint, orjson.dumps(locations), time.time()),
+            )
+
+    def completed_response(
+        self, batch_index: int, fingerprint: str, resources: list
+    ) -> Optional[BundleCreateResponse]:
+        """
+        Create the response of a batch from the journal if it has been completed.
+
+        Args:
+            batch_index: index of the batch in the upload
+            fingerprint: fingerprint of the resources of the batch
+            resources: the resources of the batch
+
+        Returns:
+            BundleCreateResponse with the recorded ids of the resources and the recorded failed entries, None if the
+            batch has not been uploaded yet
+        """
+        locations = self.completed(batch_index, fingerprint)
+        if locations is None:
+            return None
+        create_responses = []
+        failed_entries = []
+        for entry_index, (location, resource) in enumerate(zip(locations, resources)):
+            if isinstance(location, dict):
+                failed_entries.append(
+                    EntryUploadFailure(batch_index, entry_index, resource, **location)
+                )
+                continue
+            if isinstance(resource, dict):
+                resource = construct_fhir_element(
+                    resource.get("resourceType"), resource
+                )
+            else:
+                resource = resource.copy()
+            create_responses.append(
+                ResourceCreateResponse({"location": location}, resource)
+            )
+        return BundleCreateResponse(
+            create_responses=create_responses, failed_entries=failed_entries
+        )
+
+    def record_response(
+        self, batch_index: int, fingerprint: str, response: BundleCreateResponse
+    ) -> None:
+        """
+        Record the response of a completed batch, rejected resources are recorded with their status and outcome.
+        """
+        failed = {f.entry_index: f for f in response.failed_entries}
+        created = iter(response.create_responses)
+        locations = []
+        for entry_index in range(len(response.create_responses) + len(failed)):
+            failure = failed.get(entry_index)
+            if failure is not None:
+                locations.append({"status": failure.status, "outcome": failure.outcome})
+            else:
+                r = next(created)
+                locations.append(f"{r.location}/_history/{r.version}")
+        self.record(batch_index, fingerprint, locations)
+
+    @property
+    def references(self) -> List[str]:
+        """References {ResourceType}/{id} of all resources recorded in the journal, in the order of the batches"""
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT locations FROM batches ORDER BY batch_index"
+            ).fetchall()
+        return [
+            "/".join(location.split("/")[:2])
+            for row in rows
+            for location in orjson.loads(row[0])
+            if isinstance(location, str)
+        ]
+
+    def clear(self) -> None:
+        """Remove all recorded batches, e.g. to repeat an upload from the start"""
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM batches")
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+
+    def __enter__(self) -> "UploadJournal":
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.close()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._connection.execute("SELECT COUNT(*) FROM batches").fetchone()[
+                0
+            ]
+
+    def __repr__(self):
+        return f"<UploadJournal(path={self.path}, batches={len(self)})>"
+
+
+def batch_fingerprint(
+    resources: List[Union[FHIRAbstractModel, dict]], ignore_ids: bool = False
+) -> str:
+    """
+    Fingerprint of the content of a batch of resources, to detect whether a journal was recorded for the same batch.
+
+    Args:
+        resources: the resources of the batch
+        ignore_ids: exclude the ids of the resources, for uploads that create the resources with new ids
+
+    Returns:
+        hex digest of the resources
+    """
+    digest = hashlib.sha256()
+    exclude = {"id"} if ignore_ids else None
+    for resource in resources:
+        if isinstance(resource, dict):
+            if ignore_ids:
+                resource = {k: v for k, v in resource.items() if k != "id"}
+            digest.update(orjson.dumps(resource))
+        else:
+            digest.update(
+                resource.json(exclude=exclude, exclude_none=True, return_bytes=True)
+            )
+        digest.update(b"\n")
+    return digest.hexdigest()
+
+
+@contextmanager
+def open_journal(
+    journal: Union[str, pathlib.Path, UploadJournal, None]
+) -> Iterator[Optional[UploadJournal]]:
+    """
+    Open the journal of an upload given as path or journal instance, journals opened from a path are closed when the
+    upload is done.
+    """
+    if journal is None or isinstance(journal, UploadJournal):
+        yield journal
+        return
+    with UploadJournal(journal) as upload_journal:
+        yield upload_journal
@@ -13,3 +13,23 @@ def json_dict(
         return d
     elif json_dict:
         return orjson.loads(orjson.dumps(json_dict))
+
+
+def json_bytes(
+    resource: Union[Resource, FHIRAbstractModel] = None, json_dict: dict = None
+) -> bytes:
+    """
+    Serialize a resource or a json dictionary to json encoded bytes in a single pass, to be used as the content of a
+    request.
+
+    Args:
+        resource: the resource to serialize
+        json_dict: dictionary to serialize
+
+    Returns:
+        json encoded bytes
+    """
+    if resource:
+        return resource.json(exclude_none=True, return_bytes=True)
+    elif json_dict:
+        return orjson.dumps(json_dict)
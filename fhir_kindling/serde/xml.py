@@ -0,0 +1,123 @@
+from typing import BinaryIO, List, Optional
+from xml.parsers import expat
+
+
+class XmlBundlePage:
+    """
+    Byte ranges of a single page of search results in xml format. Only the top level entries and the next link of the
+    bundle are located, the content of the entries is not parsed.
+    """
+
+    def __init__(self, content: bytes):
+        self.content = content
+        self.entries: List[bytes] = []
+        self.next_url: Optional[str] = None
+        self._first_entry_start: Optional[int] = None
+        self._bundle_end: Optional[int] = None
+        self._scan()
+
+    @property
+    def prefix(self) -> bytes:
+        """Bundle content before the first entry, e.g. the xml declaration, id, type, total and links"""
+        end = self._first_entry_start
+        if end is None:
+            end = self._bundle_end
+        return self.content[:end]
+
+    @property
+    def suffix(self) -> bytes:
+        """Closing tag of the bundle and anything following it"""
+        return self.content[self._bundle_end :]
+
+    def _scan(self):
+        self._parser = expat.ParserCreate()
+        self._parser.buffer_text = True
+        self._parser.StartElementHandler = self._start_element
+        self._parser.EndElementHandler = self._end_element
+        self._depth = 0
+        self._entry_start = None
+        self._link = {}
+        self._parser.Parse(self.content, True)
+        self._parser = None
+        if self._bundle_end is None:
+            raise ValueError("Xml content does not contain a bundle")
+
+    def _start_element(self, name: str, attrs: dict):
+        self._depth += 1
+        tag = _local_name(name)
+        if self._depth == 2 and tag == "entry":
+            self._entry_start = self._parser.CurrentByteIndex
+            if self._first_entry_start is None:
+                self._first_entry_start = self._entry_start
+        elif self._depth == 2 and tag == "link":
+            self._link = {}
+        elif self._depth == 3 and tag in ("relation", "url"):
+            self._link[tag] = attrs.get("value")
+
+    def _end_element(self, name: str):
+        tag = _local_name(name)
+        index = self._parser.CurrentByteIndex
+        if self._depth == 1:
+            self._bundle_end = index
+        elif self._depth == 2 and tag == "entry":
+            # the byte index points to the start of the end tag
+            end = self.content.index(b">", index) + 1
+            self.entries.append(self.content[self._entry_start : end])
+        elif self._depth == 2 and tag == "link":
+            if self._link.get("relation") == "next":
+                self.next_url = self._link.get("url")
+        self._depth -= 1
+
+
+class XmlBundleWriter:
+    """
+    Writes the entries of consecutive pages of search results into a single xml bundle. The header of the first page
+    is written as is, followed by the raw entries of all pages and the closing tag of the bundle.
+    """
+
+    def __init__(self, file: BinaryIO, limit: int = None):
+        self.file = file
+        self.limit = limit
+        self.n_entries = 0
+        self._suffix: Optional[bytes] = None
+
+    def write_page(self, page: XmlBundlePage) -> bool:
+        """
+        Append the entries of a page to the output.
+
+        Args:
+            page: the page of search results
+
+        Returns:
+            True if the entries of further pages should be written, False if the page was empty or the limit is
+            reached
+        """
+        if self._suffix is None:
+            self.file.write(page.prefix)
+            self._suffix = page.suffix
+        entries = page.entries
+        if self.limit is not None:
+            entries = entries[: self.limit - self.n_entries]
+        for entry in entries:
+            if self.n_entries:
+                self.file.write(b"\n    ")
+            self.file.write(entry)
+            self.n_entries += 1
+
+        if not entries:
+            return False
+        return self.limit is None or self.n_entries < self.limit
+
+    def close(self):
+        """Write the closing tag of the bundle"""
+        if self._suffix is None:
+            return
+        if self.n_entries:
+            self.file.write(b"\n")
+        self.file.write(self._suffix)
+        self._suffix = None
+
+
+def _local_name(name: str) -> str:
+    # strip namespace prefixes e.g. fhir:entry -> entry
+    return name.rsplit(":", 1)[-1]
@@ -1,5 +1,6 @@
 import os
 
+import httpx
 import pytest
 from dotenv import find_dotenv, load_dotenv
 
@@ -25,3 +26,19 @@ def fhir_server(api_url):
         oidc_provider_url=os.getenv("OIDC_PROVIDER_URL"),
     )
     return server
+
+
+@pytest.fixture
+def mock_fhir_server():
+    """
+    Factory for servers whose requests are answered in-process by the given handler instead of a real FHIR server
+    """
+
+    def _make_server(handler, **kwargs) -> FhirServer:
+        server = FhirServer(api_address="http://fhir.test/fhir", **kwargs)
+        server._base_transport = lambda async_transport=False: httpx.MockTransport(
+            handler
+        )
+        return server
+
+    return _make_server
@@ -1,10 +1,14 @@
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 from zoneinfo import ZoneInfo
 
 from fhir_kindling.util.date_utils import (
     convert_to_local_datetime,
     parse_datetime,
+    retry_after_seconds,
+    split_time_range,
+    to_http_date,
     to_iso_string,
+    to_search_string,
 )
 
 
@@ -42,3 +46,35 @@ def test_convert_to_local_datetime():
     assert local_date.day == utc_now.day
     assert local_date.hour == utc_now.hour
     assert local_date.minute == utc_now.minute
+
+
+def test_split_time_range():
+    start = datetime(2021, 1, 1, tzinfo=timezone.utc)
+    end = datetime(2021, 1, 1, 0, 0, 10, tzinfo=timezone.utc)
+    windows = split_time_range(start, end, 3)
+
+    assert len(windows) == 3
+    assert windows[0][0] == start
+    assert windows[-1][1] == end
+    for (_, window_end), (window_start, _) in zip(windows[:-1], windows[1:]):
+        assert window_end == window_start
+        assert window_end.microsecond == 0
+
+    assert to_search_string(start) == "2021-01-01T00:00:00Z"
+
+
+def test_to_http_date():
+    assert to_http_date("2023-01-02T03:04:05.123Z") == "Mon, 02 Jan 2023 03:04:05 GMT"
+    assert to_http_date("2023-01-02T03:04:05+02:00") == "Mon, 02 Jan 2023 01:04:05 GMT"
+    assert to_http_date(datetime(2023, 1, 2)) == "Mon, 02 Jan 2023 00:00:00 GMT"
+
+
+def test_retry_after_seconds():
+    assert retry_after_seconds({}) is None
+    assert retry_after_seconds({"Retry-After": "120"}) == 120
+    assert retry_after_seconds({"Retry-After": "soon"}) is None
+
+    # http dates as sent by servers, in the past and in the future
+    assert retry_after_seconds({"Retry-After": "Wed, 21 Oct 2015 07:28:00 GMT"}) == 0
+    retry_date = to_http_date(datetime.now(timezone.utc) + timedelta(seconds=30))
+    assert 25 < retry_after_seconds({"Retry-After": retry_date}) <= 30
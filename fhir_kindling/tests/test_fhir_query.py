@@ -1,6 +1,11 @@
+import asyncio
 import json
 import os
+import threading
+import time
+from datetime import datetime, timedelta, timezone
 
+import httpx
 import pytest
 import xmltodict
 from dotenv import find_dotenv, load_dotenv
@@ -39,6 +44,49 @@ def server(api_url):
     return server
 
 
+def _paged_patients_handler(n: int, requests: list = None, include: bool = False):
+    """
+    Request handler that serves n patients in pages of _count entries, linked via _offset based next links. With
+    include every page contains the organization of the patients as an additional entry, like _include does.
+    """
+    patients = [{"resourceType": "Patient", "id": str(i)} for i in range(n)]
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        if requests is not None:
+            requests.append(request)
+        params = request.url.params
+        if params.get("_summary") == "count":
+            return httpx.Response(
+                200, json={"resourceType": "Bundle", "type": "searchset", "total": n}
+            )
+        count = int(params.get("_count", 50))
+        offset = int(params.get("_offset", 0))
+        links = [{"relation": "self", "url": str(request.url)}]
+        if offset + count < n:
+            next_url = request.url.copy_merge_params({"_offset": offset + count})
+            links.append({"relation": "next", "url": str(next_url)})
+        bundle = {
+            "resourceType": "Bundle",
+            "type": "searchset",
+            "total": n,
+            "link": links,
+            "entry": [
+                {"resource": patient, "search": {"mode": "match"}}
+                for patient in patients[offset : offset + count]
+            ],
+        }
+        if include:
+            bundle["entry"].append(
+                {
+                    "resource": {"resourceType": "Organization", "id": "org"},
+                    "search": {"mode": "include"},
+                }
+            )
+        return httpx.Response(200, json=bundle)
+
+    return handler
+
+
 @pytest.fixture
 def paginated_xml():
     return """<?xml version="1.0" encoding="UTF-8"?>
@@ -1752,3 +1800,388 @@ async def test_query_count_async(server):
     count = await server.query_async("Patient").count()
     print(count)
     assert count > 0
+
+
+def test_query_iter_pages(mock_fhir_server):
+    requests = []
+    server = mock_fhir_server(_paged_patients_handler(25, requests))
+
+    pages = list(server.query("Patient").iter_pages(count=10))
+    assert [len(page) for page in pages] == [10, 10, 5]
+    assert len(requests) == 3
+
+    requests.clear()
+    pages = list(server.query("Patient").iter_pages(limit=15, count=10))
+    assert [len(page) for page in pages] == [10, 5]
+    assert len(requests) == 2
+
+    patients = list(server.query("Patient").iter_resources(count=10))
+    assert [p.id for p in patients] == [str(i) for i in range(25)]
+
+    response = server.query("Patient").all(count=10)
+    assert len(response.resources) == 25
+    response = server.query("Patient").limit(12, count=5)
+    assert len(response.resources) == 12
+
+
+@pytest.mark.asyncio
+async def test_query_stream_prefetch(mock_fhir_server):
+    requests = []
+    paged_handler = _paged_patients_handler(50, requests)
+
+    async def handler(request: httpx.Request) -> httpx.Response:
+        await asyncio.sleep(0.005)
+        return paged_handler(request)
+
+    server = mock_fhir_server(handler)
+
+    page_sizes = []
+    async for entries in server.query_async("Patient").stream(count=10, prefetch=2):
+        page_sizes.append(len(entries))
+        # while the page is processed the following pages are fetched in the background
+        await asyncio.sleep(0.05)
+        assert len(requests) == min(len(page_sizes) + 2, 5)
+    assert page_sizes == [10] * 5
+
+    requests.clear()
+    query = server.query_async("Patient")
+    patients = [p async for p in query.iter_resources(limit=25, count=10)]
+    assert [p.id for p in patients] == [str(i) for i in range(25)]
+    assert len(requests) == 3
+
+    response = await server.query_async("Patient").all(count=10)
+    assert len(response.resources) == 50
+    await server.aclose()
+
+
+def test_query_parallel_offset_pages(mock_fhir_server):
+    lock = threading.Lock()
+    requests = []
+    in_flight = 0
+    max_in_flight = 0
+    paged_handler = _paged_patients_handler(95, requests)
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        nonlocal in_flight, max_in_flight
+        with lock:
+            in_flight += 1
+            max_in_flight = max(max_in_flight, in_flight)
+        time.sleep(0.01)
+        with lock:
+            in_flight -= 1
+        return paged_handler(request)
+
+    server = mock_fhir_server(handler)
+    pages = []
+    response = server.query("Patient").all(
+        count=10, parallel=True, max_concurrency=3, page_callback=pages.append
+    )
+
+    assert [r.id for r in response.resources] == [str(i) for i in range(95)]
+    assert sorted(len(page) for page in pages) == [5] + [10] * 9
+    # count request, first page and the 9 remaining pages fetched by offset
+    assert len(requests) == 11
+    assert 1 < max_in_flight <= 3
+
+
+def _slow_page_handler(handler, failing: bool = False):
+    # the page at offset 10 is answered last, or fails
+    slow_page_done = threading.Event()
+
+    def slow_handler(request: httpx.Request) -> httpx.Response:
+        if request.url.params.get("_offset") == "10":
+            if failing:
+                return httpx.Response(500)
+            time.sleep(0.2)
+            slow_page_done.set()
+        return handler(request)
+
+    return slow_handler, slow_page_done
+
+
+def test_query_parallel_offset_pages_callback(mock_fhir_server):
+    handler, slow_page_done = _slow_page_handler(_paged_patients_handler(95))
+    server = mock_fhir_server(handler)
+    # the callback is called for each page as it arrives instead of once all pages are fetched
+    before_slow_page = []
+    response = server.query("Patient").all(
+        count=10,
+        parallel=True,
+        page_callback=lambda: before_slow_page.append(not slow_page_done.is_set()),
+    )
+    assert len(response.resources) == 95
+    assert len(before_slow_page) == 10
+    assert sum(before_slow_page) > 1
+
+    # the remaining pages are not requested once a page failed
+    requests = []
+    handler, _ = _slow_page_handler(_paged_patients_handler(95, requests), failing=True)
+    server = mock_fhir_server(handler)
+    with pytest.raises(httpx.HTTPStatusError):
+        server.query("Patient").all(count=10, parallel=True, max_concurrency=1)
+    assert len(requests) < 10
+
+
+def test_query_parallel_offset_pages_include(mock_fhir_server):
+    requests = []
+    server = mock_fhir_server(_paged_patients_handler(95, requests, include=True))
+    response = (
+        server.query("Patient")
+        .include(resource="Patient", reference_param="organization")
+        .all(count=10, parallel=True)
+    )
+
+    # pages hold 11 entries, the offsets still advance by the 10 matches per page
+    patients = [r.id for r in response.resources if r.resource_type == "Patient"]
+    assert patients == [str(i) for i in range(95)]
+    assert len(requests) == 11
+
+
+@pytest.mark.asyncio
+async def test_query_parallel_offset_pages_async(mock_fhir_server):
+    requests = []
+    server = mock_fhir_server(_paged_patients_handler(95, requests))
+    query = server.query_async("Patient")
+    response = await query.all(count=10, parallel=True, max_concurrency=3)
+
+    assert [r.id for r in response.resources] == [str(i) for i in range(95)]
+    assert len(requests) == 11
+
+    paged_handler = _paged_patients_handler(95)
+    slow_page_done = asyncio.Event()
+
+    async def handler(request: httpx.Request) -> httpx.Response:
+        if request.url.params.get("_offset") == "10":
+            await asyncio.sleep(0.2)
+            slow_page_done.set()
+        return paged_handler(request)
+
+    server = mock_fhir_server(handler)
+    before_slow_page = []
+    response = await server.query_async("Patient").all(
+        count=10,
+        parallel=True,
+        page_callback=lambda: before_slow_page.append(not slow_page_done.is_set()),
+    )
+    assert len(response.resources) == 95
+    assert sum(before_slow_page) > 1
+
+    requests = []
+    failing_handler, _ = _slow_page_handler(
+        _paged_patients_handler(95, requests), failing=True
+    )
+
+    async def handler(request: httpx.Request) -> httpx.Response:
+        await asyncio.sleep(0.01)
+        return failing_handler(request)
+
+    server = mock_fhir_server(handler)
+    with pytest.raises(httpx.HTTPStatusError):
+        await server.query_async("Patient").all(
+            count=10, parallel=True, max_concurrency=1
+        )
+    assert len(requests) < 10
+    await server.aclose()
+
+
+def test_query_partitioned(mock_fhir_server):
+    start = datetime(2021, 1, 1, tzinfo=timezone.utc)
+    patients = [
+        {
+            "resourceType": "Patient",
+            "id": str(i),
+            "meta": {"lastUpdated": (start + timedelta(hours=i)).isoformat()},
+            "managingOrganization": {"reference": "Organization/org"},
+        }
+        for i in range(48)
+    ]
+    organization = {"resourceType": "Organization", "id": "org"}
+    windows = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        bounds = {
+            value[:2]: datetime.fromisoformat(value[2:].replace("Z", "+00:00"))
+            for value in request.url.params.get_list("_lastUpdated")
+        }
+        windows.append(bounds)
+        matches = [
+            p
+            for p in patients
+            if bounds["ge"]
+            <= datetime.fromisoformat(p["meta"]["lastUpdated"])
+            < bounds["lt"]
+        ]
+        entries = [{"resource": p, "search": {"mode": "match"}} for p in matches]
+        entries.append({"resource": organization, "search": {"mode": "include"}})
+        return httpx.Response(
+            200, json={"resourceType": "Bundle", "type": "searchset", "entry": entries}
+        )
+
+    server = mock_fhir_server(handler)
+    query = server.query("Patient").include(
+        resource="Patient", reference_param="organization"
+    )
+    response = query.all_partitioned(
+        start=start, end=start + timedelta(days=2), partitions=4
+    )
+
+    assert len(windows) == 4
+    assert windows[0]["ge"] == start
+    assert windows[1]["ge"] == windows[0]["lt"]
+    assert sorted(int(p.id) for p in response.resources) == list(range(48))
+    assert len(response.included_resources[0].resources) == 1
+
+
+def test_query_lazy_response(mock_fhir_server):
+    encounters = [
+        {
+            "resourceType": "Encounter",
+            "id": str(i),
+            "status": "finished",
+            "class": {"code": "AMB"},
+            "subject": {"reference": "Patient/p"},
+        }
+        for i in range(3)
+    ]
+    patient = {"resourceType": "Patient", "id": "p", "birthDate": "yesterday"}
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        entries = [{"resource": e, "search": {"mode": "match"}} for e in encounters]
+        entries.append({"resource": patient, "search": {"mode": "include"}})
+        return httpx.Response(
+            200, json={"resourceType": "Bundle", "type": "searchset", "entry": entries}
+        )
+
+    server = mock_fhir_server(handler)
+    query = server.query("Encounter").include(
+        resource="Encounter", reference_param="subject"
+    )
+    response = query.lazy().all()
+
+    assert response.raw_resources == encounters
+    assert len(response.resources) == 3
+    assert response.resources._parsed == [None, None, None]
+    encounter = response.resources[1]
+    assert encounter.id == "1"
+    assert encounter.class_fhir["code"] == "AMB"
+    assert response.resources._parsed[0] is None
+    assert response.resources[1] is encounter
+
+    # the invalid included patient is only detected when validating
+    assert response.included_resources[0].resources[0].birthDate == "yesterday"
+    assert len(response.resource_list) == 4
+    with pytest.raises(ValidationError):
+        response.validate(sample=10)
+
+    response = query.lazy(validate=True).all()
+    assert response.resources[0].class_fhir.code == "AMB"
+    with pytest.raises(ValidationError):
+        response.included_resources[0].resources[0]
+
+
+def test_query_response_entry_index(mock_fhir_server):
+    def handler(request: httpx.Request) -> httpx.Response:
+        entries = [
+            {"resource": {"resourceType": "Patient", "id": str(i)}} for i in range(4)
+        ]
+        entries.append(
+            {
+                "resource": {"resourceType": "Organization", "id": "o"},
+                "search": {"mode": "include"},
+            }
+        )
+        entries.append(
+            {
+                "resource": {"resourceType": "OperationOutcome", "id": "w"},
+                "search": {"mode": "outcome"},
+            }
+        )
+        return httpx.Response(
+            200, json={"resourceType": "Bundle", "type": "searchset", "entry": entries}
+        )
+
+    server = mock_fhir_server(handler)
+    response = (
+        server.query("Patient")
+        .include(resource="Patient", reference_param="organization")
+        .all()
+    )
+
+    assert response.resource_counts == {"Patient": 4, "Organization": 1}
+    assert response.total == 5
+    # counting does not parse the resources
+    assert response._resources is None
+    assert len(response.resource_list) == 5
+    assert len(response.resource_list) == 5
+    assert len(response.resources) == 4
+    assert response.included_resources[0].resources[0].id == "o"
+    assert response.resources is response.resources
+
+
+def _paged_xml_patients_handler(n: int, requests: list = None):
+    """
+    Request handler that serves n patients as xml bundles in pages of _count entries
+    """
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        if requests is not None:
+            requests.append(request)
+        params = request.url.params
+        count = int(params.get("_count", 50))
+        offset = int(params.get("_offset", 0))
+        links = ""
+        if offset + count < n:
+            next_url = request.url.copy_merge_params({"_offset": offset + count})
+            links = (
+                '<link><relation value="next"/>'
+                f'<url value="{str(next_url).replace("&", "&amp;")}"/></link>'
+            )
+        entries = "".join(
+            f'<entry><resource><Patient><id value="{i}"/></Patient></resource></entry>'
+            for i in range(offset, min(offset + count, n))
+        )
+        content = (
+            '<?xml version="1.0" encoding="UTF-8"?>'
+            f'<Bundle xmlns="http://hl7.org/fhir"><type value="searchset"/>'
+            f"{links}{entries}</Bundle>"
+        )
+        return httpx.Response(200, content=content.encode())
+
+    return handler
+
+
+def test_query_xml_pagination_streamed(mock_fhir_server, tmp_path):
+    requests = []
+    server = mock_fhir_server(_paged_xml_patients_handler(25, requests))
+
+    response = server.query("Patient", output_format="xml").all(count=10)
+    bundle = xmltodict.parse(response.response)["Bundle"]
+    assert [e["resource"]["Patient"]["id"]["@value"] for e in bundle["entry"]] == [
+        str(i) for i in range(25)
+    ]
+    assert len(requests) == 3
+
+    requests.clear()
+    file_path = tmp_path / "patients.xml"
+    query = server.query("Patient", output_format="xml")
+    assert query.write_xml(file_path, limit=15, count=10) == 15
+    assert len(requests) == 2
+    bundle = xmltodict.parse(file_path.read_bytes())["Bundle"]
+    assert len(bundle["entry"]) == 15
+    assert bundle["link"]["relation"]["@value"] == "next"
+
+    with pytest.raises(ValueError):
+        server.query("Patient").write_xml(file_path)
+
+    empty = mock_fhir_server(_paged_xml_patients_handler(0))
+    response = empty.query("Patient", output_format="xml").all()
+    assert "entry" not in xmltodict.parse(response.response)["Bundle"]
+
+
+@pytest.mark.asyncio
+async def test_query_async_xml_pagination_streamed(mock_fhir_server):
+    server = mock_fhir_server(_paged_xml_patients_handler(25))
+    query = server.query_async("Patient", output_format="xml")
+    response = await query.limit(22, count=10)
+    bundle = xmltodict.parse(response.response)["Bundle"]
+    assert len(bundle["entry"]) == 22
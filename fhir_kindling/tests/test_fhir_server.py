@@ -1,6 +1,14 @@
+import asyncio
+import gzip
 import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from unittest import mock
 
+import httpx
+import orjson
 import pytest
 from dotenv import find_dotenv, load_dotenv
 from fhir.resources import FHIRAbstractModel
@@ -13,8 +21,18 @@ from httpx import BasicAuth, HTTPStatusError
 
 from fhir_kindling import FhirQuerySync, FhirServer
 from fhir_kindling.fhir_query import FhirQueryParameters
+from fhir_kindling.fhir_server.bulk_export import BulkExportError
+from fhir_kindling.fhir_server.capabilities import CapabilityCache
+from fhir_kindling.fhir_server.server_responses import (
+    BatchUploadFailure,
+    EntryReadFailure,
+)
+from fhir_kindling.fhir_server.transactions import make_transaction_bundle
+from fhir_kindling.fhir_server.upload_journal import UploadJournal
 from fhir_kindling.generators import PatientGenerator
-from fhir_kindling.serde.json import json_dict
+from fhir_kindling.serde.json import json_bytes, json_dict
+from fhir_kindling.util.resource_cache import ResourceCache
+from fhir_kindling.util.retry_transport import RetryTransport
 
 
 @pytest.fixture
@@ -50,6 +68,32 @@ def fhir_server(api_url):
     return server
 
 
+def _transaction_response(request: httpx.Request) -> httpx.Response:
+    """
+    Answer a transaction bundle like a FHIR server by assigning consecutive ids to the posted resources
+    """
+    bundle = orjson.loads(request.content)
+    entries = []
+    for i, entry in enumerate(bundle["entry"]):
+        resource_type = entry["resource"]["resourceType"]
+        entries.append(
+            {
+                "response": {
+                    "status": "201 Created",
+                    "location": f"{resource_type}/{i}/_history/1",
+                }
+            }
+        )
+    return httpx.Response(
+        200,
+        json={
+            "resourceType": "Bundle",
+            "type": "transaction-response",
+            "entry": entries,
+        },
+    )
+
+
 @pytest.fixture
 def org_bundle(api_url):
     bundle = Bundle.construct()
@@ -712,3 +756,1333 @@ async def test_delete_async(fhir_server: FhirServer):
         await fhir_server.delete_async(references=["asd"], query=["asd"])
 
     # todo test delete with query and patients with specific attributes
+
+
+def test_server_pooled_clients(mock_fhir_server):
+    def handler(request: httpx.Request) -> httpx.Response:
+        return httpx.Response(200, json={"resourceType": "Patient", "id": "1"})
+
+    server = mock_fhir_server(handler, max_connections=10, keepalive_expiry=30)
+    client = server._sync_client()
+    server.get("Patient/1")
+    server.get("Patient/1")
+    assert server._sync_client() is client
+    assert server.query("Patient").client is client
+
+    with server:
+        server.get("Patient/1")
+    assert client.is_closed
+    assert server._sync_client() is not client
+    server.close()
+
+
+def test_server_client_created_once(mock_fhir_server):
+    server = mock_fhir_server(lambda request: httpx.Response(200))
+    setup_transport = server._setup_transport
+    created = []
+
+    def slow_setup_transport(async_transport: bool = False):
+        created.append(async_transport)
+        time.sleep(0.05)
+        return setup_transport(async_transport)
+
+    server._setup_transport = slow_setup_transport
+    # threads requesting the client at the same time share a single client and connection pool
+    barrier = threading.Barrier(8)
+
+    def get_client(_) -> httpx.Client:
+        barrier.wait()
+        return server._sync_client()
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        clients = list(executor.map(get_client, range(8)))
+    assert all(client is clients[0] for client in clients)
+    assert created == [False]
+    server.close()
+
+
+def test_server_client_auth_changes(mock_fhir_server):
+    requests = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        requests.append(request)
+        return httpx.Response(200, json={"resourceType": "Patient", "id": "1"})
+
+    server = mock_fhir_server(handler, token="first")
+    client = server._sync_client()
+    server.get("Patient/1")
+    assert requests[-1].headers["Authorization"] == "Bearer first"
+
+    # e.g. a refreshed token or changed headers are used by the existing client and the queries sharing it
+    server.token = "second"
+    server._headers = {"X-Request-Source": "test"}
+    server.get("Patient/1")
+    assert requests[-1].headers["Authorization"] == "Bearer second"
+    assert requests[-1].headers["X-Request-Source"] == "test"
+    assert server._sync_client() is client
+
+    async def get_async():
+        await server.get_async("Patient/1")
+        server.token = "third"
+        await server.get_async("Patient/1")
+        await server.aclose()
+
+    asyncio.run(get_async())
+    assert [r.headers["Authorization"] for r in requests[-2:]] == [
+        "Bearer second",
+        "Bearer third",
+    ]
+
+
+def test_server_async_client_loop_changed(mock_fhir_server):
+    server = mock_fhir_server(lambda request: httpx.Response(200))
+
+    async def get_client() -> httpx.AsyncClient:
+        client = server._async_client()
+        await client.get("http://fhir.test/fhir/metadata")
+        # give the close of a replaced client a chance to run
+        await asyncio.sleep(0.01)
+        return client
+
+    first = asyncio.run(get_client())
+    second = asyncio.run(get_client())
+    # the client of the previous event loop is closed once it is replaced
+    assert second is not first
+    assert first.is_closed
+    assert not second.is_closed
+
+
+@pytest.mark.asyncio
+async def test_server_pooled_clients_async(mock_fhir_server):
+    def handler(request: httpx.Request) -> httpx.Response:
+        return httpx.Response(200, json={"resourceType": "Patient", "id": "1"})
+
+    async with mock_fhir_server(handler) as server:
+        client = server._async_client()
+        await server.get_async("Patient/1")
+        await server.get_async("Patient/1")
+        assert server._async_client() is client
+        assert server.query_async("Patient").client is client
+    assert client.is_closed
+
+
+@pytest.mark.asyncio
+async def test_add_all_async_concurrent(mock_fhir_server):
+    in_flight = 0
+    max_in_flight = 0
+
+    async def handler(request: httpx.Request) -> httpx.Response:
+        nonlocal in_flight, max_in_flight
+        in_flight += 1
+        max_in_flight = max(max_in_flight, in_flight)
+        await asyncio.sleep(0.02)
+        in_flight -= 1
+        if b"fail" in request.content:
+            return httpx.Response(500, json={"resourceType": "OperationOutcome"})
+        return _transaction_response(request)
+
+    server = mock_fhir_server(handler)
+    patients = [Patient(name=[{"family": f"p{i}"}]) for i in range(100)]
+    response = await server.add_all_async(
+        patients, batch_size=10, max_concurrency=4, display=False
+    )
+
+    assert 1 < max_in_flight <= 4
+    assert len(response.create_responses) == 100
+    assert [r.name[0].family for r in response.resources] == [
+        f"p{i}" for i in range(100)
+    ]
+
+    patients[25].name[0].family = "fail"
+    with pytest.raises(HTTPStatusError):
+        await server.add_all_async(
+            patients, batch_size=10, max_concurrency=4, display=False
+        )
+
+    response = await server.add_all_async(
+        patients, batch_size=10, max_concurrency=4, display=False, fail_fast=False
+    )
+    assert len(response.create_responses) == 90
+    assert len(response.failed_batches) == 1
+    assert isinstance(response.failed_batches[0], BatchUploadFailure)
+    assert response.failed_batches[0].batch_index == 2
+    await server.aclose()
+
+
+def test_add_all_workers(mock_fhir_server):
+    lock = threading.Lock()
+    in_flight = 0
+    max_in_flight = 0
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        nonlocal in_flight, max_in_flight
+        with lock:
+            in_flight += 1
+            max_in_flight = max(max_in_flight, in_flight)
+        time.sleep(0.02)
+        with lock:
+            in_flight -= 1
+        if b"fail" in request.content:
+            return httpx.Response(500, json={"resourceType": "OperationOutcome"})
+        return _transaction_response(request)
+
+    server = mock_fhir_server(handler)
+    patients = [Patient(name=[{"family": f"p{i}"}]) for i in range(100)]
+    response = server.add_all(patients, batch_size=10, workers=4, display=False)
+
+    assert 1 < max_in_flight <= 4
+    assert [r.name[0].family for r in response.resources] == [
+        f"p{i}" for i in range(100)
+    ]
+
+    patients[95].name[0].family = "fail"
+    with pytest.raises(HTTPStatusError):
+        server.add_all(patients, batch_size=10, workers=4, display=False)
+
+    response = server.add_all(
+        patients, batch_size=10, workers=4, display=False, fail_fast=False
+    )
+    assert len(response.create_responses) == 90
+    assert response.failed_batches[0].batch_index == 9
+    server.close()
+
+
+def test_server_request_compression(mock_fhir_server):
+    received = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        received.append(request)
+        if request.headers.get("Content-Encoding") == "gzip":
+            request = httpx.Request(
+                request.method, request.url, content=gzip.decompress(request.content)
+            )
+        response = _transaction_response(request)
+        # answer with a gzip encoded body like a server negotiating compression
+        return httpx.Response(
+            response.status_code,
+            headers={"Content-Encoding": "gzip"},
+            content=gzip.compress(response.content),
+        )
+
+    server = mock_fhir_server(
+        handler, compress_requests=True, compression_min_size=2048
+    )
+    patients = [Patient(name=[{"family": f"p{i}"}]) for i in range(100)]
+    response = server.add_all(patients, display=False)
+    assert len(response.references) == 100
+
+    request = received[-1]
+    assert request.headers["Accept-Encoding"] == "gzip, deflate"
+    assert request.headers["Content-Encoding"] == "gzip"
+    assert int(request.headers["Content-Length"]) == len(request.content)
+    assert len(request.content) < len(
+        json_bytes(make_transaction_bundle(resources=patients))
+    )
+
+    # small bodies are sent uncompressed
+    server.add_all(patients[:2], display=False)
+    assert "Content-Encoding" not in received[-1].headers
+
+    with pytest.raises(ValueError):
+        mock_fhir_server(handler, compress_requests=True, compression_level=10).add(
+            patients[0]
+        )
+
+
+class _Http2StandInServer:
+    """
+    Minimal HTTP/2 (prior knowledge) server answering every GET request with a patient after a short delay, records
+    the number of connections and the maximum number of concurrently open streams on a connection.
+    """
+
+    def __init__(self, delay: float = 0.1):
+        self.delay = delay
+        self.connections = 0
+        self.requests = 0
+        self.max_open_streams = 0
+        self.closed = asyncio.Event()
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        import h2.config
+        import h2.connection
+        import h2.events
+
+        self.connections += 1
+        conn = h2.connection.H2Connection(
+            h2.config.H2Configuration(client_side=False, header_encoding="utf-8")
+        )
+        conn.initiate_connection()
+        writer.write(conn.data_to_send())
+        open_streams = {}
+        responses = set()
+        while data := await reader.read(65535):
+            for event in conn.receive_data(data):
+                if isinstance(event, h2.events.RequestReceived):
+                    self.requests += 1
+                    open_streams[event.stream_id] = dict(event.headers)
+                    self.max_open_streams = max(
+                        self.max_open_streams, len(open_streams)
+                    )
+                elif isinstance(event, h2.events.StreamEnded):
+                    task = asyncio.ensure_future(
+                        self._respond(conn, writer, event.stream_id, open_streams)
+                    )
+                    responses.add(task)
+                    task.add_done_callback(responses.discard)
+            writer.write(conn.data_to_send())
+            await writer.drain()
+        writer.close()
+        self.closed.set()
+
+    async def _respond(self, conn, writer, stream_id: int, open_streams: dict):
+        await asyncio.sleep(self.delay)
+        path = open_streams.pop(stream_id)[":path"]
+        body = orjson.dumps({"resourceType": "Patient", "id": path.rsplit("/", 1)[-1]})
+        conn.send_headers(
+            stream_id,
+            [
+                (":status", "200"),
+                ("content-type", "application/fhir+json"),
+                ("content-length", str(len(body))),
+            ],
+        )
+        conn.send_data(stream_id, body, end_stream=True)
+        writer.write(conn.data_to_send())
+
+
+@pytest.mark.asyncio
+async def test_server_http2_multiplexing():
+    pytest.importorskip("h2")
+    stand_in = _Http2StandInServer()
+    tcp_server = await asyncio.start_server(stand_in.handle, "127.0.0.1", 0)
+    port = tcp_server.sockets[0].getsockname()[1]
+
+    async with FhirServer(
+        api_address=f"http://127.0.0.1:{port}/fhir",
+        http2=True,
+        retry_status_codes=[503],
+    ) as server:
+        assert isinstance(server._async_client()._transport, RetryTransport)
+        patients = await asyncio.gather(
+            *[server.get_async(f"Patient/{i}") for i in range(10)]
+        )
+
+    await asyncio.wait_for(stand_in.closed.wait(), timeout=5)
+    tcp_server.close()
+    await tcp_server.wait_closed()
+    assert [p.id for p in patients] == [str(i) for i in range(10)]
+    assert stand_in.requests == 10
+    # all requests were multiplexed over a single connection
+    assert stand_in.connections == 1
+    assert stand_in.max_open_streams == 10
+
+
+def _resource_server_handler(requests: list):
+    # answers reads of single resources and batches of reads, accepts every transaction
+    def handler(request: httpx.Request) -> httpx.Response:
+        requests.append(request)
+        if request.method == "GET":
+            resource_type, resource_id = request.url.path.split("/")[-2:]
+            return httpx.Response(
+                200, json={"resourceType": resource_type, "id": resource_id}
+            )
+        bundle = orjson.loads(request.content)
+        entries = []
+        for entry in bundle["entry"]:
+            if entry["request"]["method"] == "GET":
+                resource_type, resource_id = entry["request"]["url"].split("/")
+                resource = {"resourceType": resource_type, "id": resource_id}
+                entries.append({"resource": resource, "response": {"status": "200"}})
+            else:
+                entries.append({"response": {"status": "200"}})
+        return httpx.Response(
+            200,
+            json={"resourceType": "Bundle", "type": "batch-response", "entry": entries},
+        )
+
+    return handler
+
+
+def test_server_resource_cache(mock_fhir_server):
+    requests = []
+    cache = ResourceCache(max_entries=10)
+    server = mock_fhir_server(_resource_server_handler(requests), cache=cache)
+
+    patient = server.get("Patient/1")
+    cached = server.get(Reference(reference="Patient/1"))
+    assert cached.id == patient.id == "1"
+    # every read returns a new resource object
+    assert cached is not patient
+    assert len(requests) == 1
+    assert cache.hits == 1 and cache.misses == 1
+
+    # only the resources that are not cached are requested in the batch
+    resources = server.get_many(["Patient/1", "Patient/2", "Organization/3"])
+    assert [r.id for r in resources] == ["1", "2", "3"]
+    assert len(orjson.loads(requests[-1].content)["entry"]) == 2
+    server.get_many(["Patient/2", "Organization/3"])
+    assert len(requests) == 2
+
+    # updated and deleted resources are read from the server again
+    patient.active = True
+    server.update([patient])
+    server.delete(references=["Organization/3"])
+    assert "Patient/1" not in cache and "Organization/3" not in cache
+    assert "Patient/2" in cache
+    server.get("Patient/1")
+    assert len(requests) == 5
+    assert cache.stats["entries"] == 2
+    server.close()
+
+    assert isinstance(
+        FhirServer(api_address="http://fhir.test/fhir", cache=True).cache, ResourceCache
+    )
+    assert FhirServer(api_address="http://fhir.test/fhir").cache is None
+
+
+@pytest.mark.asyncio
+async def test_server_resource_cache_async(mock_fhir_server):
+    requests = []
+    server = mock_fhir_server(_resource_server_handler(requests), cache=True)
+
+    await server.get_async("Patient/1")
+    resources = await server.get_many_async(["Patient/1", "Patient/2"])
+    assert [r.id for r in resources] == ["1", "2"]
+    await server.get_async("Patient/2")
+    assert len(requests) == 2
+
+    await server.update_async([{"resourceType": "Patient", "id": "2"}])
+    assert "Patient/2" not in server.cache
+    await server.delete_async(references=[Reference(reference="Patient/1")])
+    assert len(server.cache) == 0
+    await server.aclose()
+
+
+def _versioned_server_handler(requests: list, versions: dict, etag_header=True):
+    # answers reads with the current version of the resources, 304 if the version given in If-None-Match is current
+    def read(reference: str, if_none_match: str = None) -> tuple:
+        resource_type, resource_id = reference.split("/")
+        version = versions.get(reference, 1)
+        etag = f'W/"{version}"'
+        if if_none_match == etag:
+            return 304, None, etag
+        resource = {
+            "resourceType": resource_type,
+            "id": resource_id,
+            "meta": {"versionId": str(version), "lastUpdated": "2023-01-01T00:00:00Z"},
+        }
+        return 200, resource, etag
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        requests.append(request)
+        if request.method == "POST":
+            entries = []
+            for entry in orjson.loads(request.content)["entry"]:
+                status, resource, etag = read(
+                    entry["request"]["url"], entry["request"].get("ifNoneMatch")
+                )
+                response = {"status": f"{status}", "etag": etag}
+                entries.append({"resource": resource, "response": response})
+            return httpx.Response(
+                200,
+                json={
+                    "resourceType": "Bundle",
+                    "type": "batch-response",
+                    "entry": entries,
+                },
+            )
+        if_none_match = request.headers.get("If-None-Match")
+        if "?" in str(request.url):
+            etag = f'W/"search-{sum(versions.values())}"'
+            if if_none_match == etag:
+                return httpx.Response(304, headers={"ETag": etag})
+            bundle = {
+                "resourceType": "Bundle",
+                "type": "searchset",
+                "entry": [{"resource": read("Patient/1")[1]}],
+            }
+            return httpx.Response(200, json=bundle, headers={"ETag": etag})
+        status, resource, etag = read(
+            request.url.path.split("/fhir/")[1], if_none_match
+        )
+        headers = {"ETag": etag} if etag_header else {}
+        if status == 304:
+            return httpx.Response(304, headers=headers)
+        return httpx.Response(200, json=resource, headers=headers)
+
+    return handler
+
+
+@pytest.mark.parametrize("etag_header", [True, False])
+def test_server_conditional_reads(mock_fhir_server, etag_header):
+    requests = []
+    versions = {}
+    cache = ResourceCache(ttl=0)
+    server = mock_fhir_server(
+        _versioned_server_handler(requests, versions, etag_header), cache=cache
+    )
+
+    patient = server.get("Patient/1")
+    assert "If-None-Match" not in requests[-1].headers
+    # expired resources are revalidated, the server answers with 304 if they are unchanged
+    cached = server.get("Patient/1")
+    assert requests[-1].headers["If-None-Match"] == 'W/"1"'
+    assert requests[-1].headers["If-Modified-Since"] == "Sun, 01 Jan 2023 00:00:00 GMT"
+    assert cached == patient
+    assert cache.revalidated == 1
+
+    versions["Patient/1"] = 2
+    updated = server.get("Patient/1")
+    assert updated.meta.versionId == "2"
+    assert cache.lookup("Patient/1").etag == 'W/"2"'
+    assert cache.revalidated == 1
+
+    # expired resources are read conditionally in batches as well
+    resources = server.get_many(["Patient/1", "Patient/2"])
+    entries = orjson.loads(requests[-1].content)["entry"]
+    assert entries[0]["request"]["ifNoneMatch"] == 'W/"2"'
+    assert "ifNoneMatch" not in entries[1]["request"]
+    assert [r.meta.versionId for r in resources] == ["2", "1"]
+    assert cache.revalidated == 2
+    server.get_many(["Patient/2"])
+    assert cache.revalidated == 3
+    server.close()
+
+
+def test_server_cache_query_results(mock_fhir_server):
+    requests = []
+    versions = {"Patient/1": 1}
+    server = mock_fhir_server(_versioned_server_handler(requests, versions), cache=True)
+
+    # the resources of search results are stored with their validators, the search pages are always requested
+    response = server.query("Patient").all()
+    assert server.cache.lookup("Patient/1").etag == 'W/"1"'
+    server.query("Patient").all()
+    assert "If-None-Match" not in requests[-1].headers
+    n_requests = len(requests)
+    assert server.get("Patient/1").meta.versionId == "1"
+    assert len(requests) == n_requests
+
+    # newer versions returned by a search replace the cached resource
+    versions["Patient/1"] = 2
+    changed = server.query("Patient").all()
+    assert changed.resources[0].meta.versionId == "2"
+    assert response.resources[0].meta.versionId == "1"
+    assert server.get("Patient/1").meta.versionId == "2"
+
+    # resources returned only partially are not stored
+    subsetted = {
+        "resourceType": "Patient",
+        "id": "2",
+        "meta": {"tag": [{"code": "SUBSETTED"}]},
+    }
+    assert server.cache.put_bundle({"entry": [{"resource": subsetted}]}) == 0
+    assert "Patient/2" not in server.cache
+
+    # downloads not issued by get are not stored, even if they read a single resource
+    with server._sync_client().stream("GET", f"{server.api_address}/Binary/1") as r:
+        assert r.status_code == 200
+    assert "Binary/1" not in server.cache
+    server.close()
+
+    # resources of search results are revalidated with a conditional read
+    requests.clear()
+    server = mock_fhir_server(
+        _versioned_server_handler(requests, versions), cache=ResourceCache(ttl=0)
+    )
+    server.query("Patient").all()
+    assert server.get("Patient/1").meta.versionId == "2"
+    assert requests[-1].headers["If-None-Match"] == 'W/"2"'
+    assert server.cache.revalidated == 1
+    server.close()
+
+
+@pytest.mark.asyncio
+async def test_server_conditional_reads_async(mock_fhir_server):
+    requests = []
+    server = mock_fhir_server(
+        _versioned_server_handler(requests, {}), cache=ResourceCache(ttl=0)
+    )
+    patient = await server.get_async("Patient/1")
+    cached = await server.get_async("Patient/1")
+    assert requests[-1].headers["If-None-Match"] == 'W/"1"'
+    assert cached == patient
+    assert server.cache.revalidated == 1
+
+    server.cache.clear()
+    await server.query_async("Patient").all()
+    assert server.cache.lookup("Patient/1").etag == 'W/"1"'
+    await server.aclose()
+
+
+CAPABILITY_STATEMENT = {
+    "resourceType": "CapabilityStatement",
+    "status": "active",
+    "date": "2023-01-01",
+    "kind": "instance",
+    "fhirVersion": "4.0.1",
+    "format": ["json"],
+    "rest": [
+        {
+            "mode": "server",
+            "resource": [
+                {
+                    "type": "Patient",
+                    "searchParam": [
+                        {"name": "name", "type": "string"},
+                        {"name": "birthdate", "type": "date"},
+                    ],
+                },
+                {"type": "Observation"},
+            ],
+        }
+    ],
+}
+
+
+def test_server_capability_cache(mock_fhir_server, tmp_path):
+    requests = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        requests.append(request)
+        assert request.url.path == "/fhir/metadata"
+        return httpx.Response(200, json=CAPABILITY_STATEMENT)
+
+    server = mock_fhir_server(handler)
+    assert server.rest_resources == ["Patient", "Observation"]
+    assert server.rest_resources == ["Patient", "Observation"]
+    # the indexes are built without parsing the statement
+    assert server.server_capabilities._capability_statement is None
+    assert server.server_capabilities.supports("Patient", "birthdate")
+    assert not server.server_capabilities.supports("Patient", "gender")
+    assert not server.server_capabilities.supports("Encounter")
+    assert server.capabilities is server.capabilities
+    assert server.capabilities.rest[0].resource[0].type == "Patient"
+    assert len(requests) == 1
+
+    # servers of later processes load the statement from disk
+    cache = CapabilityCache(tmp_path, ttl=60)
+    mock_fhir_server(handler, capability_cache=cache).rest_resources
+    assert len(requests) == 2
+    assert mock_fhir_server(handler, capability_cache=cache).rest_resources == [
+        "Patient",
+        "Observation",
+    ]
+    assert len(requests) == 2
+
+    # expired and invalid statements are requested again
+    cache.ttl = 0
+    mock_fhir_server(handler, capability_cache=cache).rest_resources
+    assert len(requests) == 3
+    cache.ttl = 60
+    cache.path("http://fhir.test/fhir").write_text("not json")
+    mock_fhir_server(handler, capability_cache=cache).rest_resources
+    assert len(requests) == 4
+    assert cache.load("http://fhir.test/fhir") is not None
+    cache.invalidate("http://fhir.test/fhir")
+    assert cache.load("http://fhir.test/fhir") is None
+
+
+class _BulkExportStandInServer(BaseHTTPRequestHandler):
+    """
+    Local bulk data server, the export completes after one status request with a Retry-After header.
+    """
+
+    files = {
+        "Patient-0": [{"resourceType": "Patient", "id": f"p{i}"} for i in range(50)],
+        "Patient-1": [
+            {"resourceType": "Patient", "id": f"p{i}"} for i in range(50, 80)
+        ],
+        "Observation-0": [
+            {
+                "resourceType": "Observation",
+                "id": f"o{i}",
+                "status": "final",
+                "code": {"text": "test"},
+            }
+            for i in range(40)
+        ],
+    }
+    requests = []
+    polls = 0
+    requires_access_token = False
+    # whether the requests of each path were sent with an Authorization header
+    authorized = {}
+
+    def do_GET(self):
+        self.requests.append(self.path)
+        self.authorized[self.path] = "Authorization" in self.headers
+        base = f"http://{self.headers['Host']}"
+        if "$export" in self.path:
+            if self.headers.get("Prefer") != "respond-async":
+                return self._send(400, b"")
+            return self._send(202, b"", {"Content-Location": f"{base}/fhir/status/1"})
+        if self.path == "/fhir/status/1":
+            type(self).polls += 1
+            if self.polls == 1:
+                return self._send(202, b"", {"Retry-After": "0", "X-Progress": "50%"})
+            manifest = {
+                "transactionTime": "2023-01-01T00:00:00Z",
+                "request": f"{base}/fhir/$export",
+                "requiresAccessToken": self.requires_access_token,
+                "output": [
+                    {"type": name.split("-")[0], "url": f"{base}/files/{name}"}
+                    for name in self.files
+                ],
+                "error": [{"type": "OperationOutcome", "url": f"{base}/files/errors"}],
+            }
+            return self._send(200, orjson.dumps(manifest))
+        name = self.path.rsplit("/", 1)[-1]
+        if name == "errors":
+            outcome = {"resourceType": "OperationOutcome", "issue": []}
+            return self._send(200, orjson.dumps(outcome) + b"\n")
+        lines = b"\n".join(orjson.dumps(r) for r in self.files[name])
+        self._send(200, lines + b"\n", {"Content-Type": "application/fhir+ndjson"})
+
+    def do_DELETE(self):
+        self.requests.append(f"DELETE {self.path}")
+        self._send(202, b"")
+
+    def _send(self, status: int, body: bytes, headers: dict = None):
+        self.send_response(status)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def bulk_export_server():
+    _BulkExportStandInServer.requests = []
+    _BulkExportStandInServer.polls = 0
+    _BulkExportStandInServer.requires_access_token = False
+    _BulkExportStandInServer.authorized = {}
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), _BulkExportStandInServer)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    server = FhirServer(api_address=f"http://127.0.0.1:{httpd.server_port}/fhir")
+    yield server
+    server.close()
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def test_bulk_export(bulk_export_server, tmp_path):
+    response = bulk_export_server.bulk_export(
+        tmp_path / "export",
+        resource_types=["Patient", "Observation"],
+        since="2022-01-01T00:00:00+00:00",
+        max_concurrency=3,
+        display=False,
+    )
+    kick_off = _BulkExportStandInServer.requests[0]
+    assert "_type=Patient%2CObservation" in kick_off
+    assert "_since=2022-01-01T00%3A00%3A00Z" in kick_off
+    assert _BulkExportStandInServer.polls == 2
+
+    assert response.transaction_time == "2023-01-01T00:00:00Z"
+    assert response.resource_counts == {"Patient": 80, "Observation": 40}
+    assert [f.path.name for f in response.files] == [
+        "Patient-0.ndjson",
+        "Patient-1.ndjson",
+        "Observation-0.ndjson",
+    ]
+    lines = response.files[1].path.read_bytes().splitlines()
+    assert orjson.loads(lines[0])["id"] == "p50"
+    assert response.errors[0].path.name == "error-OperationOutcome-0.ndjson"
+
+
+def test_bulk_export_resources(bulk_export_server):
+    resources = list(
+        bulk_export_server.bulk_export_resources(max_concurrency=2, buffer_size=10)
+    )
+    assert len(resources) == 120
+    assert {r.id for r in resources if r.resource_type == "Patient"} == {
+        f"p{i}" for i in range(80)
+    }
+
+    # closing the iterator early stops the downloads
+    _BulkExportStandInServer.polls = 0
+    iterator = bulk_export_server.bulk_export_resources(buffer_size=5, validate=False)
+    first = [next(iterator) for _ in range(3)]
+    start = time.monotonic()
+    iterator.close()
+    assert time.monotonic() - start < 1
+    assert len(first) == 3
+
+
+def test_bulk_export_access_token(bulk_export_server, tmp_path):
+    bulk_export_server.token = "secret"
+    files = [f"/files/{name}" for name in _BulkExportStandInServer.files]
+
+    # the export is authorized, files that do not require the access token are downloaded without it
+    bulk_export_server.bulk_export(tmp_path / "public", display=False)
+    assert _BulkExportStandInServer.authorized["/fhir/status/1"]
+    assert not any(_BulkExportStandInServer.authorized[f] for f in files)
+
+    _BulkExportStandInServer.polls = 0
+    _BulkExportStandInServer.requires_access_token = True
+    resources = list(bulk_export_server.bulk_export_resources(validate=False))
+    assert len(resources) == 120
+    assert all(_BulkExportStandInServer.authorized[f] for f in files)
+
+
+def test_bulk_export_errors(mock_fhir_server, tmp_path):
+    def rejecting_handler(request: httpx.Request) -> httpx.Response:
+        return httpx.Response(400, json={"resourceType": "OperationOutcome"})
+
+    with pytest.raises(BulkExportError):
+        mock_fhir_server(rejecting_handler).bulk_export(tmp_path, display=False)
+
+    requests = []
+
+    def pending_handler(request: httpx.Request) -> httpx.Response:
+        requests.append(request)
+        if "$export" in request.url.path:
+            assert request.url.path == "/fhir/Group/1/$export"
+            location = "http://fhir.test/fhir/status/1"
+            return httpx.Response(202, headers={"Content-Location": location})
+        return httpx.Response(202)
+
+    server = mock_fhir_server(pending_handler)
+    with pytest.raises(TimeoutError):
+        server.bulk_export(
+            tmp_path, group="1", poll_interval=0.05, timeout=0.2, display=False
+        )
+    # the export is cancelled on the server
+    assert requests[-1].method == "DELETE"
+    with pytest.raises(ValueError):
+        server.bulk_export(tmp_path, group="1", patient=True)
+
+
+def _write_ndjson(path, resources, compress=False):
+    content = b"\n".join(orjson.dumps(r) for r in resources) + b"\n"
+    if compress:
+        content = gzip.compress(content)
+    path.write_bytes(content)
+    return path
+
+
+def test_load_ndjson(mock_fhir_server, tmp_path):
+    lock = threading.Lock()
+    in_flight = 0
+    max_in_flight = 0
+    bundles = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        nonlocal in_flight, max_in_flight
+        with lock:
+            in_flight += 1
+            max_in_flight = max(max_in_flight, in_flight)
+        time.sleep(0.02)
+        bundle = orjson.loads(request.content)
+        with lock:
+            in_flight -= 1
+            bundles.append(bundle)
+        if any(
+            e["resource"].get("name", [{}])[0].get("family") == "fail"
+            for e in bundle["entry"]
+        ):
+            return httpx.Response(500, json={"resourceType": "OperationOutcome"})
+        entries = []
+        for i, entry in enumerate(bundle["entry"]):
+            resource_id = entry["resource"].get("id", f"new-{i}")
+            location = f"{entry['resource']['resourceType']}/{resource_id}/_history/1"
+            entries.append({"response": {"status": "201", "location": location}})
+        return httpx.Response(
+            200,
+            json={
+                "resourceType": "Bundle",
+                "type": "transaction-response",
+                "entry": entries,
+            },
+        )
+
+    _write_ndjson(
+        tmp_path / "Patient-0.ndjson",
+        [{"resourceType": "Patient", "id": f"p{i}"} for i in range(45)],
+    )
+    _write_ndjson(
+        tmp_path / "Patient-1.ndjson.gz",
+        [{"resourceType": "Patient"} for _ in range(30)],
+        compress=True,
+    )
+    server = mock_fhir_server(handler)
+
+    response = server.load_ndjson(
+        str(tmp_path / "Patient-*"), batch_size=10, max_concurrency=3, display=False
+    )
+    assert response.n_resources == 75
+    assert response.n_batches == 8
+    assert not response.failed_batches
+    assert response.elapsed > 0 and response.resources_per_second > 0
+    assert 1 < max_in_flight <= 3
+    assert sorted(len(b["entry"]) for b in bundles) == [5] + [10] * 7
+    assert all(b["type"] == "transaction" for b in bundles)
+    # resources with an id keep it, resources without an id are created
+    requests = [e["request"] for b in bundles for e in b["entry"]]
+    assert {"method": "PUT", "url": "Patient/p0"} in requests
+    assert sum(r["method"] == "POST" for r in requests) == 30
+
+    bundles.clear()
+    response = server.load_ndjson(
+        [tmp_path / "Patient-0.ndjson"], batch_size=50, method="POST", display=False
+    )
+    assert response.n_resources == 45
+    assert all(e["request"]["method"] == "POST" for e in bundles[0]["entry"])
+
+    # updated resources are removed from the cache
+    server.cache = ResourceCache()
+    server.cache.put("Patient/p0", b'{"resourceType": "Patient", "id": "p0"}')
+    server.load_ndjson(tmp_path / "Patient-0.ndjson", method="PUT", display=False)
+    assert "Patient/p0" not in server.cache
+    with pytest.raises(ValueError, match="line 1 of .*Patient-1.ndjson.gz has no id"):
+        server.load_ndjson(
+            tmp_path / "Patient-1.ndjson.gz", method="PUT", display=False
+        )
+
+    _write_ndjson(
+        tmp_path / "failing.ndjson",
+        [{"resourceType": "Patient", "name": [{"family": "fail"}]}]
+        + [{"resourceType": "Patient"} for _ in range(10)],
+    )
+    with pytest.raises(HTTPStatusError) as error:
+        server.load_ndjson(tmp_path / "failing.ndjson", batch_size=5, display=False)
+    assert error.value.outcome == {"resourceType": "OperationOutcome"}
+    response = server.load_ndjson(
+        tmp_path / "failing.ndjson", batch_size=5, fail_fast=False, display=False
+    )
+    assert response.n_resources == 6
+    assert response.failed_batches[0].batch_index == 0
+
+    with pytest.raises(FileNotFoundError):
+        server.load_ndjson(tmp_path / "missing.ndjson")
+    with pytest.raises(ValueError):
+        server.load_ndjson(str(tmp_path / "*.json"))
+    server.close()
+
+
+def test_add_all_journal(mock_fhir_server, tmp_path):
+    uploaded = []
+    fail_family = "p30"
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        bundle = orjson.loads(request.content)
+        families = [e["resource"]["name"][0]["family"] for e in bundle["entry"]]
+        if fail_family in families:
+            return httpx.Response(500, json={"resourceType": "OperationOutcome"})
+        uploaded.extend(families)
+        return _transaction_response(request)
+
+    server = mock_fhir_server(handler)
+    journal_path = tmp_path / "upload.journal"
+    patients = [Patient(id=f"id{i}", name=[{"family": f"p{i}"}]) for i in range(50)]
+
+    with pytest.raises(HTTPStatusError):
+        server.add_all(patients, batch_size=10, journal=journal_path, display=False)
+    assert len(uploaded) == 30
+    with UploadJournal(journal_path) as journal:
+        assert len(journal) == 3
+        assert journal.references[:2] == ["Patient/0", "Patient/1"]
+
+    # the rerun only sends the unfinished batches and returns the ids of all resources
+    fail_family = None
+    uploaded.clear()
+    patients = [Patient(id=f"id{i}", name=[{"family": f"p{i}"}]) for i in range(50)]
+    response = server.add_all(
+        patients, batch_size=10, journal=str(journal_path), workers=2, display=False
+    )
+    assert uploaded == [f"p{i}" for i in range(30, 50)]
+    assert len(response.create_responses) == 50
+    assert [r.name[0].family for r in response.resources] == [
+        f"p{i}" for i in range(50)
+    ]
+    assert response.create_responses[0].resource_id == "0"
+    assert response.create_responses[0].version == 1
+
+    # resuming with different resources is rejected instead of creating duplicates
+    uploaded.clear()
+    other = [Patient(name=[{"family": f"other{i}"}]) for i in range(50)]
+    journal = UploadJournal(journal_path)
+    with pytest.raises(ValueError):
+        server.add_all(other, batch_size=10, journal=journal, display=False)
+    journal.clear()
+    server.add_all(other, batch_size=10, journal=journal, display=False)
+    assert len(uploaded) == 50 and len(journal) == 5
+    journal.close()
+    server.close()
+
+
+@pytest.mark.asyncio
+async def test_add_all_async_journal(mock_fhir_server, tmp_path):
+    uploaded = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        uploaded.append(request)
+        return _transaction_response(request)
+
+    server = mock_fhir_server(handler)
+    patients = [{"resourceType": "Patient", "id": f"id{i}"} for i in range(20)]
+    journal = UploadJournal(tmp_path / "upload.journal")
+    await server.add_all_async(
+        patients[:10], batch_size=5, journal=journal, display=False
+    )
+    response = await server.add_all_async(
+        patients, batch_size=5, journal=journal, max_concurrency=2, display=False
+    )
+    assert len(uploaded) == 4
+    assert len(response.create_responses) == 20
+    assert len(journal) == 4
+    journal.close()
+    await server.aclose()
+
+
+def test_load_ndjson_journal(mock_fhir_server, tmp_path):
+    uploaded = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        bundle = orjson.loads(request.content)
+        uploaded.append(len(bundle["entry"]))
+        return _transaction_response(request)
+
+    server = mock_fhir_server(handler)
+    path = _write_ndjson(
+        tmp_path / "Patient.ndjson",
+        [{"resourceType": "Patient", "id": f"p{i}"} for i in range(25)],
+    )
+    journal_path = tmp_path / "load.journal"
+    with UploadJournal(journal_path) as journal:
+        journal.record(0, "outdated", ["Patient/0"])
+    with pytest.raises(ValueError):
+        server.load_ndjson(path, batch_size=10, journal=journal_path, display=False)
+
+    journal_path.unlink()
+    response = server.load_ndjson(
+        path, batch_size=10, journal=journal_path, display=False
+    )
+    assert response.n_resources == 25 and response.skipped_batches == 0
+    response = server.load_ndjson(
+        path, batch_size=10, journal=journal_path, display=False
+    )
+    assert response.n_resources == 0 and response.skipped_batches == 3
+    assert uploaded == [10, 10, 5]
+    server.close()
+
+
+def _dirty_data_handler(requests: list):
+    """
+    Answer bundles like a server that rejects patients with the family name "invalid" and reports a conflict for
+    every second patient with the family name "conflict" in batch bundles
+    """
+    conflicts = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        bundle = orjson.loads(request.content)
+        requests.append(bundle)
+        families = [e["resource"]["name"][0]["family"] for e in bundle["entry"]]
+        outcome = {
+            "resourceType": "OperationOutcome",
+            "issue": [
+                {"severity": "error", "code": "invalid", "diagnostics": "invalid name"}
+            ],
+        }
+        if bundle["type"] == "transaction":
+            if "invalid" in families:
+                return httpx.Response(400, json=outcome)
+            return _transaction_response(request)
+        entries = []
+        for i, family in enumerate(families):
+            if family == "invalid":
+                entries.append({"response": {"status": "400", "outcome": outcome}})
+            elif family == "conflict" and len(conflicts) % 2 == 0:
+                conflicts.append(i)
+                entries.append({"response": {"status": "409 Conflict"}})
+            else:
+                if family == "conflict":
+                    conflicts.append(i)
+                location = f"Patient/{family}/_history/1"
+                entries.append({"response": {"status": "201", "location": location}})
+        return httpx.Response(
+            200,
+            json={"resourceType": "Bundle", "type": "batch-response", "entry": entries},
+        )
+
+    return handler
+
+
+def test_add_all_batch_bundles(mock_fhir_server, tmp_path):
+    requests = []
+    server = mock_fhir_server(_dirty_data_handler(requests))
+    families = ["p0", "invalid", "p2", "conflict", "p4", "p5", "invalid", "p7"]
+    patients = [Patient(name=[{"family": f}]) for f in families]
+
+    # a single invalid resource rejects the whole transaction
+    with pytest.raises(HTTPStatusError) as error:
+        server.add_all(patients, display=False)
+    assert error.value.outcome["issue"][0]["diagnostics"] == "invalid name"
+    assert "invalid name" in str(error.value)
+
+    requests.clear()
+    response = server.add_all(
+        patients, batch_size=4, transaction_type="batch", display=False
+    )
+    assert [r.resource_id for r in response.create_responses] == [
+        "p0",
+        "p2",
+        "conflict",
+        "p4",
+        "p5",
+        "p7",
+    ]
+    assert [(f.batch_index, f.entry_index) for f in response.failed_entries] == [
+        (0, 1),
+        (1, 2),
+    ]
+    assert response.failed_entries[0].status == 400
+    assert response.failed_entries[0].diagnostics == "error: invalid name"
+    assert response.failed_entries[0].resource is patients[1]
+    # only the conflicting entry is sent again
+    assert [len(b["entry"]) for b in requests] == [4, 1, 4]
+    assert all(b["type"] == "batch" for b in requests)
+
+    # failed entries are recorded in the journal and reported when the upload is resumed
+    journal_path = tmp_path / "upload.journal"
+    server.add_all(
+        patients, batch_size=4, transaction_type="batch", journal=journal_path
+    )
+    resumed = server.add_all(
+        patients, batch_size=4, transaction_type="batch", journal=journal_path
+    )
+    assert len(resumed.create_responses) == 6
+    assert [f.status for f in resumed.failed_entries] == [400, 400]
+    with UploadJournal(journal_path) as journal:
+        assert len(journal.references) == 6
+
+    with pytest.raises(ValueError):
+        server.add_all(patients, transaction_type="batch", bisect=True)
+    server.close()
+
+
+def test_add_all_bisect(mock_fhir_server):
+    requests = []
+    server = mock_fhir_server(_dirty_data_handler(requests))
+    families = [f"p{i}" for i in range(16)]
+    families[5] = "invalid"
+    patients = [Patient(name=[{"family": f}]) for f in families]
+
+    response = server.add_all(patients, batch_size=16, bisect=True, display=False)
+    assert len(response.create_responses) == 15
+    assert [r.resource.name[0].family for r in response.create_responses] == [
+        f for f in families if f != "invalid"
+    ]
+    assert len(response.failed_entries) == 1
+    failure = response.failed_entries[0]
+    assert failure.entry_index == 5 and failure.status == 400
+    assert failure.outcome["resourceType"] == "OperationOutcome"
+    # the bundle is split until the invalid resource is isolated
+    assert [len(b["entry"]) for b in requests] == [16, 8, 4, 4, 2, 1, 1, 2, 8]
+    server.close()
+
+
+def test_add_all_bisect_server_error(mock_fhir_server, tmp_path):
+    requests = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        requests.append(request)
+        return httpx.Response(503, json={"resourceType": "OperationOutcome"})
+
+    server = mock_fhir_server(handler)
+    patients = [Patient(name=[{"family": f"p{i}"}]) for i in range(16)]
+    journal_path = tmp_path / "upload.journal"
+
+    # temporary server errors are raised instead of splitting the bundle
+    with pytest.raises(HTTPStatusError) as error:
+        server.add_all(
+            patients, batch_size=16, bisect=True, journal=journal_path, display=False
+        )
+    assert error.value.response.status_code == 503
+    assert len(requests) == 1
+    with UploadJournal(journal_path) as journal:
+        assert len(journal) == 0
+    server.close()
+
+
+def test_add_all_journal_retryable_entries(mock_fhir_server, tmp_path):
+    requests = []
+    busy = True
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        bundle = orjson.loads(request.content)
+        families = [e["resource"]["name"][0]["family"] for e in bundle["entry"]]
+        requests.append(families)
+        entries = []
+        for family in families:
+            if busy and family.startswith("busy"):
+                entries.append({"response": {"status": "503 Service Unavailable"}})
+            else:
+                location = f"Patient/{family}/_history/1"
+                entries.append({"response": {"status": "201", "location": location}})
+        return httpx.Response(
+            200,
+            json={"resourceType": "Bundle", "type": "batch-response", "entry": entries},
+        )
+
+    server = mock_fhir_server(handler)
+    journal_path = tmp_path / "upload.journal"
+    families = ["p0", "busy1", "p2", "busy3"]
+    options = dict(
+        batch_size=2,
+        transaction_type="batch",
+        entry_retries=0,
+        journal=journal_path,
+        display=False,
+    )
+
+    response = server.add_all(
+        [Patient(name=[{"family": f}]) for f in families], **options
+    )
+    assert [f.status for f in response.failed_entries] == [503, 503]
+
+    # only the entries that failed with a temporary error are sent again when resuming
+    busy = False
+    requests.clear()
+    response = server.add_all(
+        [Patient(name=[{"family": f}]) for f in families], **options
+    )
+    assert sorted(requests) == [["busy1"], ["busy3"]]
+    assert [r.resource_id for r in response.create_responses] == families
+    assert not response.failed_entries
+
+    requests.clear()
+    response = server.add_all(
+        [Patient(name=[{"family": f}]) for f in families], **options
+    )
+    assert not requests
+    assert [r.resource_id for r in response.create_responses] == families
+    server.close()
+
+
+@pytest.mark.asyncio
+async def test_add_all_async_batch_bundles(mock_fhir_server):
+    requests = []
+    server = mock_fhir_server(_dirty_data_handler(requests))
+    families = ["p0", "invalid", "conflict", "p3"]
+    patients = [Patient(name=[{"family": f}]) for f in families]
+
+    response = await server.add_all_async(
+        patients, transaction_type="batch", display=False
+    )
+    assert len(response.create_responses) == 3
+    assert response.failed_entries[0].entry_index == 1
+
+    requests.clear()
+    response = await server.add_all_async(
+        patients, batch_size=2, bisect=True, max_concurrency=2, display=False
+    )
+    assert len(response.create_responses) == 3
+    assert response.failed_entries[0].entry_index == 1
+    await server.aclose()
+
+
+def _read_batch_handler(requests: list):
+    """
+    Answer batch bundles of reads like a server that stores patients with numeric ids
+    """
+    lock = threading.Lock()
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        bundle = orjson.loads(request.content)
+        with lock:
+            requests.append(bundle)
+        time.sleep(0.01)
+        entries = []
+        for entry in bundle["entry"]:
+            resource_type, resource_id = entry["request"]["url"].split("/")
+            if not resource_id.isdigit():
+                outcome = {
+                    "resourceType": "OperationOutcome",
+                    "issue": [
+                        {
+                            "severity": "error",
+                            "code": "not-found",
+                            "diagnostics": f"{resource_type}/{resource_id} is not known",
+                        }
+                    ],
+                }
+                entries.append({"response": {"status": "404", "outcome": outcome}})
+                continue
+            entries.append(
+                {
+                    "resource": {"resourceType": resource_type, "id": resource_id},
+                    "response": {"status": "200 OK"},
+                }
+            )
+        return httpx.Response(
+            200,
+            json={"resourceType": "Bundle", "type": "batch-response", "entry": entries},
+        )
+
+    return handler
+
+
+def test_get_many_batches(mock_fhir_server):
+    requests = []
+    server = mock_fhir_server(_read_batch_handler(requests))
+    references = [f"Patient/{i}" for i in range(95)]
+    references[42] = "Patient/missing"
+
+    resources = server.get_many(references, batch_size=10, workers=4)
+    assert len(requests) == 10
+    assert sorted(len(b["entry"]) for b in requests) == [5] + [10] * 9
+    assert resources[42] is None
+    assert [r.id for r in resources if r is not None] == [
+        str(i) for i in range(95) if i != 42
+    ]
+
+    requests.clear()
+    results = dict(
+        server.iter_many(
+            references + [Reference(reference="Patient/100")], batch_size=25
+        )
+    )
+    assert len(requests) == 4
+    assert results["Patient/100"].id == "100"
+    failure = results["Patient/missing"]
+    assert isinstance(failure, EntryReadFailure)
+    assert failure.status == 404
+    assert failure.diagnostics == "error: Patient/missing is not known"
+
+    # closing the iterator early does not read the remaining batches
+    requests.clear()
+    results = server.iter_many(references, batch_size=10, workers=2)
+    next(results)
+    results.close()
+    assert len(requests) <= 4
+
+    assert server.get_many([]) == []
+    server.close()
+
+
+@pytest.mark.asyncio
+async def test_get_many_batches_async(mock_fhir_server):
+    requests = []
+    server = mock_fhir_server(_read_batch_handler(requests))
+    references = [f"Patient/{i}" for i in range(50)] + ["Patient/missing"]
+
+    resources = await server.get_many_async(
+        references, batch_size=10, max_concurrency=3
+    )
+    assert len(requests) == 6
+    assert [r.id for r in resources[:50]] == [str(i) for i in range(50)]
+    assert resources[50] is None
+
+    results = {}
+    async for reference, result in server.iter_many_async(references, batch_size=20):
+        results[reference] = result
+    assert len(results) == 51
+    assert results["Patient/missing"].status == 404
+    await server.aclose()
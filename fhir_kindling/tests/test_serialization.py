@@ -1,15 +1,19 @@
 import os
 
+import orjson
 import pandas as pd
 import pytest
 from dotenv import find_dotenv, load_dotenv
+from fhir.resources.patient import Patient
 
 from fhir_kindling import FhirServer
+from fhir_kindling.fhir_server.transactions import make_transaction_bundle
 from fhir_kindling.serde.flatten import (
     flatten_resource,
     flatten_resources,
     flatten_response,
 )
+from fhir_kindling.serde.json import json_bytes, json_dict
 
 
 @pytest.fixture
@@ -78,3 +82,14 @@ def test_resources_to_csv(server):
 
     if os.path.exists("conditions.csv"):
         os.remove("conditions.csv")
+
+
+def test_json_bytes():
+    patient = Patient(id="1", active=True, birthDate="2000-01-01")
+    assert orjson.loads(json_bytes(patient)) == json_dict(patient)
+
+    bundle = make_transaction_bundle(resources=[patient])
+    assert orjson.loads(json_bytes(bundle)) == json_dict(bundle)
+
+    d = {"resourceType": "Patient", "id": "1"}
+    assert json_bytes(json_dict=d) == orjson.dumps(d)
@@ -1,6 +1,11 @@
+import asyncio
 import os
+import threading
+import time
 import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
+import httpx
 import pytest
 from dotenv import find_dotenv, load_dotenv
 from fhir.resources.condition import Condition
@@ -13,15 +18,24 @@ from fhir_kindling import FhirServer
 from fhir_kindling.benchmark.bench import ServerBenchmark
 from fhir_kindling.fhir_server.transfer import reference_graph
 from fhir_kindling.generators import PatientGenerator
+from fhir_kindling.util.circuit_breaker import (
+    CircuitBreaker,
+    CircuitOpenError,
+    CircuitState,
+)
+from fhir_kindling.util.hedging import HedgePolicy
+from fhir_kindling.util.rate_limit import AdaptiveLimiter, RateLimitTransport
 from fhir_kindling.util.references import (
     _resource_ids_from_query_response,
     check_missing_references,
     extract_references,
 )
+from fhir_kindling.util.resource_cache import ResourceCache
 from fhir_kindling.util.resources import (
     check_resource_contains_field,
     get_resource_fields,
 )
+from fhir_kindling.util.retry_transport import RetryBudget, RetryTransport
 
 
 @pytest.fixture
@@ -159,3 +173,380 @@ def test_retry_transport():
 
     with pytest.raises(Exception):
         transfer_server.query("Patient").all()
+
+
+@pytest.mark.asyncio
+async def test_retry_transport_async_does_not_block():
+    attempts = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        attempts.append(time.monotonic())
+        if len(attempts) < 3:
+            return httpx.Response(503)
+        return httpx.Response(200)
+
+    transport = RetryTransport(
+        httpx.MockTransport(handler), backoff_factor=0.1, jitter_ratio=0
+    )
+    ticks = 0
+
+    async def tick():
+        nonlocal ticks
+        while len(attempts) < 3:
+            ticks += 1
+            await asyncio.sleep(0.01)
+
+    async with httpx.AsyncClient(transport=transport) as client:
+        response, _ = await asyncio.gather(client.get("http://fhir.test/"), tick())
+
+    assert response.status_code == 200
+    assert attempts[2] - attempts[0] >= 0.25
+    # the event loop kept running other coroutines during the backoff
+    assert ticks >= 10
+
+
+@pytest.mark.asyncio
+async def test_retry_transport_async_http_transport():
+    responses = [503, 503, 200]
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            self.send_response(responses.pop(0))
+            self.send_header("Content-Length", "2")
+            self.end_headers()
+            self.wfile.write(b"{}")
+
+        def log_message(self, format, *args):
+            pass
+
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    # the responses of a real transport are async streams that have to be closed asynchronously
+    transport = RetryTransport(
+        httpx.AsyncHTTPTransport(), backoff_factor=0.01, jitter_ratio=0
+    )
+    try:
+        async with httpx.AsyncClient(transport=transport) as client:
+            response = await client.get(f"http://127.0.0.1:{httpd.server_port}/")
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+
+    assert response.status_code == 200
+    assert responses == []
+
+
+def test_retry_budget():
+    calls = 0
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        nonlocal calls
+        calls += 1
+        return httpx.Response(503)
+
+    budget = RetryBudget(ratio=0.2, min_retries=0)
+    transport = RetryTransport(
+        httpx.MockTransport(handler),
+        max_attempts=3,
+        backoff_factor=0,
+        retry_budget=budget,
+    )
+    with httpx.Client(transport=transport) as client:
+        for _ in range(10):
+            assert client.get("http://fhir.test/").status_code == 503
+
+    assert budget.requests == 10
+    assert budget.retries <= 2
+    assert calls == 10 + budget.retries
+
+    with pytest.raises(ValueError):
+        RetryBudget(ratio=-1)
+
+
+def test_adaptive_limiter():
+    limiter = AdaptiveLimiter(concurrency=4, latency_factor=None)
+    for _ in range(4):
+        assert limiter.try_acquire() == 0
+    assert limiter.try_acquire() == AdaptiveLimiter.POLL_INTERVAL
+    limiter.release(200, 0.01)
+    assert limiter.try_acquire() == 0
+    assert limiter.concurrency > 4
+
+    # throttling cuts the window, starts limiting the rate and pauses for retry-after
+    limiter.release(429, 0.01, retry_after=1)
+    assert limiter.concurrency < 4
+    assert limiter.rate is not None
+    assert limiter.throttled == 1
+    assert 0.9 < limiter.try_acquire() <= 1
+
+    # latency spikes reduce the window as well
+    limiter = AdaptiveLimiter(concurrency=8, latency_factor=3)
+    limiter.try_acquire()
+    limiter.release(200, 0.01)
+    limiter.try_acquire()
+    limiter.release(200, 0.5)
+    assert limiter.concurrency < 5
+    assert limiter.rate is None
+
+    with pytest.raises(ValueError):
+        AdaptiveLimiter(decrease_factor=1)
+
+
+@pytest.mark.asyncio
+async def test_rate_limit_transport():
+    in_flight = 0
+    throttled = 0
+
+    async def handler(request: httpx.Request) -> httpx.Response:
+        nonlocal in_flight, throttled
+        # the server only sustains 3 concurrent requests
+        if in_flight >= 3:
+            throttled += 1
+            return httpx.Response(429)
+        in_flight += 1
+        await asyncio.sleep(0.02)
+        in_flight -= 1
+        return httpx.Response(200)
+
+    limiter = AdaptiveLimiter(concurrency=20, latency_factor=None)
+    server = FhirServer(
+        api_address="http://fhir.test/fhir",
+        rate_limiter=limiter,
+        retry_status_codes=[429],
+        backoff_factor=0.01,
+        retry_budget_ratio=None,
+    )
+    server._base_transport = lambda async_transport=False: httpx.MockTransport(handler)
+    assert isinstance(server._setup_transport().wrapped_transport, RateLimitTransport)
+    client = server._async_client()
+    responses = await asyncio.gather(
+        *[client.get(f"http://fhir.test/fhir/Patient/{i}") for i in range(60)]
+    )
+    await server.aclose()
+
+    assert all(r.status_code == 200 for r in responses)
+    assert limiter.throttled == throttled
+    # without the limiter the first wave of requests alone gets throttled 57 times
+    assert throttled <= 15
+    assert limiter.in_flight == 0
+
+
+def test_circuit_breaker():
+    breaker = CircuitBreaker(consecutive_failures=3, reset_timeout=0.1)
+    for _ in range(2):
+        assert breaker.allow_request()
+        breaker.record_failure()
+    breaker.record_success()
+    assert breaker.state == CircuitState.CLOSED
+
+    for _ in range(3):
+        breaker.record_failure()
+    assert breaker.state == CircuitState.OPEN
+    assert not breaker.allow_request()
+    assert 0 < breaker.retry_in <= 0.1
+
+    time.sleep(0.1)
+    assert breaker.state == CircuitState.HALF_OPEN
+    # a single probe request is let through
+    assert breaker.allow_request()
+    assert not breaker.allow_request()
+    breaker.record_failure()
+    assert breaker.state == CircuitState.OPEN
+
+    time.sleep(0.1)
+    assert breaker.allow_request()
+    breaker.record_success()
+    assert breaker.state == CircuitState.CLOSED
+
+    # failure rate over the window of recent requests
+    breaker = CircuitBreaker(consecutive_failures=10, failure_rate=0.5, min_requests=4)
+    for _ in range(2):
+        breaker.record_success()
+        breaker.record_failure()
+    assert breaker.state == CircuitState.OPEN
+
+
+def test_circuit_breaker_transport():
+    calls = 0
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        nonlocal calls
+        calls += 1
+        return httpx.Response(503)
+
+    server = FhirServer(
+        api_address="http://fhir.test/fhir",
+        circuit_breaker=CircuitBreaker(consecutive_failures=3, reset_timeout=60),
+        retry_status_codes=[503],
+        backoff_factor=0,
+        max_atttempts=10,
+    )
+    server._base_transport = lambda async_transport=False: httpx.MockTransport(handler)
+    assert server.circuit_state == CircuitState.CLOSED
+
+    # the retries stop as soon as the circuit opens
+    with pytest.raises(CircuitOpenError):
+        server.get("Patient/1")
+    assert calls == 3
+    assert server.circuit_state == CircuitState.OPEN
+
+    with pytest.raises(CircuitOpenError):
+        server.get("Patient/1")
+    assert calls == 3
+    server.close()
+    assert FhirServer(api_address="http://fhir.test/fhir").circuit_state is None
+
+
+def test_hedge_policy():
+    with pytest.raises(ValueError):
+        HedgePolicy(percentile=0)
+
+    policy = HedgePolicy(percentile=90, min_samples=10, min_delay=0.01)
+    assert policy.hedge_delay is None
+    for latency in range(1, 11):
+        policy.record_latency(latency / 100)
+    assert policy.hedge_delay == pytest.approx(0.1)
+    assert HedgePolicy(delay=0.5).hedge_delay == 0.5
+
+    # the hedges are capped at the given fraction of the requests
+    policy = HedgePolicy(max_hedge_ratio=0.1)
+    for _ in range(20):
+        policy.budget.record_request()
+    assert sum(policy.acquire_hedge() for _ in range(5)) == 2
+    assert policy.hedged == 2
+
+
+def _slow_first_request_handler(requests: list, slow: float = 0.5):
+    # the first request for every resource is slow, the hedged duplicate is answered immediately
+    def handler(request: httpx.Request) -> httpx.Response:
+        requests.append(request)
+        if [r.url for r in requests].count(request.url) == 1:
+            time.sleep(slow)
+        resource_id = request.url.path.rsplit("/", 1)[-1]
+        return httpx.Response(200, json={"resourceType": "Patient", "id": resource_id})
+
+    return handler
+
+
+def test_hedged_requests(mock_fhir_server):
+    requests = []
+    policy = HedgePolicy(delay=0.05, max_hedge_ratio=1)
+    server = mock_fhir_server(_slow_first_request_handler(requests), hedging=policy)
+
+    # the hedge is answered first, the calling thread does not wait for the slow primary request
+    start = time.monotonic()
+    patient = server.get("Patient/1")
+    elapsed = time.monotonic() - start
+    assert patient.id == "1"
+    assert len(requests) == 2
+    assert elapsed < 0.3
+    assert policy.hedged == 1
+    assert policy.hedge_wins == 1
+
+    # the primary request is used if it is answered before the hedge
+    def slow_hedge_handler(request: httpx.Request) -> httpx.Response:
+        requests.append(request)
+        if [r.url for r in requests].count(request.url) == 2:
+            time.sleep(0.5)
+        else:
+            time.sleep(0.1)
+        return httpx.Response(200, json={"resourceType": "Patient", "id": "3"})
+
+    slow_hedge_policy = HedgePolicy(delay=0.05, max_hedge_ratio=1)
+    slow_hedge_server = mock_fhir_server(slow_hedge_handler, hedging=slow_hedge_policy)
+    start = time.monotonic()
+    assert slow_hedge_server.get("Patient/3").id == "3"
+    assert time.monotonic() - start < 0.4
+    assert slow_hedge_policy.hedged == 1
+    assert slow_hedge_policy.hedge_wins == 0
+    slow_hedge_server.close()
+
+    # the hedge replaces a primary request that fails
+    failing = []
+
+    def failing_handler(request: httpx.Request) -> httpx.Response:
+        failing.append(request)
+        if len(failing) == 1:
+            time.sleep(0.2)
+            raise httpx.ReadError("connection reset", request=request)
+        return httpx.Response(200, json={"resourceType": "Patient", "id": "2"})
+
+    failing_policy = HedgePolicy(delay=0.05, max_hedge_ratio=1)
+    failing_server = mock_fhir_server(failing_handler, hedging=failing_policy)
+    assert failing_server.get("Patient/2").id == "2"
+    assert failing_policy.hedge_wins == 1
+    failing_server.close()
+
+    # requests with side effects are never hedged
+    requests.clear()
+    server._sync_client().post("http://fhir.test/fhir/Patient", json={})
+    assert len(requests) == 1
+    assert policy.hedged == 1
+    server.close()
+
+    assert FhirServer(api_address="http://fhir.test/fhir", hedging=True).hedging
+
+
+@pytest.mark.asyncio
+async def test_hedged_requests_async(mock_fhir_server):
+    requests = []
+    sync_handler = _slow_first_request_handler(requests, slow=0)
+
+    async def handler(request: httpx.Request) -> httpx.Response:
+        response = sync_handler(request)
+        if len([r for r in requests if r.url == request.url]) == 1:
+            await asyncio.sleep(0.5)
+        return response
+
+    policy = HedgePolicy(delay=0.05, max_hedge_ratio=0.5)
+    server = mock_fhir_server(handler, hedging=policy)
+
+    start = time.monotonic()
+    patients = await asyncio.gather(
+        *[server.get_async(f"Patient/{i}") for i in range(10)]
+    )
+    elapsed = time.monotonic() - start
+    await server.aclose()
+
+    assert [p.id for p in patients] == [str(i) for i in range(10)]
+    # half of the requests may be hedged, the others wait for the slow response
+    assert policy.hedged == 5
+    assert policy.hedge_wins == 5
+    assert len(requests) == 15
+    assert elapsed < 1
+
+
+def test_resource_cache():
+    cache = ResourceCache(max_entries=2)
+    cache.put("Patient/1", b"1")
+    cache.put("/Patient/2", b"2")
+    assert cache.get("Patient/1") == b"1"
+    # the least recently used resource is evicted
+    cache.put("Patient/3", b"3")
+    assert cache.get("Patient/2") is None
+    assert cache.get("Patient/3") == b"3"
+    assert cache.evictions == 1
+    assert cache.stats["hit_rate"] == pytest.approx(2 / 3)
+
+    cache.invalidate(Patient(id="3"))
+    cache.invalidate({"resourceType": "Patient", "id": "1"})
+    assert len(cache) == 0 and cache.size == 0
+
+    cache = ResourceCache(max_entries=None, max_bytes=10)
+    cache.put("Patient/1", b"x" * 6)
+    cache.put("Patient/2", b"x" * 6)
+    assert "Patient/1" not in cache and cache.size == 6
+    # resources larger than the cache are not stored
+    cache.put("Patient/3", b"x" * 11)
+    assert "Patient/3" not in cache
+
+    cache = ResourceCache(ttl=0.05)
+    cache.put("Patient/1", b"1")
+    assert "Patient/1" in cache
+    time.sleep(0.06)
+    assert cache.get("Patient/1") is None
+    assert len(cache) == 0
+
+    with pytest.raises(ValueError):
+        ResourceCache(max_entries=0)
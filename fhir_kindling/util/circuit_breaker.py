@@ -0,0 +1,233 @@
+import threading
+import time
+from collections import deque
+from enum import Enum
+from typing import Iterable, Union
+
+import httpx
+
+
+class CircuitState(str, Enum):
+    """
+    States of a circuit breaker.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+
+class CircuitOpenError(httpx.TransportError):
+    """
+    Raised instead of sending a request while the circuit breaker of a server is open.
+    """
+
+
+class CircuitBreaker:
+    FAILURE_STATUS_CODES = frozenset([500, 502, 503, 504])
+
+    def __init__(
+        self,
+        consecutive_failures: int = 5,
+        failure_rate: float = 0.5,
+        window_size: int = 20,
+        min_requests: int = 10,
+        reset_timeout: float = 30,
+        half_open_requests: int = 1,
+        failure_status_codes: Iterable[int] = None,
+    ) -> None:
+        """
+        Circuit breaker shared by all requests to a server. The circuit opens when too many consecutive requests
+        fail or the failure rate of the most recent requests is too high, while open all requests fail fast. After the
+        reset timeout a limited number of probe requests are let through (half-open), the circuit closes again when
+        they succeed and reopens when they fail.
+
+        Args:
+            consecutive_failures: Number of consecutive failed requests that open the circuit.
+            failure_rate: Fraction of failed requests in the window of recent requests that opens the circuit.
+            window_size: Number of recent requests the failure rate is calculated from.
+            min_requests: Minimum number of requests in the window before the failure rate is evaluated.
+            reset_timeout: Time in seconds the circuit stays open before probe requests are let through.
+            half_open_requests: Number of concurrent probe requests allowed while half-open.
+            failure_status_codes: Response status codes counted as failures, in addition to transport errors.
+        """
+        if failure_rate <= 0 or failure_rate > 1:
+            raise ValueError(
+                f"failure rate should be between 0 and 1, actual {failure_rate}"
+            )
+        self.consecutive_failures = consecutive_failures
+        self.failure_rate = failure_rate
+        self.min_requests = min_requests
+        self.reset_timeout = reset_timeout
+        self.half_open_requests = half_open_requests
+        self.failure_status_codes = (
+            frozenset(failure_status_codes)
+            if failure_status_codes
+            else self.FAILURE_STATUS_CODES
+        )
+
+        self._state = CircuitState.CLOSED
+        self._outcomes = deque(maxlen=window_size)
+        self._failures_in_row = 0
+        self._opened_at = 0.0
+        self._probes = 0
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> CircuitState:
+        with self._lock:
+            self._check_reset_timeout()
+            return self._state
+
+    @property
+    def retry_in(self) -> float:
+        """Seconds until an open circuit lets the next probe request through"""
+        with self._lock:
+            if self._state != CircuitState.OPEN:
+                return 0.0
+            return max(0.0, self._opened_at + self.reset_timeout - time.monotonic())
+
+    def allow_request(self) -> bool:
+        """
+        Check whether a request may be sent in the current state of the circuit.
+
+        Returns:
+            True if the request may be sent, False if it should fail fast
+        """
+        with self._lock:
+            self._check_reset_timeout()
+            if self._state == CircuitState.CLOSED:
+                return True
+            if (
+                self._state == CircuitState.HALF_OPEN
+                and self._probes < self.half_open_requests
+            ):
+                self._probes += 1
+                return True
+            return False
+
+    def record_success(self) -> None:
+        with self._lock:
+            if self._state == CircuitState.HALF_OPEN:
+                self._close()
+                return
+            self._failures_in_row = 0
+            self._outcomes.append(True)
+
+    def record_failure(self) -> None:
+        with self._lock:
+            if self._state == CircuitState.HALF_OPEN:
+                self._open()
+                return
+            self._failures_in_row += 1
+            self._outcomes.append(False)
+            if self._state == CircuitState.CLOSED and self._should_open():
+                self._open()
+
+    def record_cancelled(self) -> None:
+        """Give back the probe slot of a request that was cancelled before it completed"""
+        with self._lock:
+            if self._state == CircuitState.HALF_OPEN and self._probes > 0:
+                self._probes -= 1
+
+    def is_failure(self, response: httpx.Response) -> bool:
+        return response.status_code in self.failure_status_codes
+
+    def reset(self) -> None:
+        """Close the circuit and forget all recorded requests"""
+        with self._lock:
+            self._close()
+
+    def _should_open(self) -> bool:
+        if self._failures_in_row >= self.consecutive_failures:
+            return True
+        if len(self._outcomes) < self.min_requests:
+            return False
+        failures = self._outcomes.count(False)
+        return failures / len(self._outcomes) >= self.failure_rate
+
+    def _check_reset_timeout(self) -> None:
+        if (
+            self._state == CircuitState.OPEN
+            and time.monotonic() - self._opened_at >= self.reset_timeout
+        ):
+            self._state = CircuitState.HALF_OPEN
+            self._probes = 0
+
+    def _open(self) -> None:
+        self._state = CircuitState.OPEN
+        self._opened_at = time.monotonic()
+        self._probes = 0
+
+    def _close(self) -> None:
+        self._state = CircuitState.CLOSED
+        self._outcomes.clear()
+        self._failures_in_row = 0
+        self._probes = 0
+
+    def __repr__(self):
+        return f"<CircuitBreaker(state={self.state.value})>"
+
+
+class CircuitBreakerTransport(httpx.AsyncBaseTransport, httpx.BaseTransport):
+    def __init__(
+        self,
+        wrapped_transport: Union[httpx.BaseTransport, httpx.AsyncBaseTransport],
+        circuit_breaker: CircuitBreaker,
+    ) -> None:
+        """
+        A transport that rejects requests with a CircuitOpenError while the given circuit breaker is open and records
+        the outcome of all other requests in the circuit breaker.
+
+        Args:
+            wrapped_transport: The transport to wrap.
+            circuit_breaker: The circuit breaker shared by all requests to the server.
+        """
+        self.wrapped_transport = wrapped_transport
+        self.circuit_breaker = circuit_breaker
+
+    def _check_circuit(self, request: httpx.Request) -> None:
+        if not self.circuit_breaker.allow_request():
+            raise CircuitOpenError(
+                f"Circuit breaker is open, requests to {request.url.host} are rejected for "
+                f"{self.circuit_breaker.retry_in:.1f}s",
+                request=request,
+            )
+
+    def _record(self, response: httpx.Response) -> None:
+        if self.circuit_breaker.is_failure(response):
+            self.circuit_breaker.record_failure()
+        else:
+            self.circuit_breaker.record_success()
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        self._check_circuit(request)
+        try:
+            response = self.wrapped_transport.handle_request(request)
+        except httpx.TransportError:
+            self.circuit_breaker.record_failure()
+            raise
+        except BaseException:
+            self.circuit_breaker.record_cancelled()
+            raise
+        self._record(response)
+        return response
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        self._check_circuit(request)
+        try:
+            response = await self.wrapped_transport.handle_async_request(request)
+        except httpx.TransportError:
+            self.circuit_breaker.record_failure()
+            raise
+        except BaseException:
+            self.circuit_breaker.record_cancelled()
+            raise
+        self._record(response)
+        return response
+
+    def close(self) -> None:
+        self.wrapped_transport.close()
+
+    async def aclose(self) -> None:
+        await self.wrapped_transport.aclose()
@@ -0,0 +1,68 @@
+import gzip
+from typing import Union
+
+import httpx
+
+
+class CompressionTransport(httpx.AsyncBaseTransport, httpx.BaseTransport):
+    MIN_SIZE = 1024
+
+    def __init__(
+        self,
+        wrapped_transport: Union[httpx.BaseTransport, httpx.AsyncBaseTransport],
+        min_size: int = MIN_SIZE,
+        compression_level: int = 6,
+    ) -> None:
+        """
+        A transport that gzip encodes the bodies of outgoing requests. Only bodies of at least min_size bytes are
+        compressed, smaller bodies and requests that are already encoded are sent as is.
+
+        Args:
+            wrapped_transport: The transport to wrap.
+            min_size: The minimum size of a request body in bytes to be compressed.
+            compression_level: The gzip compression level between 0 (no compression) and 9 (best compression).
+        """
+        if compression_level < 0 or compression_level > 9:
+            raise ValueError(
+                f"compression level should be between 0 and 9, actual {compression_level}"
+            )
+        self.wrapped_transport = wrapped_transport
+        self.min_size = min_size
+        self.compression_level = compression_level
+
+    def _compress(self, request: httpx.Request) -> httpx.Request:
+        if "Content-Encoding" in request.headers:
+            return request
+        try:
+            content = request.content
+        except httpx.RequestNotRead:
+            # streamed request bodies are sent unchanged
+            return request
+        if len(content) < self.min_size:
+            return request
+
+        compressed = gzip.compress(content, compresslevel=self.compression_level)
+        headers = request.headers.copy()
+        headers["Content-Encoding"] = "gzip"
+        headers["Content-Length"] = str(len(compressed))
+        return httpx.Request(
+            method=request.method,
+            url=request.url,
+            headers=headers,
+            content=compressed,
+            extensions=request.extensions,
+        )
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        return self.wrapped_transport.handle_request(self._compress(request))
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        return await self.wrapped_transport.handle_async_request(
+            self._compress(request)
+        )
+
+    def close(self) -> None:
+        self.wrapped_transport.close()
+
+    async def aclose(self) -> None:
+        await self.wrapped_transport.aclose()
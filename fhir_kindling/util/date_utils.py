@@ -1,4 +1,6 @@
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from typing import List, Mapping, Tuple, Union
 from zoneinfo import ZoneInfo
 
 
@@ -109,3 +111,78 @@ def subtract(
         weeks=weeks, days=days, hours=hours, minutes=minutes, seconds=seconds
     )
     return dt_result
+
+
+def to_search_string(value: Union[datetime, date, str]) -> str:
+    """
+    Convert a date or datetime into a value for a FHIR date search parameter. Datetimes are converted to UTC with
+    seconds precision, naive datetimes are assumed to be in local time.
+    :param value: date, datetime or ISO 8601 string
+    :return: string usable as search value e.g. 2021-01-01T00:00:00Z
+    """
+    if isinstance(value, str):
+        value = parse_datetime(value)
+    if not isinstance(value, datetime):
+        return value.isoformat()
+    utc_value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return utc_value.isoformat(timespec="seconds") + "Z"
+
+
+def to_http_date(value: Union[datetime, str]) -> str:
+    """
+    Convert a datetime into a date for http headers such as If-Modified-Since. Naive datetimes are assumed to be in
+    UTC.
+    :param value: datetime or ISO 8601 string e.g. the lastUpdated of a resource
+    :return: string in http date format e.g. Wed, 21 Oct 2015 07:28:00 GMT
+    """
+    if isinstance(value, str):
+        value = parse_datetime(value.replace("Z", "+00:00"))
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return format_datetime(value.astimezone(timezone.utc), usegmt=True)
+
+
+def retry_after_seconds(headers: Mapping[str, str]) -> Union[float, None]:
+    """
+    Seconds to wait as requested by the Retry-After header of a response, which is either a number of seconds or an
+    http date
+    :param headers: headers of the response
+    :return: seconds to wait, 0 for dates in the past, None if the header is missing or invalid
+    """
+    retry_after = (headers.get("Retry-After") or "").strip()
+    if not retry_after:
+        return None
+    if retry_after.isdigit():
+        return float(retry_after)
+    try:
+        retry_date = parsedate_to_datetime(retry_after)
+    except (TypeError, ValueError):
+        return None
+    if retry_date.tzinfo is None:
+        # dates with a -0000 offset are parsed as naive datetimes in UTC
+        retry_date = retry_date.replace(tzinfo=timezone.utc)
+    return max(0.0, (retry_date - datetime.now(timezone.utc)).total_seconds())
+
+
+def split_time_range(
+    start: datetime, end: datetime, n: int
+) -> List[Tuple[datetime, datetime]]:
+    """
+    Split the time range [start, end) into at most n disjoint consecutive windows of equal length in whole seconds
+    :param start: start of the time range (inclusive)
+    :param end: end of the time range (exclusive)
+    :param n: number of windows
+    :return: list of (start, end) tuples
+    """
+    if n < 1:
+        raise ValueError(f"Number of windows must be at least 1, given {n}")
+    if end <= start:
+        raise ValueError(f"End {end} of the time range has to be after start {start}")
+    step = (end - start) / n
+    boundaries = [start]
+    for i in range(1, n):
+        boundary = (start + step * i).replace(microsecond=0)
+        if boundary > boundaries[-1]:
+            boundaries.append(boundary)
+    boundaries.append(end)
+    return list(zip(boundaries[:-1], boundaries[1:]))
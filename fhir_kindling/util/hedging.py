@@ -0,0 +1,235 @@
+import asyncio
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Iterable, List, Union
+
+import httpx
+
+from fhir_kindling.util.retry_transport import RetryBudget
+
+
+class HedgePolicy:
+    HEDGED_METHODS = frozenset(["GET", "HEAD"])
+
+    def __init__(
+        self,
+        percentile: float = 95,
+        delay: float = None,
+        min_delay: float = 0.01,
+        min_samples: int = 20,
+        window_size: int = 1000,
+        max_hedge_ratio: float = 0.1,
+        hedged_methods: Iterable[str] = None,
+    ) -> None:
+        """
+        Policy for hedging idempotent requests shared by all requests to a server. If a request has not been answered
+        after the hedge delay a duplicate request is sent and the first response wins. The delay is the given
+        percentile of the recently observed latencies, so only the slowest requests are hedged.
+
+        Args:
+            percentile: Percentile of the observed latencies used as hedge delay.
+            delay: Fixed hedge delay in seconds, overrides the percentile based delay.
+            min_delay: Lower bound of the percentile based delay in seconds.
+            min_samples: Number of observed latencies required before requests are hedged.
+            window_size: Number of recent latencies the percentile is calculated from.
+            max_hedge_ratio: Maximum number of hedged requests as a fraction of the requests, caps the extra load.
+            hedged_methods: HTTP methods of the requests that may be hedged, only idempotent methods should be used.
+        """
+        if percentile <= 0 or percentile > 100:
+            raise ValueError(
+                f"percentile should be between 0 and 100, actual {percentile}"
+            )
+        self.percentile = percentile
+        self.delay = delay
+        self.min_delay = min_delay
+        self.min_samples = min_samples
+        self.hedged_methods = (
+            frozenset(hedged_methods) if hedged_methods else self.HEDGED_METHODS
+        )
+        self.budget = RetryBudget(ratio=max_hedge_ratio, min_retries=0)
+        self.hedged = 0
+        self.hedge_wins = 0
+        self._latencies = deque(maxlen=window_size)
+        self._lock = threading.Lock()
+
+    @property
+    def hedge_delay(self) -> Union[float, None]:
+        """Current delay after which a request is hedged, None if there are not enough samples yet"""
+        if self.delay is not None:
+            return self.delay
+        with self._lock:
+            if len(self._latencies) < self.min_samples:
+                return None
+            latencies = sorted(self._latencies)
+        index = min(len(latencies) - 1, int(len(latencies) * self.percentile / 100))
+        return max(self.min_delay, latencies[index])
+
+    def should_hedge(self, request: httpx.Request) -> bool:
+        return request.method in self.hedged_methods
+
+    def record_latency(self, latency: float) -> None:
+        with self._lock:
+            self._latencies.append(latency)
+
+    def acquire_hedge(self) -> bool:
+        """
+        Take a hedged request from the budget.
+
+        Returns:
+            True if the hedged request may be sent
+        """
+        if not self.budget.acquire_retry():
+            return False
+        with self._lock:
+            self.hedged += 1
+        return True
+
+    def record_hedge_win(self) -> None:
+        with self._lock:
+            self.hedge_wins += 1
+
+    def __repr__(self):
+        return (
+            f"<HedgePolicy(delay={self.hedge_delay}, hedged={self.hedged}, "
+            f"hedge_wins={self.hedge_wins})>"
+        )
+
+
+class HedgingTransport(httpx.AsyncBaseTransport, httpx.BaseTransport):
+    def __init__(
+        self,
+        wrapped_transport: Union[httpx.BaseTransport, httpx.AsyncBaseTransport],
+        policy: HedgePolicy,
+        max_workers: int = 32,
+    ) -> None:
+        """
+        A transport that hedges idempotent requests according to the given policy. The response of the request that
+        is answered first is used and the other response is discarded, async requests are cancelled. Hedged sync
+        requests are sent from a thread pool, so the calling thread can return as soon as either request is answered.
+
+        Args:
+            wrapped_transport: The transport to wrap.
+            policy: The hedging policy shared by all requests to the server.
+            max_workers: Maximum number of threads sending sync requests that may be hedged.
+        """
+        self.wrapped_transport = wrapped_transport
+        self.policy = policy
+        self.max_workers = max_workers
+        self._executor: Union[ThreadPoolExecutor, None] = None
+        self._executor_lock = threading.Lock()
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        if not self.policy.should_hedge(request):
+            return self.wrapped_transport.handle_request(request)
+        self.policy.budget.record_request()
+        delay = self.policy.hedge_delay
+        if delay is None:
+            return self._send(request)
+
+        executor = self._get_executor()
+        primary = executor.submit(self._send, request)
+        done, _ = wait([primary], timeout=delay)
+        if done or not self.policy.acquire_hedge():
+            return primary.result()
+        hedge = executor.submit(self._send, request)
+        return self._first_response([primary, hedge], hedge)
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        if not self.policy.should_hedge(request):
+            return await self.wrapped_transport.handle_async_request(request)
+        self.policy.budget.record_request()
+        delay = self.policy.hedge_delay
+        if delay is None:
+            return await self._send_async(request)
+
+        primary = asyncio.ensure_future(self._send_async(request))
+        try:
+            done, _ = await asyncio.wait({primary}, timeout=delay)
+        except BaseException:
+            primary.cancel()
+            raise
+        if done or not self.policy.acquire_hedge():
+            return await primary
+        hedge = asyncio.ensure_future(self._send_async(request))
+        return await self._first_response_async([primary, hedge], hedge)
+
+    def _send(self, request: httpx.Request) -> httpx.Response:
+        start = time.monotonic()
+        response = self.wrapped_transport.handle_request(request)
+        self.policy.record_latency(time.monotonic() - start)
+        return response
+
+    async def _send_async(self, request: httpx.Request) -> httpx.Response:
+        start = time.monotonic()
+        response = await self.wrapped_transport.handle_async_request(request)
+        self.policy.record_latency(time.monotonic() - start)
+        return response
+
+    def _first_response(self, futures: List[Future], hedge: Future) -> httpx.Response:
+        pending = set(futures)
+        errors = []
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            # the primary request wins if both requests were answered at the same time
+            winner = next(
+                (f for f in futures if f in done and f.exception() is None), None
+            )
+            errors.extend(f.exception() for f in done if f.exception())
+            if winner is not None:
+                for future in done - {winner}:
+                    if future.exception() is None:
+                        future.result().close()
+                # requests that are already being sent can not be interrupted, close their response once it arrives
+                for future in pending:
+                    if not future.cancel():
+                        future.add_done_callback(_close_response)
+                if winner is hedge:
+                    self.policy.record_hedge_win()
+                return winner.result()
+        raise errors[0]
+
+    async def _first_response_async(
+        self, tasks: List[asyncio.Future], hedge: asyncio.Future
+    ) -> httpx.Response:
+        pending = set(tasks)
+        errors = []
+        try:
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                winner = next((t for t in done if t.exception() is None), None)
+                errors.extend(t.exception() for t in done if t.exception())
+                if winner is not None:
+                    for task in done - {winner}:
+                        if task.exception() is None:
+                            await task.result().aclose()
+                    if winner is hedge:
+                        self.policy.record_hedge_win()
+                    return winner.result()
+            raise errors[0]
+        finally:
+            for task in pending:
+                task.cancel()
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers)
+            return self._executor
+
+    def close(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+        self.wrapped_transport.close()
+
+    async def aclose(self) -> None:
+        await self.wrapped_transport.aclose()
+
+
+def _close_response(future: Future) -> None:
+    if not future.cancelled() and future.exception() is None:
+        future.result().close()
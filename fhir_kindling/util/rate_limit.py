@@ -0,0 +1,234 @@
+import asyncio
+import threading
+import time
+from typing import Union
+
+import httpx
+
+from fhir_kindling.util.date_utils import retry_after_seconds
+
+
+class AdaptiveLimiter:
+    THROTTLE_STATUS_CODES = frozenset([429, 503])
+    # interval in seconds in which waiting requests check for a free slot in the concurrency window
+    POLL_INTERVAL = 0.01
+
+    def __init__(
+        self,
+        rate: float = None,
+        burst: int = 10,
+        min_rate: float = 1.0,
+        max_rate: float = None,
+        rate_increase: float = 1.0,
+        concurrency: float = 10,
+        min_concurrency: int = 1,
+        max_concurrency: int = 100,
+        decrease_factor: float = 0.5,
+        latency_factor: Union[float, None] = 3.0,
+    ) -> None:
+        """
+        Client side limiter shared by all requests to a server, combining a token bucket limiting the request rate
+        and a concurrency window limiting the number of requests in flight. Both limits adapt to the server using
+        additive increase/multiplicative decrease (AIMD): every successful request slowly raises the limits, a
+        throttled request (429/503) or a latency spike cuts them.
+
+        Args:
+            rate: Initial number of requests per second, None to not limit the rate until the server throttles.
+            burst: Maximum number of tokens in the bucket, i.e. requests that can be sent at once.
+            min_rate: Lower bound of the request rate.
+            max_rate: Upper bound of the request rate.
+            rate_increase: Requests per second the rate grows by per second of successful requests.
+            concurrency: Initial size of the concurrency window.
+            min_concurrency: Lower bound of the concurrency window.
+            max_concurrency: Upper bound of the concurrency window.
+            decrease_factor: Factor the limits are multiplied by when the server throttles.
+            latency_factor: Reduce the concurrency window when the latency of a request exceeds this multiple of the
+                baseline latency, None to ignore the latency.
+        """
+        if decrease_factor <= 0 or decrease_factor >= 1:
+            raise ValueError(
+                f"decrease factor should be between 0 and 1, actual {decrease_factor}"
+            )
+        self.rate = rate
+        self.burst = burst
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.rate_increase = rate_increase
+        self.concurrency = float(concurrency)
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.decrease_factor = decrease_factor
+        self.latency_factor = latency_factor
+
+        self.in_flight = 0
+        self.throttled = 0
+        self.baseline_latency: Union[float, None] = None
+        self._tokens = float(burst)
+        self._last_refill = time.monotonic()
+        self._blocked_until = 0.0
+        self._last_decrease = float("-inf")
+        self._lock = threading.Lock()
+
+    def try_acquire(self) -> float:
+        """
+        Try to take a slot in the concurrency window and a token from the bucket.
+
+        Returns:
+            0 if the request can be sent, otherwise the number of seconds to wait before trying again
+        """
+        with self._lock:
+            now = time.monotonic()
+            if now < self._blocked_until:
+                return self._blocked_until - now
+            if self.in_flight >= int(self.concurrency):
+                return self.POLL_INTERVAL
+            if self.rate is not None:
+                self._refill(now)
+                if self._tokens < 1:
+                    return (1 - self._tokens) / self.rate
+                self._tokens -= 1
+            self.in_flight += 1
+            return 0
+
+    def acquire(self) -> None:
+        """Block until the request can be sent"""
+        while wait := self.try_acquire():
+            time.sleep(wait)
+
+    async def acquire_async(self) -> None:
+        """Wait until the request can be sent without blocking the event loop"""
+        while wait := self.try_acquire():
+            await asyncio.sleep(wait)
+
+    def release(
+        self,
+        status_code: Union[int, None],
+        latency: float,
+        retry_after: Union[float, None] = None,
+    ) -> None:
+        """
+        Release the slot of a finished request and adapt the limits to the outcome of the request.
+
+        Args:
+            status_code: status code of the response, None if the request failed without a response
+            latency: time in seconds until the response was received
+            retry_after: seconds to wait before sending further requests as requested by the server
+        """
+        with self._lock:
+            self.in_flight -= 1
+            now = time.monotonic()
+            if status_code in self.THROTTLE_STATUS_CODES:
+                self.throttled += 1
+                if retry_after:
+                    self._blocked_until = max(self._blocked_until, now + retry_after)
+                self._decrease(now, latency, limit_rate=True)
+            elif status_code is not None and self._latency_spike(latency):
+                self._decrease(now, latency, limit_rate=False)
+            elif status_code is not None:
+                self._increase()
+            self._update_baseline(latency)
+
+    def _refill(self, now: float) -> None:
+        self._tokens = min(
+            self.burst, self._tokens + (now - self._last_refill) * self.rate
+        )
+        self._last_refill = now
+
+    def _increase(self) -> None:
+        # grow the window by about one request per window of successful requests
+        self.concurrency = min(
+            self.max_concurrency, self.concurrency + 1 / self.concurrency
+        )
+        if self.rate is not None:
+            self.rate = self.rate + self.rate_increase / self.rate
+            if self.max_rate is not None:
+                self.rate = min(self.rate, self.max_rate)
+
+    def _decrease(self, now: float, latency: float, limit_rate: bool) -> None:
+        # requests in flight when the limits were cut report the same congestion, cut at most once per round trip
+        if now - self._last_decrease < max(latency, self.baseline_latency or 0):
+            return
+        self._last_decrease = now
+        if limit_rate:
+            if self.rate is None:
+                # start limiting the rate at the throughput the current window sustains
+                self.rate = self.concurrency / max(latency, 0.001)
+                self._tokens = 0
+                self._last_refill = now
+            self.rate = max(self.min_rate, self.rate * self.decrease_factor)
+        self.concurrency = max(
+            self.min_concurrency, self.concurrency * self.decrease_factor
+        )
+
+    def _latency_spike(self, latency: float) -> bool:
+        return (
+            self.latency_factor is not None
+            and self.baseline_latency is not None
+            and latency > self.latency_factor * self.baseline_latency
+        )
+
+    def _update_baseline(self, latency: float) -> None:
+        if self.baseline_latency is None:
+            self.baseline_latency = latency
+            return
+        # moving average that follows faster latencies quicker than slower ones
+        weight = 0.05 if latency < self.baseline_latency else 0.01
+        self.baseline_latency += weight * (latency - self.baseline_latency)
+
+    def __repr__(self):
+        rate = f"{self.rate:.1f}" if self.rate is not None else None
+        return (
+            f"<AdaptiveLimiter(rate={rate}, concurrency={int(self.concurrency)}, "
+            f"in_flight={self.in_flight}, throttled={self.throttled})>"
+        )
+
+
+class RateLimitTransport(httpx.AsyncBaseTransport, httpx.BaseTransport):
+    def __init__(
+        self,
+        wrapped_transport: Union[httpx.BaseTransport, httpx.AsyncBaseTransport],
+        limiter: AdaptiveLimiter,
+    ) -> None:
+        """
+        A transport that sends requests only when the given limiter allows it and reports the outcome of every request
+        back to the limiter.
+
+        Args:
+            wrapped_transport: The transport to wrap.
+            limiter: The limiter shared by all requests to the server.
+        """
+        self.wrapped_transport = wrapped_transport
+        self.limiter = limiter
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        self.limiter.acquire()
+        start = time.monotonic()
+        try:
+            response = self.wrapped_transport.handle_request(request)
+        except BaseException:
+            self.limiter.release(None, time.monotonic() - start)
+            raise
+        self._release(response, time.monotonic() - start)
+        return response
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        await self.limiter.acquire_async()
+        start = time.monotonic()
+        try:
+            response = await self.wrapped_transport.handle_async_request(request)
+        except BaseException:
+            self.limiter.release(None, time.monotonic() - start)
+            raise
+        self._release(response, time.monotonic() - start)
+        return response
+
+    def _release(self, response: httpx.Response, latency: float) -> None:
+        self.limiter.release(
+            response.status_code, latency, retry_after_seconds(response.headers)
+        )
+
+    def close(self) -> None:
+        self.wrapped_transport.close()
+
+    async def aclose(self) -> None:
+        await self.wrapped_transport.aclose()
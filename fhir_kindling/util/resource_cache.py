@@ -0,0 +1,432 @@
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional, Tuple, Union
+
+import httpx
+import orjson
+from fhir.resources import FHIRAbstractModel
+from fhir.resources.reference import Reference
+
+from fhir_kindling.serde.json import json_bytes
+from fhir_kindling.util.date_utils import to_http_date
+
+# reads of a single resource {ResourceType}/{id} or a version of it, as opposed to searches and operations
+RESOURCE_READ_PATTERN = re.compile(
+    r"[A-Z][A-Za-z]+/[A-Za-z0-9\-.]{1,64}(/_history/[^/?]+)?"
+)
+# request extension marking the reads of get() whose responses are stored in the cache, other requests e.g. searches
+# or streamed downloads are passed through as is
+CACHED_READ_EXTENSION = "fhir_kindling.cached_read"
+
+
+class CacheEntry:
+    """
+    Json content of a cached resource and the validators to revalidate it with the server once it expired.
+    """
+
+    __slots__ = ("content", "expires", "etag", "last_modified")
+
+    def __init__(
+        self,
+        content: bytes,
+        expires: float,
+        etag: Optional[str] = None,
+        last_modified: Optional[str] = None,
+    ):
+        self.content = content
+        self.expires = expires
+        self.etag = etag
+        self.last_modified = last_modified
+
+    @property
+    def expired(self) -> bool:
+        return self.expires <= time.monotonic()
+
+    @property
+    def conditional_headers(self) -> dict:
+        """Headers of a conditional request that is answered with 304 Not Modified if the resource is unchanged"""
+        headers = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+
+class ResourceCache:
+    def __init__(
+        self,
+        max_entries: Optional[int] = 1000,
+        max_bytes: Optional[int] = None,
+        ttl: Optional[float] = 300,
+    ) -> None:
+        """
+        In-process cache of resources read from a server, keyed by the reference {ResourceType}/{id}. The raw json
+        content of the resources is stored, so every read returns a new resource object. The least recently used
+        resources are evicted when the cache holds more than max_entries resources or more than max_bytes of content.
+        Expired resources with an ETag or last modified date are kept and revalidated with a conditional request, an
+        unchanged resource is answered with 304 Not Modified instead of its content.
+
+        Args:
+            max_entries: Maximum number of cached resources, None for no limit.
+            max_bytes: Maximum size of the cached json content in bytes, None for no limit.
+            ttl: Time in seconds a cached resource is used before it is read or revalidated from the server again,
+                0 to revalidate on every read, None to cache resources until they are evicted or invalidated.
+        """
+        if max_entries is not None and max_entries < 1:
+            raise ValueError(f"max_entries should be at least 1, actual {max_entries}")
+        if max_bytes is not None and max_bytes < 1:
+            raise ValueError(f"max_bytes should be at least 1, actual {max_bytes}")
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.revalidated = 0
+        self.size = 0
+        self._entries: "OrderedDict[str, CacheEntry]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, reference: Union[str, Reference]) -> Optional[bytes]:
+        """
+        Look up the json content of a cached resource and mark it as recently used.
+
+        Args:
+            reference: reference {ResourceType}/{id} of the resource
+
+        Returns:
+            the json content of the resource, None if the resource is not cached or expired
+        """
+        key = resource_key(reference)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.expired:
+                # expired entries are kept if they can be revalidated
+                if not entry.conditional_headers:
+                    self._remove(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry.content
+
+    def lookup(self, reference: Union[str, Reference]) -> Optional[CacheEntry]:
+        """
+        Look up the cache entry of a resource including expired entries, without counting a hit or miss.
+
+        Args:
+            reference: reference {ResourceType}/{id} of the resource
+
+        Returns:
+            the cache entry of the resource, None if the resource is not cached
+        """
+        with self._lock:
+            return self._entries.get(resource_key(reference))
+
+    def put(
+        self,
+        reference: Union[str, Reference],
+        content: bytes,
+        etag: Optional[str] = None,
+        last_modified: Optional[str] = None,
+    ) -> None:
+        """
+        Store the json content of a resource read from the server.
+
+        Args:
+            reference: reference {ResourceType}/{id} of the resource
+            content: json content of the resource
+            etag: ETag of the resource e.g. W/"3", sent as If-None-Match to revalidate the resource
+            last_modified: last modified date of the resource in http date format, sent as If-Modified-Since to
+                revalidate the resource
+        """
+        if self.max_bytes is not None and len(content) > self.max_bytes:
+            return
+        key = resource_key(reference)
+        expires = time.monotonic() + self.ttl if self.ttl is not None else float("inf")
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = CacheEntry(content, expires, etag, last_modified)
+            self.size += len(content)
+            self._evict()
+
+    def put_bundle(self, bundle: dict) -> int:
+        """
+        Store the resources of a search result bundle e.g. a page of query results, with the validators of their
+        entries, so that later reads of the resources are answered from the cache or revalidated conditionally.
+        Resources of searches returning only a subset of their elements (_summary, _elements) are not stored.
+
+        Args:
+            bundle: json dictionary of the bundle
+
+        Returns:
+            the number of stored resources
+        """
+        stored = 0
+        for entry in bundle.get("entry") or []:
+            resource = entry.get("resource") or {}
+            if not (resource.get("resourceType") and resource.get("id")):
+                continue
+            meta = resource.get("meta") or {}
+            if any(tag.get("code") == "SUBSETTED" for tag in meta.get("tag") or []):
+                continue
+            etag, last_modified = entry_validators(entry.get("response") or {})
+            etag, last_modified = _validators_from_meta(meta, etag, last_modified)
+            self.put(
+                f"{resource['resourceType']}/{resource['id']}",
+                json_bytes(json_dict=resource),
+                etag,
+                last_modified,
+            )
+            stored += 1
+        return stored
+
+    def revalidate(self, reference: Union[str, Reference], entry: CacheEntry) -> None:
+        """
+        Store a cache entry again after the server confirmed that the resource is unchanged.
+
+        Args:
+            reference: reference {ResourceType}/{id} of the resource
+            entry: the entry that was revalidated
+        """
+        self.put(reference, entry.content, entry.etag, entry.last_modified)
+        with self._lock:
+            self.revalidated += 1
+
+    def invalidate(self, reference: Union[str, Reference, FHIRAbstractModel, dict]):
+        """
+        Remove a resource from the cache, e.g. after it was updated or deleted on the server.
+
+        Args:
+            reference: reference {ResourceType}/{id} of the resource or the resource itself
+        """
+        key = resource_key(reference)
+        with self._lock:
+            self._remove(key)
+
+    def clear(self) -> None:
+        """Remove all cached resources and reset the statistics"""
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+            self.revalidated = 0
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    @property
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hit_rate,
+            "revalidated": self.revalidated,
+            "evictions": self.evictions,
+            "entries": len(self),
+            "size": self.size,
+        }
+
+    def _remove(self, key: str) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= len(entry.content)
+
+    def _evict(self) -> None:
+        while self._entries and (
+            (self.max_entries is not None and len(self._entries) > self.max_entries)
+            or (self.max_bytes is not None and self.size > self.max_bytes)
+        ):
+            _, entry = self._entries.popitem(last=False)
+            self.size -= len(entry.content)
+            self.evictions += 1
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, reference: Union[str, Reference]) -> bool:
+        entry = self._entries.get(resource_key(reference))
+        return entry is not None and not entry.expired
+
+    def __repr__(self):
+        return (
+            f"<ResourceCache(entries={len(self)}, size={self.size}, hits={self.hits}, "
+            f"misses={self.misses})>"
+        )
+
+
+class CacheRevalidationTransport(httpx.AsyncBaseTransport, httpx.BaseTransport):
+    def __init__(
+        self,
+        wrapped_transport: Union[httpx.BaseTransport, httpx.AsyncBaseTransport],
+        cache: ResourceCache,
+        base_url: str,
+    ) -> None:
+        """
+        A transport that stores the responses to resource reads against the server in the given cache and turns reads
+        of cached resources into conditional requests, a 304 Not Modified response is replaced by the cached content.
+        Only requests marked with the CACHED_READ_EXTENSION are handled, all other requests e.g. searches or streamed
+        downloads are sent as is and their responses are not buffered.
+
+        Args:
+            wrapped_transport: The transport to wrap.
+            cache: The resource cache of the server.
+            base_url: The base url of the server, requests to other urls are sent as is.
+        """
+        self.wrapped_transport = wrapped_transport
+        self.cache = cache
+        self.base_url = base_url.rstrip("/") + "/"
+
+    def _prepare(
+        self, request: httpx.Request
+    ) -> Tuple[httpx.Request, Optional[str], Optional[CacheEntry]]:
+        url = str(request.url)
+        if (
+            request.method != "GET"
+            or not request.extensions.get(CACHED_READ_EXTENSION)
+            or not url.startswith(self.base_url)
+        ):
+            return request, None, None
+        key = url[len(self.base_url) :]
+        if not RESOURCE_READ_PATTERN.fullmatch(key):
+            return request, None, None
+        entry = self.cache.lookup(key)
+        if (
+            entry is None
+            or not entry.conditional_headers
+            or "If-None-Match" in request.headers
+            or "If-Modified-Since" in request.headers
+        ):
+            return request, key, None
+
+        headers = request.headers.copy()
+        headers.update(entry.conditional_headers)
+        conditional = httpx.Request(
+            method=request.method,
+            url=request.url,
+            headers=headers,
+            extensions=request.extensions,
+        )
+        return conditional, key, entry
+
+    def _not_modified(
+        self, response: httpx.Response, key: str, entry: CacheEntry
+    ) -> httpx.Response:
+        self.cache.revalidate(key, entry)
+        headers = response.headers.copy()
+        for header in ("Content-Length", "Content-Encoding", "Transfer-Encoding"):
+            headers.pop(header, None)
+        return httpx.Response(
+            200,
+            headers=headers,
+            content=entry.content,
+            extensions=response.extensions,
+        )
+
+    @staticmethod
+    def _should_store(response: httpx.Response, key: Optional[str]) -> bool:
+        return key is not None and response.status_code == 200
+
+    def _store(self, response: httpx.Response, key: str) -> None:
+        etag = response.headers.get("ETag")
+        last_modified = response.headers.get("Last-Modified")
+        if not (etag and last_modified):
+            etag, last_modified = _meta_validators(
+                response.content, etag, last_modified
+            )
+        self.cache.put(key, response.content, etag, last_modified)
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        request, key, entry = self._prepare(request)
+        response = self.wrapped_transport.handle_request(request)
+        if entry is not None and response.status_code == 304:
+            response.close()
+            return self._not_modified(response, key, entry)
+        if self._should_store(response, key):
+            response.read()
+            self._store(response, key)
+        return response
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        request, key, entry = self._prepare(request)
+        response = await self.wrapped_transport.handle_async_request(request)
+        if entry is not None and response.status_code == 304:
+            await response.aclose()
+            return self._not_modified(response, key, entry)
+        if self._should_store(response, key):
+            await response.aread()
+            self._store(response, key)
+        return response
+
+    def close(self) -> None:
+        self.wrapped_transport.close()
+
+    async def aclose(self) -> None:
+        await self.wrapped_transport.aclose()
+
+
+def resource_key(reference: Union[str, Reference, FHIRAbstractModel, dict]) -> str:
+    """
+    Cache key {ResourceType}/{id} of a reference or resource.
+    """
+    if isinstance(reference, Reference):
+        reference = reference.reference
+    elif isinstance(reference, FHIRAbstractModel):
+        reference = f"{reference.resource_type}/{reference.id}"
+    elif isinstance(reference, dict):
+        reference = f"{reference.get('resourceType')}/{reference.get('id')}"
+    return reference.strip("/")
+
+
+def entry_validators(
+    response: dict, content: Optional[bytes] = None
+) -> Tuple[Optional[str], Optional[str]]:
+    """
+    ETag and last modified date of a resource from the response of a batch entry, falling back to the version in
+    the meta of the resource.
+
+    Args:
+        response: the response element of a batch response entry
+        content: json content of the resource
+
+    Returns:
+        Tuple of the ETag and the last modified date in http date format
+    """
+    etag = response.get("etag")
+    last_modified = response.get("lastModified")
+    if last_modified:
+        last_modified = to_http_date(last_modified)
+    if content is not None and not (etag and last_modified):
+        etag, last_modified = _meta_validators(content, etag, last_modified)
+    return etag, last_modified
+
+
+def _meta_validators(
+    content: bytes, etag: Optional[str], last_modified: Optional[str]
+) -> Tuple[Optional[str], Optional[str]]:
+    # servers that do not send an ETag or last modified date still report the version in the meta of the resource
+    try:
+        meta = orjson.loads(content).get("meta") or {}
+    except (orjson.JSONDecodeError, AttributeError):
+        return etag, last_modified
+    return _validators_from_meta(meta, etag, last_modified)
+
+
+def _validators_from_meta(
+    meta: dict, etag: Optional[str], last_modified: Optional[str]
+) -> Tuple[Optional[str], Optional[str]]:
+    if not etag and meta.get("versionId"):
+        etag = f'W/"{meta["versionId"]}"'
+    if not last_modified and meta.get("lastUpdated"):
+        last_modified = to_http_date(meta["lastUpdated"])
+    return etag, last_modified
@@ -1,11 +1,48 @@
+import asyncio
 import random
-from datetime import datetime
+import threading
 from time import sleep
 from typing import Iterable, Mapping, Union
 
 import httpx
 
-from fhir_kindling.util.date_utils import convert_to_local_datetime, parse_datetime
+from fhir_kindling.util.date_utils import retry_after_seconds
+
+
+class RetryBudget:
+    def __init__(self, ratio: float = 0.2, min_retries: int = 10) -> None:
+        """
+        Caps the number of retries to a fraction of the requests made, so that retries can not multiply the load on
+        a server that is already saturated.
+
+        Args:
+            ratio: The maximum number of retries as a fraction of the number of requests.
+            min_retries: The number of retries that are always allowed, independent of the number of requests.
+        """
+        if ratio < 0:
+            raise ValueError(f"retry budget ratio should be positive, actual {ratio}")
+        self.ratio = ratio
+        self.min_retries = min_retries
+        self.requests = 0
+        self.retries = 0
+        self._lock = threading.Lock()
+
+    def record_request(self) -> None:
+        with self._lock:
+            self.requests += 1
+
+    def acquire_retry(self) -> bool:
+        """
+        Take a retry from the budget.
+
+        Returns:
+            True if the retry is within the budget, False if the budget is exhausted
+        """
+        with self._lock:
+            if self.retries >= self.min_retries + self.ratio * self.requests:
+                return False
+            self.retries += 1
+            return True
 
 
 class RetryTransport(httpx.AsyncBaseTransport, httpx.BaseTransport):
@@ -24,6 +61,7 @@ class RetryTransport(httpx.AsyncBaseTransport, httpx.BaseTransport):
         respect_retry_after_header: bool = True,
         retryable_methods: Iterable[str] = None,
         retry_status_codes: Iterable[int] = None,
+        retry_budget: RetryBudget = None,
     ) -> None:
         """
         A transport that retries requests that fail with retryable status codes.
@@ -41,6 +79,7 @@ class RetryTransport(httpx.AsyncBaseTransport, httpx.BaseTransport):
                 when retrying requests.
             retryable_methods: The HTTP methods that should be retried.
             retry_status_codes: The HTTP status codes that should be retried.
+            retry_budget: Optional budget shared by all requests of the transport that caps the number of retries.
         """
         self.wrapped_transport = wrapped_transport
         if jitter_ratio < 0 or jitter_ratio > 0.5:
@@ -63,30 +102,35 @@ class RetryTransport(httpx.AsyncBaseTransport, httpx.BaseTransport):
         )
         self.jitter_ratio = jitter_ratio
         self.max_backoff_wait = max_backoff_wait
+        self.retry_budget = retry_budget
 
     def _calculate_sleep(
         self, attempts_made: int, headers: Union[httpx.Headers, Mapping[str, str]]
     ) -> float:
-        retry_after_header = (headers.get("Retry-After") or "").strip()
-        if self.respect_retry_after_header and retry_after_header:
-            if retry_after_header.isdigit():
-                return float(retry_after_header)
-
-            try:
-                # convert to local time
-                parsed_date = convert_to_local_datetime(parse_datetime(retry_after_header)) 
-                diff = (parsed_date - datetime.now().astimezone()).total_seconds()
-                if diff > 0:
-                    return min(diff, self.max_backoff_wait)
-            except ValueError:
-                pass
+        if self.respect_retry_after_header:
+            retry_after = retry_after_seconds(headers)
+            if retry_after:
+                return min(retry_after, self.max_backoff_wait)
 
         backoff = self.backoff_factor * (2 ** (attempts_made - 1))
         jitter = (backoff * self.jitter_ratio) * random.choice([1, -1])
         total_backoff = backoff + jitter
         return min(total_backoff, self.max_backoff_wait)
 
+    def _should_retry(self, remaining_attempts: int, response: httpx.Response) -> bool:
+        if (
+            remaining_attempts < 1
+            or response.status_code not in self.retry_status_codes
+        ):
+            return False
+        return self.retry_budget is None or self.retry_budget.acquire_retry()
+
+    def _record_request(self) -> None:
+        if self.retry_budget is not None:
+            self.retry_budget.record_request()
+
     def handle_request(self, request: httpx.Request) -> httpx.Response:
+        self._record_request()
         response = self.wrapped_transport.handle_request(request)
 
         if request.method not in self.retryable_methods:
@@ -96,10 +140,7 @@ class RetryTransport(httpx.AsyncBaseTransport, httpx.BaseTransport):
         attempts_made = 1
 
         while True:
-            if (
-                remaining_attempts < 1
-                or response.status_code not in self.retry_status_codes
-            ):
+            if not self._should_retry(remaining_attempts, response):
                 return response
 
             response.close()
@@ -113,6 +154,7 @@ class RetryTransport(httpx.AsyncBaseTransport, httpx.BaseTransport):
             remaining_attempts -= 1
 
     async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        self._record_request()
         response = await self.wrapped_transport.handle_async_request(request)
 
         if request.method not in self.retryable_methods:
@@ -122,18 +164,22 @@ class RetryTransport(httpx.AsyncBaseTransport, httpx.BaseTransport):
         attempts_made = 1
 
         while True:
-            if (
-                remaining_attempts < 1
-                or response.status_code not in self.retry_status_codes
-            ):
+            if not self._should_retry(remaining_attempts, response):
                 return response
 
-            response.close()
+            await response.aclose()
 
             sleep_for = self._calculate_sleep(attempts_made, response.headers)
-            sleep(sleep_for)
+            # do not block the event loop while waiting for the next attempt
+            await asyncio.sleep(sleep_for)
 
             response = await self.wrapped_transport.handle_async_request(request)
 
             attempts_made += 1
             remaining_attempts -= 1
+
+    def close(self) -> None:
+        self.wrapped_transport.close()
+
+    async def aclose(self) -> None:
+        await self.wrapped_transport.aclose()